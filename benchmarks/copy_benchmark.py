@@ -0,0 +1,78 @@
+"""Compares the transfer strategies of sourcelib.copy on large temporary files.
+
+Requires sourcelib to be installed (e.g., pip install -e .). The files are created in
+--folder, so point it at the filesystem you stage to (e.g., a btrfs/xfs scratch disk)
+to see reflinks in action.
+
+Usage:
+    python benchmarks/copy_benchmark.py --files 4 --size-mb 1024
+    python benchmarks/copy_benchmark.py --folder /scratch --strategies reflink copy
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from sourcelib.copy import TRANSFER_STRATEGIES, transfer
+
+
+def create_files(folder: Path, number_of_files: int, size: int):
+    chunk = os.urandom(1 << 20)
+    paths = []
+    for index in range(number_of_files):
+        path = folder / f"file_{index}.bin"
+        with open(path, "wb") as file:
+            for _ in range(size // len(chunk)):
+                file.write(chunk)
+        paths.append(path)
+    return paths
+
+
+def free_bytes(folder: Path) -> int:
+    statvfs = os.statvfs(folder)
+    return statvfs.f_bavail * statvfs.f_frsize
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--folder", type=Path, default=None)
+    parser.add_argument(
+        "--strategies",
+        nargs="+",
+        default=TRANSFER_STRATEGIES,
+        choices=TRANSFER_STRATEGIES,
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.folder) as temporary_folder:
+        source_folder = Path(temporary_folder) / "source"
+        source_folder.mkdir()
+        sources = create_files(source_folder, args.files, args.size_mb << 20)
+        total = args.files * (args.size_mb << 20)
+
+        print(f"{'strategy':<16}{'seconds':>10}{'MB/s':>10}{'extra disk MB':>16}")
+        for strategy in args.strategies:
+            destination_folder = Path(temporary_folder) / strategy
+            destination_folder.mkdir()
+            free_before = free_bytes(destination_folder)
+
+            start = time.perf_counter()
+            for source in sources:
+                transfer(source, destination_folder / source.name, strategy)
+            seconds = time.perf_counter() - start
+
+            extra = max(free_before - free_bytes(destination_folder), 0)
+            print(
+                f"{strategy:<16}{seconds:>10.2f}{total / seconds / 1e6:>10.0f}"
+                f"{extra / 1e6:>16.0f}"
+            )
+            shutil.rmtree(destination_folder)
+
+
+if __name__ == "__main__":
+    main()
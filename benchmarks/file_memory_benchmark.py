@@ -0,0 +1,69 @@
+"""Measures the memory of File instances with tracemalloc.
+
+Requires sourcelib to be installed (e.g., pip install -e .). The paths are spread over
+--folders folders, like slides in a dataset, and kept alive outside of the measurement
+so only the File objects are counted.
+
+Usage:
+    python benchmarks/file_memory_benchmark.py --files 1000000
+"""
+
+import argparse
+import time
+import tracemalloc
+from copy import copy
+from pathlib import Path
+
+from sourcelib.extension import Extension, create_extensions_mapping
+from sourcelib.file import File, generate_file_class
+
+EXTENSIONS = create_extensions_mapping([Extension((".tif",))])
+BenchmarkFile = generate_file_class("benchmark", EXTENSIONS)
+
+
+class DictFile:
+    """The File layout before it was slotted: a __dict__ and two Path objects."""
+
+    EXTENSIONS = EXTENSIONS
+
+    def __init__(self, path, mode=None):
+        self._mode = mode
+        self._path = Path(path).absolute()
+        self._original_path = copy(self._path)
+        self._extension = self.EXTENSIONS[self._path.suffix]
+
+
+def measure(file_cls, paths):
+    tracemalloc.start()
+    start = time.perf_counter()
+    files = [file_cls(path=path) for path in paths]
+    seconds = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del files
+    return size, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=1_000_000)
+    parser.add_argument("--folders", type=int, default=1_000)
+    args = parser.parse_args()
+
+    paths = [
+        f"/data/dataset/folder_{index % args.folders:05d}/slide_{index:08d}.tif"
+        for index in range(args.files)
+    ]
+
+    print(f"{'class':<16}{'MB':>10}{'bytes/file':>12}{'seconds':>10}")
+    for file_cls in (DictFile, BenchmarkFile):
+        size, seconds = measure(file_cls, paths)
+        print(
+            f"{file_cls.__name__:<16}{size / 1e6:>10.0f}"
+            f"{size / args.files:>12.0f}{seconds:>10.2f}"
+        )
+    assert isinstance(BenchmarkFile(path=paths[0]), File)
+
+
+if __name__ == "__main__":
+    main()
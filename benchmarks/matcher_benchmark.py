@@ -0,0 +1,73 @@
+"""Compares the per-path cost of naive and compiled path filtering.
+
+The naive filter checks every pattern against every path, as get_files_from_paths
+used to; the compiled filter is sourcelib.matcher.PathMatcher.
+
+Requires sourcelib to be installed (e.g., pip install -e .).
+
+Usage:
+    python benchmarks/matcher_benchmark.py --paths 1000000 --patterns 500
+"""
+
+import argparse
+import random
+import time
+
+from sourcelib.matcher import PathMatcher
+
+
+def naive_select(path, filters, excludes):
+    if any((exclude in path for exclude in excludes)):
+        return False
+    return not filters or any((filter in path for filter in filters))
+
+
+def generate_paths(number_of_paths: int):
+    return [
+        f"/data/center_{index % 17}/patient_{index % 9973:05d}/slide_{index:07d}.tif"
+        for index in range(number_of_paths)
+    ]
+
+
+def generate_patterns(number_of_patterns: int):
+    return [f"slide_{random.randrange(10**7):07d}" for _ in range(number_of_patterns)]
+
+
+def measure(select, paths):
+    start = time.perf_counter()
+    selected = sum(1 for path in paths if select(path))
+    return (time.perf_counter() - start) / len(paths), selected
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--paths", type=int, default=1_000_000)
+    parser.add_argument("--patterns", type=int, default=500)
+    parser.add_argument(
+        "--naive-paths",
+        type=int,
+        default=20_000,
+        help="number of paths for the (slow) naive filter",
+    )
+    args = parser.parse_args()
+
+    random.seed(0)
+    paths = generate_paths(args.paths)
+    filters = generate_patterns(args.patterns)
+    excludes = generate_patterns(args.patterns)
+
+    naive_seconds, naive_selected = measure(
+        lambda path: naive_select(path, filters, excludes), paths[: args.naive_paths]
+    )
+    matcher = PathMatcher(filters, excludes)
+    compiled_seconds, compiled_selected = measure(matcher, paths)
+
+    print(f"{args.patterns} filters and {args.patterns} excludes")
+    print(f"naive:    {naive_seconds * 1e6:8.2f} us/path ({args.naive_paths} paths)")
+    print(f"compiled: {compiled_seconds * 1e6:8.2f} us/path ({args.paths} paths)")
+    print(f"speedup:  {naive_seconds / compiled_seconds:8.1f}x")
+    print(f"selected: {compiled_selected} paths")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Compares the serial and the parallel folder walk of get_files_from_folder.
+
+Requires sourcelib to be installed (e.g., pip install -e .).
+
+Usage:
+    python benchmarks/scan_benchmark.py --files 100000 --workers 8
+    python benchmarks/scan_benchmark.py --folder /mnt/nfs/dataset --workers 16
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from sourcelib.collect import get_files_from_folder
+from sourcelib.extension import Extension, create_extensions_mapping
+from sourcelib.file import generate_file_class
+
+BenchmarkFile = generate_file_class(
+    "benchmark",
+    create_extensions_mapping([Extension((".tif",)), Extension((".xml",))]),
+)
+
+
+def generate_tree(root: Path, number_of_files: int, files_per_folder: int = 100):
+    for index in range(number_of_files):
+        folder = root / f"{index // (files_per_folder * 10):04d}" / f"{index // files_per_folder:06d}"
+        if index % files_per_folder == 0:
+            folder.mkdir(parents=True)
+        suffix = ".tif" if index % 2 else ".xml"
+        (folder / f"file_{index:07d}{suffix}").touch()
+
+
+def measure(folder: Path, workers):
+    start = time.perf_counter()
+    files = get_files_from_folder(
+        file_cls=BenchmarkFile, folder=folder, recursive=True, workers=workers
+    )
+    return time.perf_counter() - start, files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=100_000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--folder", type=Path, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        folder = args.folder
+        if folder is None:
+            folder = Path(temporary_folder)
+            generate_tree(folder, args.files)
+
+        serial_time, serial_files = measure(folder, workers=None)
+        parallel_time, parallel_files = measure(folder, workers=args.workers)
+
+        assert [file.path for file in serial_files] == [
+            file.path for file in parallel_files
+        ]
+        print(f"files:               {len(serial_files)}")
+        print(f"serial:              {serial_time:.2f}s")
+        print(f"parallel ({args.workers:>2} workers): {parallel_time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
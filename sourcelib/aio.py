@@ -0,0 +1,225 @@
+import asyncio
+import time
+from concurrent.futures import Executor
+from enum import Enum
+from functools import partial
+from pathlib import Path
+from typing import (
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TypeVar,
+    Union,
+)
+
+from sourcelib.associations import Associations
+from sourcelib.collect import iter_files_from_folder, iter_files_from_yaml
+from sourcelib.copy import prepare_destination_folder
+from sourcelib.file import File, FileMode
+from sourcelib.staging import CopyReport, CopyScheduler, get_copy_jobs
+
+T = TypeVar("T")
+
+# Seconds between attempts to get a destination slot of a CopyScheduler.
+SLOT_POLL_INTERVAL = 0.01
+
+
+async def aiterate(
+    iterator_factory: Callable[[], Iterator[T]],
+    batch_size: int = 256,
+    executor: Optional[Executor] = None,
+) -> AsyncIterator[T]:
+    """Iterates a blocking iterator on an executor, so the event loop is not blocked.
+
+    Items are pulled in batches of at most batch_size items per executor call, and the
+    iterator is only advanced when the consumer asks for more items.
+
+    Args:
+        iterator_factory (Callable[[], Iterator[T]]): Creates the blocking iterator.
+        batch_size (int, optional): Maximum number of items per executor call. Defaults to 256.
+        executor (Optional[Executor], optional): The executor. Defaults to None (the loop's default executor).
+
+    Yields:
+        T: The items of the iterator.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = await loop.run_in_executor(executor, iterator_factory)
+    try:
+        while True:
+            batch = await loop.run_in_executor(
+                executor, _next_batch, iterator, batch_size
+            )
+            for item in batch:
+                yield item
+            if len(batch) < batch_size:
+                return
+    finally:
+        if hasattr(iterator, "close"):
+            await loop.run_in_executor(executor, iterator.close)
+
+
+def _next_batch(iterator: Iterator[T], batch_size: int) -> List[T]:
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) == batch_size:
+            break
+    return batch
+
+
+async def aiter_files_from_folder(
+    file_cls: File,
+    folder: Union[str, Path],
+    mode: Enum = FileMode.default,
+    batch_size: int = 256,
+    executor: Optional[Executor] = None,
+    **kwargs,
+) -> AsyncIterator[File]:
+    """Asynchronous version of sourcelib.collect.iter_files_from_folder.
+
+    Args:
+        file_cls (File): The class for the files to be retrieved.
+        folder (Union[str, Path]): The folder from which to retrieve files.
+        mode (Enum, optional): The mode associated with the file, default is FileMode.default.
+        batch_size (int, optional): Maximum number of files scanned per executor call. Defaults to 256.
+        executor (Optional[Executor], optional): The executor. Defaults to None (the loop's default executor).
+        **kwargs: Passed to iter_files_from_folder, e.g., filters, recursive or workers.
+
+    Yields:
+        File: The files retrieved from the folder based on the criteria.
+
+    Examples:
+        >>> async for file in aiter_files_from_folder(ImageFile, "/data", recursive=True):
+        ...     await queue.put(file)
+    """
+    factory = partial(iter_files_from_folder, file_cls, folder, mode, **kwargs)
+    async for file in aiterate(factory, batch_size, executor):
+        yield file
+
+
+async def aiter_files_from_yaml(
+    yaml_source: Union[str, dict],
+    file_cls: File,
+    mode: Enum = FileMode.default,
+    batch_size: int = 256,
+    executor: Optional[Executor] = None,
+    **kwargs,
+) -> AsyncIterator[File]:
+    """Asynchronous version of sourcelib.collect.iter_files_from_yaml.
+
+    Args:
+        yaml_source (Union[str, dict]): The YAML source, either as a path or a dictionary.
+        file_cls (File): The class for the files to be retrieved.
+        mode (Enum, optional): The mode associated with the file, default is FileMode.default.
+        batch_size (int, optional): Maximum number of files read per executor call. Defaults to 256.
+        executor (Optional[Executor], optional): The executor. Defaults to None (the loop's default executor).
+        **kwargs: Passed to iter_files_from_yaml, e.g., filters or excludes.
+
+    Yields:
+        File: The files specified in the YAML source.
+    """
+    factory = partial(iter_files_from_yaml, yaml_source, file_cls, mode, **kwargs)
+    async for file in aiterate(factory, batch_size, executor):
+        yield file
+
+
+async def copy_file(
+    file: File,
+    destination_folder: Path,
+    executor: Optional[Executor] = None,
+    **kwargs,
+) -> None:
+    """Asynchronous version of File.copy.
+
+    Args:
+        file (File): The file to copy.
+        destination_folder (Path): The destination folder.
+        executor (Optional[Executor], optional): The executor. Defaults to None (the loop's default executor).
+        **kwargs: Passed to File.copy, e.g., strategy or verify.
+    """
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(
+        executor, partial(file.copy, destination_folder, **kwargs)
+    )
+
+
+async def copy_files(
+    files: Union[Iterable[File], Associations],
+    destination_folder: Path,
+    concurrency: int = 8,
+    executor: Optional[Executor] = None,
+    strategy: str = "copy",
+    verify: str = "size",
+    scheduler: Optional[CopyScheduler] = None,
+) -> CopyReport:
+    """Asynchronous version of sourcelib.staging.copy_files.
+
+    At most concurrency copies run at once, so a large dataset does not occupy all
+    threads of a shared executor.
+
+    Args:
+        files (Union[Iterable[File], Associations]): The files, or all files of the associations, to copy.
+        destination_folder (Path): The destination folder.
+        concurrency (int, optional): Maximum number of concurrent copies. Defaults to 8.
+        executor (Optional[Executor], optional): The executor. Defaults to None (the loop's default executor).
+        strategy (str, optional): Transfer strategy, see sourcelib.copy.transfer. Defaults to "copy".
+        verify (str, optional): How existing copies are verified, see sourcelib.copy.is_complete. Defaults to "size".
+        scheduler (Optional[CopyScheduler], optional): Orders the jobs and limits their concurrency and bandwidth, see sourcelib.staging.CopyScheduler. Defaults to None.
+
+    Returns:
+        CopyReport: The number of copies, bytes and throughput.
+
+    Examples:
+        >>> report = await copy_files(associations, "/scratch/dataset", concurrency=16)
+    """
+    start_time = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    destination_folder = await loop.run_in_executor(
+        executor, prepare_destination_folder, destination_folder
+    )
+    # scheduling stats the files, so it runs in the executor and not in the loop
+    jobs = iter(
+        await loop.run_in_executor(
+            executor,
+            get_copy_jobs,
+            files,
+            destination_folder,
+            strategy,
+            verify,
+            scheduler,
+        )
+    )
+    slots = None if scheduler is None else scheduler.get_slots(destination_folder)
+    report = CopyReport()
+
+    async def _worker() -> None:
+        for job in jobs:
+            # wait for a slot in the loop, not in a thread of the executor
+            while slots is not None and not slots.acquire(blocking=False):
+                await asyncio.sleep(SLOT_POLL_INTERVAL)
+            try:
+                future = loop.run_in_executor(executor, job)
+                try:
+                    report.add(await asyncio.shield(future))
+                except asyncio.CancelledError:
+                    # a running copy can not be interrupted, so wait until it is done
+                    await asyncio.wait([future])
+                    raise
+            finally:
+                if slots is not None:
+                    slots.release()
+
+    workers = [asyncio.ensure_future(_worker()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        # no copy is started or still running after a failed copy
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    report.seconds = time.perf_counter() - start_time
+    return report
@@ -1,10 +1,15 @@
+import os
 import warnings
 from collections import UserDict
+from itertools import chain, repeat
+from concurrent.futures import Executor, ProcessPoolExecutor
 from pathlib import Path
-from typing import Callable, List, Optional
+from typing import Callable, Iterable, List, Optional, Union
 
 from sourcelib.file import File, ModeMisMatchError
 from sourcelib.associators import stem_file_associater
+from sourcelib.sharding import get_shard_filter
+from sourcelib.table import FileTable
 
 class AssociatedFiles(UserDict):
     """Represents files associated with a key and mode.
@@ -29,52 +34,336 @@ class AssociatedFiles(UserDict):
         if type(file) not in self or file not in self[type(file)]:
             self.setdefault(file.IDENTIFIER, []).append(file)
 
+class _AssociationIndex:
+    """Index over association keys that replaces a linear scan over all keys.
+
+    Exact lookups are a single hash lookup. Substring lookups hash every window
+    of the query whose length equals the length of at least one indexed key,
+    so the cost depends on the length of the query and not on the number of
+    keys. When several keys match, the key that was indexed first wins, which
+    mirrors iterating over the keys in insertion order.
+    """
+
+    def __init__(self):
+        self._order = {}
+        self._lengths = {}
+        self._counter = 0
+
+    def add(self, key) -> None:
+        if key in self._order:
+            return
+        self._order[key] = self._counter
+        self._counter += 1
+        if isinstance(key, str):
+            self._lengths[len(key)] = self._lengths.get(len(key), 0) + 1
+
+    def remove(self, key) -> None:
+        if self._order.pop(key, None) is None:
+            return
+        if isinstance(key, str):
+            self._lengths[len(key)] -= 1
+            if not self._lengths[len(key)]:
+                del self._lengths[len(key)]
+
+    def match(self, association_key, exact_match: bool):
+        if exact_match:
+            return association_key if association_key in self._order else None
+        if not isinstance(association_key, str):
+            return self._scan(association_key)
+
+        best_key, best_order = None, None
+        query_length = len(association_key)
+        for length in self._lengths:
+            if length > query_length:
+                continue
+            for start in range(query_length - length + 1):
+                window = association_key[start : start + length]
+                order = self._order.get(window)
+                if order is not None and (best_order is None or order < best_order):
+                    best_key, best_order = window, order
+        return best_key
+
+    def _scan(self, association_key):
+        for key in self._order:
+            if key in association_key:
+                return key
+        return None
+
+
 class Associations(UserDict):
     """Represents a collection of associated files.
 
+    Keys without a partner (a single file) are not part of the mapping but are kept as
+    pending, and files that match no key are kept as orphans, so add_files can pair
+    them when their partner arrives in a later update.
+
     Examples:
         >>> associations = Associations()
         >>> associations.add_file_key(file_key="key1", mode="mode1")
     """
     def __init__(self):
+        self._index = _AssociationIndex()
+        # unpaired keys, waiting for a partner
+        self._pending = {}
+        self._pending_index = _AssociationIndex()
+        # association key -> files that match no key
+        self._orphans = {}
+        # file -> (file key or None for orphans, association key, whether the file created the key),
+        # by identity, because copies change the paths of files
+        self._locations = {}
+        # path -> file, to find the added file for a new File of the same path
+        self._paths = {}
         super().__init__({})
 
+    def __setitem__(self, file_key, associated_files):
+        if file_key not in self.data:
+            self._index.add(file_key)
+        super().__setitem__(file_key, associated_files)
+
+    def __delitem__(self, file_key):
+        super().__delitem__(file_key)
+        self._index.remove(file_key)
+
+    def copy(self):
+        associations = self.__class__()
+        associations.update(self.data)
+        for file_key, associated_files in self._pending.items():
+            associations._pending[file_key] = associated_files
+            associations._pending_index.add(file_key)
+        associations._orphans = {
+            association_key: list(files) for association_key, files in self._orphans.items()
+        }
+        associations._locations = dict(self._locations)
+        associations._paths = dict(self._paths)
+        return associations
+
+    @property
+    def pending(self) -> dict:
+        """The unpaired keys and their single file, waiting for a partner."""
+        return dict(self._pending)
+
     def add_file_key(self, file_key: str, mode):
+        if file_key in self._pending:
+            self._pending_index.remove(file_key)
+            self[file_key] = self._pending.pop(file_key)
         self.setdefault(file_key, AssociatedFiles(file_key, mode))
 
     def add_file_with_key(self, file_key, file):
         self[file_key].add_file(file)
+        self._set_location(file, (file_key, file_key, True))
+
+    def add_files(self, files1: List[File] = (), files2: List[File] = (),
+                  associator: Callable = stem_file_associater, exact_match=False) -> List[str]:
+        """Adds files incrementally, like associate_files but without a pass over all keys.
+
+        Files of files1 create their association key. A key becomes part of the
+        associations once it has a partner; until then it is pending. Files of files2
+        join the first key they match, or are kept as orphans until a matching key is
+        added. The cost depends on the number of added files (and orphans, for
+        substring matching), not on the size of the associations.
+
+        Args:
+            files1 (List[File]): Files that create association keys.
+            files2 (List[File]): Files that are associated with existing keys.
+            associator (Callable): The function used to determine associations. Defaults to stem_file_associater.
+            exact_match (bool): Flag to determine if exact matches are required. Defaults to False.
+
+        Returns:
+            List[str]: The keys that were pending and got a partner.
+
+        Examples:
+            >>> associations = associate_files(images, annotations)
+            >>> completed = associations.add_files(new_images, new_annotations)
+        """
+        completed = []
+        for file in files1:
+            completed.append(self._add_key_file(file, associator(file), exact_match))
+        for file in files2:
+            completed.append(self._add_partner_file(file, associator(file), exact_match))
+        return [file_key for file_key in completed if file_key is not None]
+
+    def remove_files(self, files: List[File], exact_match=False) -> List[str]:
+        """Removes files that were added before.
+
+        A key that is left with a single file becomes pending again. A key whose files
+        of files1 are all removed is dropped, and its remaining files are associated
+        again (or kept as orphans). Files are found by identity, so they can be removed
+        after they were copied; a new File is matched by the current path of the files.
+
+        Args:
+            files (List[File]): The files to remove.
+            exact_match (bool): Flag to determine if exact matches are required when remaining files are associated again. Defaults to False.
+
+        Returns:
+            List[str]: The keys that lost their partner or were dropped.
+        """
+        changed = []
+        for file in files:
+            file = self._get_known_file(file)
+            location = self._pop_location(file)
+            if location is None:
+                continue
+            file_key, association_key, _ = location
+            if file_key is None:
+                orphans = self._orphans.get(association_key, [])
+                _remove_file(orphans, file)
+                if not orphans:
+                    self._orphans.pop(association_key, None)
+                continue
+
+            associated_files = self.data.get(file_key, self._pending.get(file_key))
+            if associated_files is None:
+                continue
+            _remove_file_from_associated_files(associated_files, file)
+            remaining = [
+                remaining_file
+                for identifier_files in associated_files.values()
+                for remaining_file in identifier_files
+            ]
+            if not any(self._locations.get(f, (None, None, False))[2] for f in remaining):
+                self._drop_key(file_key)
+                for remaining_file in remaining:
+                    _, remaining_key, _ = self._pop_location(remaining_file)
+                    self._add_partner_file(remaining_file, remaining_key, exact_match)
+                changed.append(file_key)
+            elif file_key in self.data and len(remaining) < 2:
+                self._defer_key(file_key)
+                changed.append(file_key)
+        return changed
+
+    def _get_known_file(self, file: File) -> File:
+        """Returns file if it was added, else the added file with the same path (e.g., a new File for a removed path)."""
+        if file in self._locations:
+            return file
+        known = self._paths.get(file.path)
+        if known is None or known not in self._locations or known.path != file.path:
+            return file
+        return known
+
+    def _set_location(self, file: File, location: tuple) -> None:
+        self._locations[file] = location
+        self._paths[file.path] = file
+
+    def _pop_location(self, file: File) -> Optional[tuple]:
+        location = self._locations.pop(file, None)
+        # the path of a copied file changed, its old path is replaced by a later file
+        if location is not None and self._paths.get(file.path) is file:
+            del self._paths[file.path]
+        return location
 
     def add_file(self, file: Path, associater: Callable, exact_match: bool, required: bool):
-        file_key = self._associate(file, associater, exact_match)
-        if file_key is None and not required:
+        self.add_file_with_association_key(file, associater(file), exact_match, required)
+
+    def add_file_with_association_key(self, file: File, association_key, exact_match: bool, required: bool):
+        """Adds a file whose associater result (association_key) was already computed."""
+        if not required:
+            self._add_partner_file(file, association_key, exact_match)
             return
+        file_key = self._index.match(association_key, exact_match)
         self[file_key].add_file(file)
+        self._set_location(file, (file_key, association_key, True))
+
+    def _add_key_file(self, file: File, file_key, exact_match: bool) -> Optional[str]:
+        if file_key in self.data:
+            self.data[file_key].add_file(file)
+            self._set_location(file, (file_key, file_key, True))
+            return None
+
+        adopted = []
+        if file_key not in self._pending:
+            self._pending[file_key] = AssociatedFiles(file_key, file.mode)
+            self._pending_index.add(file_key)
+            adopted = self._pop_orphans(file_key, exact_match)
+
+        self._pending[file_key].add_file(file)
+        self._set_location(file, (file_key, file_key, True))
+        for adopted_file in adopted:
+            association_key = self._locations[adopted_file][1]
+            self._pending[file_key].add_file(adopted_file)
+            self._set_location(adopted_file, (file_key, association_key, False))
+        return self._complete_key(file_key)
+
+    def _add_partner_file(self, file: File, association_key, exact_match: bool) -> Optional[str]:
+        file_key = self._index.match(association_key, exact_match)
+        if file_key is not None:
+            self.data[file_key].add_file(file)
+            self._set_location(file, (file_key, association_key, False))
+            return None
+
+        file_key = self._pending_index.match(association_key, exact_match)
+        if file_key is None:
+            self._orphans.setdefault(association_key, []).append(file)
+            self._set_location(file, (None, association_key, False))
+            return None
+        self._pending[file_key].add_file(file)
+        self._set_location(file, (file_key, association_key, False))
+        return self._complete_key(file_key)
+
+    def _pop_orphans(self, file_key, exact_match: bool) -> List[File]:
+        """Removes and returns the orphans that match a new key."""
+        if exact_match or not isinstance(file_key, str):
+            # only an equal association key matches, a lookup instead of a scan
+            return self._orphans.pop(file_key, [])
+        orphans = []
+        for association_key in list(self._orphans):
+            if _matches(association_key, file_key, exact_match):
+                orphans.extend(self._orphans.pop(association_key))
+        return orphans
+
+    def _complete_key(self, file_key) -> Optional[str]:
+        if _count_files(self._pending[file_key]) < 2:
+            return None
+        self._pending_index.remove(file_key)
+        self[file_key] = self._pending.pop(file_key)
+        return file_key
+
+    def _defer_key(self, file_key) -> None:
+        self._pending[file_key] = self.data[file_key]
+        self._pending_index.add(file_key)
+        del self[file_key]
+
+    def _drop_key(self, file_key) -> None:
+        if file_key in self.data:
+            del self[file_key]
+        else:
+            del self._pending[file_key]
+            self._pending_index.remove(file_key)
 
     def _associate(self, file: Path, associater: Callable, exact_match: bool) -> Optional[str]:
         file_association_key = associater(file)
+        return self._index.match(file_association_key, exact_match)
 
-        for file_key in self:
-            if exact_match:
-                if file_key == file_association_key:
-                    return file_key
-            elif file_key in file_association_key:
-                return file_key
-        return None
-
-def associate_files(files1: List[File], files2: List[File], associations: Optional[Associations] = None, 
-                    associator: Callable = stem_file_associater, exact_match=False) -> Associations:
+def associate_files(files1: List[File], files2: List[File], associations: Optional[Associations] = None,
+                    associator: Callable = stem_file_associater, exact_match=False,
+                    as_table=False, shard_index: Optional[int] = None,
+                    num_shards: Optional[int] = None, workers: Optional[int] = None,
+                    executor: Optional[Executor] = None,
+                    chunksize: Optional[int] = None) -> Union[Associations, FileTable]:
     """Associates two lists of files based on an associator.
 
+    The associator is called once per file. With workers or an executor, the
+    associator is called in parallel, which pays off for CPU-bound associators (e.g.,
+    ones that parse barcodes or read file headers). With workers, a process pool is
+    used, so the associator and the files need to be picklable (e.g., a module level
+    function or class instance, not a lambda). An associator with a flush method
+    (e.g., CachedAssociater) is flushed after every chunk, so the keys computed by
+    its copy in a worker process are not lost.
+
     Args:
         files1 (List[File]): The first list of files to be associated.
         files2 (List[File]): The second list of files to be associated.
         associations (Optional[Associations]): Pre-existing associations. Defaults to None.
         associator (Callable): The function used to determine associations. Defaults to stem_file_associater.
         exact_match (bool): Flag to determine if exact matches are required. Defaults to False.
+        as_table (bool): Return the associated files as a FileTable with the association key in its key column. Defaults to False.
+        shard_index (Optional[int]): Only associate the keys in this shard, see sourcelib.sharding. All files of an association are in the same shard. Defaults to None (all keys).
+        num_shards (Optional[int]): The number of shards. Defaults to None.
+        workers (Optional[int]): Number of processes used to call the associator. Defaults to None (in this process).
+        executor (Optional[Executor]): Executor used to call the associator, instead of a new process pool. Defaults to None.
+        chunksize (Optional[int]): Number of files sent to a worker at once. Defaults to None (about four chunks per worker).
 
     Returns:
-        Associations: The associations formed from the provided files.
+        Union[Associations, FileTable]: The associations formed from the provided files.
 
     Examples:
         >>> files1 = [File("/path/to/image1.jpg"), File("/path/to/image2.jpg")]
@@ -85,26 +374,112 @@ def associate_files(files1: List[File], files2: List[File], associations: Option
     if associations is None:
         associations = Associations()
 
-    for file1 in files1:
-        file_key = associator(file1)
+    files1, files2 = list(files1), list(files2)
+    association_keys = _get_association_keys(
+        files1 + files2, associator, workers, executor, chunksize
+    )
+    in_shard = _get_resolved_shard_filter(
+        chain(associations.keys(), association_keys[:len(files1)]),
+        shard_index, num_shards, exact_match
+    )
+
+    for file1, file_key in zip(files1, association_keys):
+        if in_shard is not None and not in_shard(file_key):
+            continue
         associations.add_file_key(file_key=file_key, mode=file1.mode)
-        associations.add_file(
-            file=file1, associater=associator, exact_match=exact_match, required=True
+        associations.add_file_with_association_key(
+            file=file1, association_key=file_key, exact_match=exact_match, required=True
         )
 
-    for file2 in files2:
-        associations.add_file(
-            file=file2, associater=associator, exact_match=exact_match, required=False
+    for file2, association_key in zip(files2, association_keys[len(files1):]):
+        if in_shard is not None and not in_shard(association_key):
+            continue
+        associations.add_file_with_association_key(
+            file=file2, association_key=association_key, exact_match=exact_match, required=False
         )
 
-    # remove unpaired
-    remove_keys = []
-    for file_key, files in associations.items():
-        if len(list(files.keys())) <= 1 and len(list(dict(files).values())[0]) <= 1:
-            remove_keys.append(file_key)
+    _defer_unpaired_keys(associations)
+    if as_table:
+        return FileTable.from_associations(associations)
+    return associations
+
+
+def _get_resolved_shard_filter(file_keys: Iterable, shard_index: Optional[int],
+                               num_shards: Optional[int], exact_match: bool) -> Optional[Callable]:
+    """Returns a filter of association keys whose file key (among all file_keys) is in the shard.
+
+    Files are sharded by the key they resolve to among all keys, not by their own key,
+    so that every file is in the shard of its association.
+    """
+    in_shard = get_shard_filter(shard_index, num_shards)
+    if in_shard is None:
+        return None
+    all_keys = _AssociationIndex()
+    for file_key in file_keys:
+        all_keys.add(file_key)
+
+    def resolves_in_shard(association_key) -> bool:
+        file_key = all_keys.match(association_key, exact_match)
+        return file_key is not None and in_shard(file_key)
+
+    return resolves_in_shard
+
 
+def _defer_unpaired_keys(associations: Associations) -> None:
+    """Keeps unpaired keys as pending, so Associations.add_files can pair them later."""
+    remove_keys = [
+        file_key for file_key, files in associations.items() if _count_files(files) <= 1
+    ]
     for remove_key in remove_keys:
-        warnings.warn(f"Could not find matching files for key: {remove_key}")
-        del associations[remove_key]
+        warnings.warn(f"Could not find matching files for key: {remove_key}", stacklevel=3)
+        associations._defer_key(remove_key)
 
-    return associations
+
+def _get_association_keys(files: List[File], associator: Callable, workers: Optional[int],
+                          executor: Optional[Executor], chunksize: Optional[int]) -> list:
+    if workers is None and executor is None:
+        return [associator(file) for file in files]
+
+    if chunksize is None:
+        chunksize = max(1, len(files) // ((workers or os.cpu_count() or 1) * 4))
+    chunks = [files[start:start + chunksize] for start in range(0, len(files), chunksize)]
+    if executor is not None:
+        keys = executor.map(_associate_chunk, repeat(associator), chunks)
+        return list(chain.from_iterable(keys))
+    with ProcessPoolExecutor(max_workers=workers) as process_pool:
+        keys = process_pool.map(_associate_chunk, repeat(associator), chunks)
+        return list(chain.from_iterable(keys))
+
+
+def _associate_chunk(associator: Callable, files: List[File]) -> list:
+    association_keys = [associator(file) for file in files]
+    # a worker process gets a copy of the associator (e.g., a CachedAssociater), which
+    # writes its new keys before it is discarded
+    flush = getattr(associator, "flush", None)
+    if flush is not None:
+        flush()
+    return association_keys
+
+
+def _count_files(associated_files: AssociatedFiles) -> int:
+    return sum(len(files) for files in associated_files.values())
+
+
+def _matches(association_key, file_key, exact_match: bool) -> bool:
+    if exact_match or not isinstance(association_key, str):
+        return association_key == file_key
+    return file_key in association_key
+
+
+def _remove_file(files: List[File], file: File) -> None:
+    for index, known_file in enumerate(files):
+        if known_file is file:
+            del files[index]
+            return
+
+
+def _remove_file_from_associated_files(associated_files: AssociatedFiles, file: File) -> None:
+    for identifier, files in list(associated_files.items()):
+        _remove_file(files, file)
+        if not files:
+            del associated_files[identifier]
@@ -1,3 +1,12 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional, Union
+
 from sourcelib.file import File
 
 
@@ -15,7 +24,7 @@ def stem_file_associater(file: File) -> str:
         >>> stem_file_associater(file)
         'image'
     """
-    return file.path.stem
+    return file.stem
 
 
 class AnyOneAssociater:
@@ -49,7 +58,223 @@ class StemSplitterAssociater:
         super().__init__()
 
     def __call__(self, file: File) -> str:
-        association_name = file.path.stem
+        # splitting by every symbol in turn and keeping the first part is the same as
+        # cutting the stem at the first occurrence of any of the symbols
+        association_name = file.stem
+        end = len(association_name)
         for split_symbol in self._split_symbols:
-            association_name = association_name.split(split_symbol)[0]
-        return association_name
+            index = association_name.find(split_symbol, 0, end)
+            if index != -1:
+                end = index
+        return association_name[:end]
+
+
+@dataclass
+class AssociaterCacheStats:
+    """Counts keys served from memory, from the persistent cache, and computed (misses)."""
+
+    memory_hits: int = 0
+    persistent_hits: int = 0
+    misses: int = 0
+
+
+class CachedAssociater:
+    """Wraps an associater and caches its association keys.
+
+    Keys are kept in memory in a least recently used cache, per path. With a
+    cache_folder, keys are also stored in an SQLite database, per path, size, mtime
+    and associater identity, so associating an unchanged dataset again (e.g., in the
+    next run of a pipeline) does not call the associater at all. A file that changed
+    size or mtime is associated again.
+
+    The identity defaults to the qualified name of the associater and the attributes
+    of an associater instance (e.g., the split symbols of StemSplitterAssociater).
+    Pass an identity, such as "barcode-v2", to invalidate the persistent keys when
+    the associater code changes. Lambdas and nested functions or classes do not have
+    a unique qualified name, so they need an identity for a persistent cache.
+
+    Args:
+        associater (Callable): The associater to cache.
+        maxsize (int, optional): Maximum number of keys kept in memory. Defaults to 65536.
+        cache_folder (Optional[Union[str, Path]], optional): Folder of the persistent cache, e.g., sourcelib.scancache.default_cache_folder(). Defaults to None (memory only).
+        identity (Optional[str], optional): Identifies the associater in the persistent cache. Defaults to None (derived from the associater).
+
+    Raises:
+        ValueError: If a persistent cache is used without an identity for a lambda or a nested function or class.
+
+    Examples:
+        >>> associater = CachedAssociater(BarcodeAssociater(), cache_folder=default_cache_folder())
+        >>> associations = associate_files(images, annotations, associator=associater)
+        >>> associater.flush()
+    """
+
+    FILENAME = "associater_cache.sqlite"
+
+    # Number of new persistent keys written at once.
+    FLUSH_SIZE = 1024
+
+    def __init__(
+        self,
+        associater: Callable,
+        maxsize: int = 65536,
+        cache_folder: Optional[Union[str, Path]] = None,
+        identity: Optional[str] = None,
+    ):
+        self._associater = associater
+        self._maxsize = maxsize
+        self._cache_folder = None if cache_folder is None else Path(cache_folder)
+        if identity is None and cache_folder is not None:
+            identity = _get_identity(associater)
+        self._identity = identity
+        self._memory = OrderedDict()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._connection = None
+        self.stats = AssociaterCacheStats()
+
+    def __call__(self, file: File):
+        path = str(file.path)
+        with self._lock:
+            if path in self._memory:
+                self._memory.move_to_end(path)
+                self.stats.memory_hits += 1
+                return self._memory[path]
+
+        if self._cache_folder is None:
+            association_key = self._associater(file)
+            with self._lock:
+                self.stats.misses += 1
+        else:
+            association_key = self._get_persistent(file, path)
+        self._remember(path, association_key)
+        return association_key
+
+    def __getstate__(self) -> dict:
+        # the connection and lock can not be pickled, e.g., for a process pool
+        state = {name: getattr(self, name) for name in vars(self)}
+        state.update(_connection=None, _lock=None, _pending=[], _memory=OrderedDict())
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        vars(self).update(state)
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "CachedAssociater":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @property
+    def path(self) -> Optional[Path]:
+        if self._cache_folder is None:
+            return None
+        return self._cache_folder / self.FILENAME
+
+    def flush(self) -> None:
+        """Writes the new persistent keys."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if pending:
+                connection = self._get_connection()
+                connection.executemany(
+                    "INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?)", pending
+                )
+                connection.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._pending = []
+            if self._cache_folder is not None:
+                connection = self._get_connection()
+                connection.execute(
+                    "DELETE FROM keys WHERE associater = ?", (self._identity,)
+                )
+                connection.commit()
+        self.stats = AssociaterCacheStats()
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _remember(self, path: str, association_key) -> None:
+        with self._lock:
+            self._memory[path] = association_key
+            self._memory.move_to_end(path)
+            while len(self._memory) > self._maxsize:
+                self._memory.popitem(last=False)
+
+    def _get_persistent(self, file: File, path: str):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with self._lock:
+                self.stats.misses += 1
+            return self._associater(file)
+
+        with self._lock:
+            row = (
+                self._get_connection()
+                .execute(
+                    "SELECT size, mtime_ns, key FROM keys "
+                    "WHERE associater = ? AND path = ?",
+                    (self._identity, path),
+                )
+                .fetchone()
+            )
+            if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+                self.stats.persistent_hits += 1
+                return json.loads(row[2])
+            self.stats.misses += 1
+
+        association_key = self._associater(file)
+        with self._lock:
+            self._pending.append(
+                (
+                    self._identity,
+                    path,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    json.dumps(association_key),
+                )
+            )
+            flush = len(self._pending) >= self.FLUSH_SIZE
+        if flush:
+            self.flush()
+        return association_key
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._cache_folder.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(
+                str(self.path), check_same_thread=False, timeout=60
+            )
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS keys (
+                    associater TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    key TEXT NOT NULL,
+                    PRIMARY KEY (associater, path)
+                )
+                """)
+        return self._connection
+
+
+def _get_identity(associater: Callable) -> str:
+    named = associater if hasattr(associater, "__qualname__") else type(associater)
+    if "<lambda>" in named.__qualname__ or "<locals>" in named.__qualname__:
+        # all lambdas of a module, or nested functions of the same name, would share keys
+        raise ValueError(
+            f"Can not derive a unique identity for {named.__qualname__}, "
+            "pass an identity to CachedAssociater"
+        )
+    if named is associater:
+        return f"{associater.__module__}.{associater.__qualname__}"
+    attributes = sorted(getattr(associater, "__dict__", {}).items())
+    return f"{named.__module__}.{named.__qualname__}{attributes!r}"
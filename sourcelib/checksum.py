@@ -0,0 +1,55 @@
+import hashlib
+from pathlib import Path
+from typing import Union
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+CHECKSUM_ALGORITHMS = ("blake2b", "xxhash")
+
+# Large reads keep the number of syscalls (and NFS round trips) low.
+DEFAULT_BLOCK_SIZE = 8 << 20
+
+
+def get_hasher(algorithm: str = "blake2b"):
+    """Creates a hash object.
+
+    Args:
+        algorithm (str, optional): One of CHECKSUM_ALGORITHMS. xxhash requires the optional xxhash package. Defaults to "blake2b".
+
+    Raises:
+        ValueError: If the algorithm is unknown or not installed.
+    """
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    if algorithm == "xxhash":
+        if xxhash is None:
+            raise ValueError("The xxhash checksum requires: pip install xxhash")
+        return xxhash.xxh3_128()
+    raise ValueError(
+        f"Unknown checksum algorithm '{algorithm}', choose from {CHECKSUM_ALGORITHMS}"
+    )
+
+
+def file_checksum(
+    path: Union[str, Path],
+    algorithm: str = "blake2b",
+    block_size: int = DEFAULT_BLOCK_SIZE,
+) -> str:
+    """Computes the checksum of a file, reading it in large blocks.
+
+    Args:
+        path (Union[str, Path]): The file.
+        algorithm (str, optional): One of CHECKSUM_ALGORITHMS. Defaults to "blake2b".
+        block_size (int, optional): Number of bytes per read. Defaults to DEFAULT_BLOCK_SIZE.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    hasher = get_hasher(algorithm)
+    with open(path, "rb", buffering=0) as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
@@ -1,20 +1,26 @@
-from copy import deepcopy
+import os
 from enum import Enum
 from pathlib import Path
-from typing import List, Mapping, Tuple, Union
-import re
-import yaml
-
-from sourcelib.file import File, FileMode
-from sourcelib.associations import Associations
+from itertools import chain
+from typing import Callable, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+import heapq
+
+from sourcelib.file import File, FileMode, get_stem
+from sourcelib.manifest import iter_manifest_entries, load_manifest
+from sourcelib.matcher import PathMatcher
+from sourcelib.associations import AssociatedFiles, Associations
+from sourcelib.associators import stem_file_associater
+from sourcelib.scan import iter_scan_folder
+from sourcelib.scancache import ScanCache
+from sourcelib.sharding import get_shard_filter
+from sourcelib.staging import CopyScheduler, copy_files
+from sourcelib.table import FileTable
 
 
 class NoSourceFilesInFolderError(Exception):
     """Exception raised when no source files are found in a specified folder."""
 
 
-
-
 class NonExistentModeInYamlSource(Exception):
     """Exception raised when a mode doesn't exist in the provided YAML source."""
 
@@ -24,22 +30,23 @@ def _get_yaml_data(source, mode):
     Retrieve data from the source, either directly or from a YAML file.
 
     Args:
-        source (Union[Mapping, str, Path]): The source, which can be a mapping, 
-            a string indicating the path, or a Path object.
+        source (Union[Mapping, str, Path]): The source, which can be a mapping,
+            a string indicating the path, or a Path object. Besides YAML, the path can
+            be a manifest in any of sourcelib.manifest.MANIFEST_FORMATS.
         mode (Enum): The mode to be used for extraction.
 
     Returns:
-        dict: The extracted data.
+        dict: The extracted data. It is shared with the source or the manifest cache
+            (see sourcelib.manifest.load_manifest), so it is only read, never modified.
 
     Raises:
         NonExistentModeInYamlSource: If the mode isn't present in the YAML data.
     """
 
     if isinstance(source, Mapping):
-        data = deepcopy(source)
+        data = source
     if isinstance(source, (str, Path)):
-        with open(source, encoding="utf-8") as file:
-            data = yaml.safe_load(file)
+        data = load_manifest(source)
 
     if mode.name not in data:
         raise NonExistentModeInYamlSource(
@@ -68,23 +75,72 @@ def get_files_from_paths(
         excludes (List[str]): A list of strings based on which files should be excluded.
         regex (str, optional): A regular expression to further filter files.
 
+    The filters, excludes and regex are compiled once into a PathMatcher, which also
+    supports glob and negated (!) patterns, see sourcelib.matcher.
+
     Returns:
         List[File]: A list of files retrieved based on the criteria.
-    """   
+    """
+
+    matcher = PathMatcher(filters, excludes, regex)
+    return _get_files_from_paths(file_cls, mode, paths, matcher, **kwargs)
+
 
+def _get_files_from_paths(
+    file_cls: File,
+    mode: Enum,
+    paths: List[str],
+    matcher: PathMatcher,
+    in_shard: Optional[Callable] = None,
+    stats: Optional[Mapping] = None,
+    **kwargs,
+):
     files = []
-    paths = set(paths)
+    for path in _select_paths(set(paths), matcher):
+        file = file_cls(mode=mode, path=path, **kwargs)
+        if in_shard is None or in_shard(file):
+            _set_stat(file, path, stats)
+            files.append(file)
+    return sorted(files, key=_file_sort_key)
+
+
+def _select_paths(paths: Iterable, matcher: PathMatcher) -> Iterator[str]:
     for path in paths:
         path = str(Path(path).expanduser())
-        if any((exclude in path for exclude in excludes)):
-            continue
-        if filters and not any((filter in path for filter in filters)):
-            continue
-        if regex is not None and not re.search(regex, path):
-            continue
+        if matcher(path):
+            yield path
 
-        files.append(file_cls(mode=mode, path=path, **kwargs))
-    return sorted(files, key=lambda k: k.path)
+
+def _set_stat(file: File, path: str, stats: Optional[Mapping]) -> None:
+    """Caches the stat of path taken during the scan, if there is one."""
+    if stats is not None and path in stats:
+        file.set_stat(stats[path])
+
+
+def _file_sort_key(file: File):
+    return file.path
+
+
+def _sort_within_buffer(
+    files: Iterable[File], sort_buffer: Optional[int]
+) -> Iterator[File]:
+    """Sorts a stream of files with a bounded heap.
+
+    The output is completely sorted when no file arrives more than sort_buffer
+    positions after a file that should come after it; otherwise it is sorted
+    within windows of sort_buffer files. Memory use is bounded by sort_buffer.
+    """
+    if not sort_buffer:
+        yield from files
+        return
+
+    heap = []
+    for counter, file in enumerate(files):
+        heapq.heappush(heap, (_file_sort_key(file), counter, file))
+        if len(heap) > sort_buffer:
+            yield heapq.heappop(heap)[-1]
+    while heap:
+        yield heapq.heappop(heap)[-1]
 
 
 def get_files_from_path(
@@ -105,6 +161,25 @@ def get_files_from_path(
     return get_files_from_paths(file_cls, mode, [path], [], [], None, **kwargs)
 
 
+def _get_path_shard_filter(
+    shard_index: Optional[int],
+    num_shards: Optional[int],
+    shard_key: Callable,
+    file_cls: File,
+    mode: Enum,
+    kwargs: dict,
+) -> Optional[Callable[[str], bool]]:
+    """Returns a filter of paths in the shard, which only creates Files for a custom shard_key."""
+    if shard_key is stem_file_associater:
+        return get_shard_filter(
+            shard_index, num_shards, lambda path: get_stem(os.path.basename(path))
+        )
+    in_shard = get_shard_filter(shard_index, num_shards, shard_key)
+    if in_shard is None:
+        return None
+    return lambda path: in_shard(file_cls(mode=mode, path=path, **kwargs))
+
+
 def get_files_from_folder(
     file_cls: File,
     folder: Union[str, Path],
@@ -113,12 +188,32 @@ def get_files_from_folder(
     excludes: List[str] = (),
     regex=None,
     recursive=False,
+    workers: Optional[int] = None,
+    cache: Optional[ScanCache] = None,
+    as_table: bool = False,
+    shard_index: Optional[int] = None,
+    num_shards: Optional[int] = None,
+    shard_key: Callable = stem_file_associater,
+    with_stat: bool = False,
     **kwargs,
 ):
-    
     """
     Retrieve files from a specified folder based on criteria.
 
+    The folder is walked once, and every entry is matched against all suffixes in
+    file_cls.EXTENSIONS with a single lookup. An entry that ends with several
+    suffixes (e.g., '.tif' and '.ome.tif') is collected once under the longest one.
+
+    With shard_index and num_shards, only the files whose shard_key is in the shard are
+    kept, so every node of a multi-node job keeps its own slice of the folder. Files
+    with the same key (by default the stem, like stem_file_associater) end up in the
+    same shard. Associated files only end up together if they have the same key, i.e.,
+    with exact_match associations and their associator as shard_key. With substring
+    matching (the default of associate_files), "slide_1" and "slide_1_annotation" can
+    land in different shards, so collect all files and shard with
+    associate_files(shard_index=..., num_shards=...) instead. A shard without files is
+    returned empty.
+
     Args:
         file_cls (File): The class for the files to be retrieved.
         folder (Union[str, Path]): The folder from which to retrieve files.
@@ -127,27 +222,133 @@ def get_files_from_folder(
         excludes (List[str], optional): List of strings based on which files should be excluded.
         regex (str, optional): A regular expression to further filter files.
         recursive (bool, optional): Whether to search recursively in the folder.
+        workers (Optional[int], optional): Number of threads used to list subdirectories when searching recursively. Defaults to None (serial).
+        cache (Optional[ScanCache], optional): Persistent cache of directory listings, see sourcelib.scancache. Defaults to None.
+        as_table (bool, optional): Return a FileTable without creating File objects; kwargs can be passed to FileTable.to_files instead. Defaults to False.
+        shard_index (Optional[int], optional): Only return the files of this shard, see sourcelib.sharding. Defaults to None (all files).
+        num_shards (Optional[int], optional): The number of shards. Defaults to None.
+        shard_key (Callable, optional): Returns the shard key of a file. Defaults to stem_file_associater.
+        with_stat (bool, optional): Stat every entry while scanning (on the workers, if any) and cache the size and mtime on the files, or in the size column of the table, see File.size. Defaults to False.
 
     Returns:
-        List[File]: A list of files retrieved from the folder based on the criteria.
+        Union[List[File], FileTable]: The files retrieved from the folder based on the criteria.
     """
 
+    paths = {extension: [] for extension in file_cls.EXTENSIONS}
+    stats = {} if with_stat else None
+    for extension, path, *stat in iter_scan_folder(
+        folder, file_cls.EXTENSIONS, recursive, workers, cache, with_stat
+    ):
+        paths[extension].append(path)
+        if stat:
+            stats[str(Path(path).expanduser())] = stat[0]
+
+    matcher = PathMatcher(filters, excludes, regex)
+    in_shard = get_shard_filter(shard_index, num_shards, shard_key)
+    found = False
+    if as_table:
+        path_in_shard = _get_path_shard_filter(
+            shard_index, num_shards, shard_key, file_cls, mode, kwargs
+        )
+        table = FileTable()
+        for extension in file_cls.EXTENSIONS:
+            selected_paths = set(_select_paths(paths[extension], matcher))
+            found = found or bool(selected_paths)
+            for path in sorted(selected_paths, key=Path):
+                if path_in_shard is None or path_in_shard(path):
+                    stat = stats.get(path) if stats is not None else None
+                    size = -1 if stat is None else stat.st_size
+                    table.append_path(file_cls, mode, path, size=size)
+        if not found:
+            raise NoSourceFilesInFolderError(file_cls, filters, excludes, regex, folder)
+        return table
+
     all_sources = []
-    folder = Path(folder)
     for extension in file_cls.EXTENSIONS:
-        paths = (
-            folder.rglob("*" + extension) if recursive else folder.glob("*" + extension)
-        )
-        sources = get_files_from_paths(
-            file_cls, mode, paths, filters, excludes, regex, **kwargs
+        sources = _get_files_from_paths(
+            file_cls, mode, paths[extension], matcher, in_shard, stats, **kwargs
         )
         all_sources.extend(sources)
 
-    if len(all_sources) == 0:
+    if len(all_sources) == 0 and (
+        in_shard is None
+        or not any(_select_paths(chain.from_iterable(paths.values()), matcher))
+    ):
         raise NoSourceFilesInFolderError(file_cls, filters, excludes, regex, folder)
     return all_sources
 
 
+def iter_files_from_folder(
+    file_cls: File,
+    folder: Union[str, Path],
+    mode: Enum = FileMode.default,
+    filters: List[str] = (),
+    excludes: List[str] = (),
+    regex=None,
+    recursive=False,
+    workers: Optional[int] = None,
+    cache: Optional[ScanCache] = None,
+    sort_buffer: Optional[int] = None,
+    shard_index: Optional[int] = None,
+    num_shards: Optional[int] = None,
+    shard_key: Callable = stem_file_associater,
+    with_stat: bool = False,
+    **kwargs,
+) -> Iterator[File]:
+    """
+    Yield files from a specified folder as they are found.
+
+    Unlike get_files_from_folder, no list of all files is built, so memory use stays
+    flat and the first file is available as soon as it has been scanned.
+
+    Args:
+        file_cls (File): The class for the files to be retrieved.
+        folder (Union[str, Path]): The folder from which to retrieve files.
+        mode (Enum, optional): The mode associated with the file, default is FileMode.default.
+        filters (List[str], optional): List of strings to filter the files.
+        excludes (List[str], optional): List of strings based on which files should be excluded.
+        regex (str, optional): A regular expression to further filter files.
+        recursive (bool, optional): Whether to search recursively in the folder.
+        workers (Optional[int], optional): Number of threads used to list subdirectories when searching recursively. Defaults to None (serial).
+        cache (Optional[ScanCache], optional): Persistent cache of directory listings, see sourcelib.scancache. Defaults to None.
+        sort_buffer (Optional[int], optional): Size of a heap used to sort files by path before they are yielded. Defaults to None (scan order).
+        shard_index (Optional[int], optional): Only return the files of this shard, see sourcelib.sharding. Defaults to None (all files).
+        num_shards (Optional[int], optional): The number of shards. Defaults to None.
+        shard_key (Callable, optional): Returns the shard key of a file, see get_files_from_folder. Defaults to stem_file_associater.
+        with_stat (bool, optional): Cache the size and mtime taken while scanning on the files, see get_files_from_folder. Defaults to False.
+
+    Yields:
+        File: The files retrieved from the folder based on the criteria.
+
+    Raises:
+        NoSourceFilesInFolderError: If the folder does not contain any matching file.
+    """
+
+    in_shard = get_shard_filter(shard_index, num_shards, shard_key)
+    found = False
+
+    def _iter_files():
+        nonlocal found
+        matcher = PathMatcher(filters, excludes, regex)
+        for _, path, *stat in iter_scan_folder(
+            folder, file_cls.EXTENSIONS, recursive, workers, cache, with_stat
+        ):
+            path = str(Path(path).expanduser())
+            if not matcher(path):
+                continue
+            found = True
+            file = file_cls(mode=mode, path=path, **kwargs)
+            if in_shard is None or in_shard(file):
+                if stat:
+                    file.set_stat(stat[0])
+                yield file
+
+    yield from _sort_within_buffer(_iter_files(), sort_buffer)
+
+    if not found:
+        raise NoSourceFilesInFolderError(file_cls, filters, excludes, regex, folder)
+
+
 # YAML_SOURCE_SCHEMA = {"mode": {'file_key': {'path': 'path_to_file', '**kwargs': '**kwargs'}}}
 
 
@@ -158,11 +359,17 @@ def get_files_from_yaml(
     filters=(),
     excludes=(),
     regex=None,
+    shard_index: Optional[int] = None,
+    num_shards: Optional[int] = None,
     **kwargs,
 ):
     """
     Retrieve files specified in a YAML source.
 
+    With shard_index and num_shards, only the entries whose index is in the shard are
+    read, see sourcelib.sharding. The shards of the entries are the same as those of
+    the association keys of get_associations_from_yaml.
+
     Args:
         yaml_source (Union[str, dict]): The YAML source, either as a path or a dictionary.
         file_cls (File): The class for the files to be retrieved.
@@ -170,6 +377,8 @@ def get_files_from_yaml(
         filters (Tuple[str], optional): Tuple of strings to filter the files.
         excludes (Tuple[str], optional): Tuple of strings based on which files should be excluded.
         regex (str, optional): A regular expression to further filter files.
+        shard_index (Optional[int], optional): Only return the files of this shard, see sourcelib.sharding. Defaults to None (all files).
+        num_shards (Optional[int], optional): The number of shards. Defaults to None.
 
     Returns:
         List[File]: A list of files retrieved based on the criteria specified in the YAML.
@@ -179,22 +388,75 @@ def get_files_from_yaml(
     file_identifier = file_cls.IDENTIFIER
 
     paths = []
-    for item in data[mode.name]:
+    for _, item in _select_entries(data[mode.name], shard_index, num_shards):
         if file_identifier in item:
-            paths.append(item[file_identifier].pop("path"))
-            kwargs.update(item[file_identifier])
+            file_kwargs = dict(item[file_identifier])
+            paths.append(file_kwargs.pop("path"))
+            kwargs.update(file_kwargs)
 
     return get_files_from_paths(
         file_cls, mode, paths, filters, excludes, regex, **kwargs
     )
 
 
+def iter_files_from_yaml(
+    yaml_source: Union[str, dict],
+    file_cls: File,
+    mode: Enum = FileMode.default,
+    filters=(),
+    excludes=(),
+    regex=None,
+    sort_buffer: Optional[int] = None,
+    shard_index: Optional[int] = None,
+    num_shards: Optional[int] = None,
+    **kwargs,
+) -> Iterator[File]:
+    """
+    Yield files specified in a YAML source one by one.
+
+    Unlike get_files_from_yaml, each file only receives the keyword arguments of its
+    own entry in the YAML source (on top of the given kwargs). A YAML file is streamed
+    (see sourcelib.manifest.iter_manifest_entries), so the first files are yielded
+    before the whole file is parsed and memory does not grow with its size.
+
+    Args:
+        yaml_source (Union[str, dict]): The YAML source, either as a path or a dictionary.
+        file_cls (File): The class for the files to be retrieved.
+        mode (Enum, optional): The mode associated with the file, default is FileMode.default.
+        filters (Tuple[str], optional): Tuple of strings to filter the files.
+        excludes (Tuple[str], optional): Tuple of strings based on which files should be excluded.
+        regex (str, optional): A regular expression to further filter files.
+        sort_buffer (Optional[int], optional): Size of a heap used to sort files by path before they are yielded. Defaults to None (source order).
+        shard_index (Optional[int], optional): Only return the files of this shard, see sourcelib.sharding. Defaults to None (all files).
+        num_shards (Optional[int], optional): The number of shards. Defaults to None.
+
+    Yields:
+        File: The files specified in the YAML source.
+    """
+
+    file_identifier = file_cls.IDENTIFIER
+
+    def _iter_files():
+        matcher = PathMatcher(filters, excludes, regex)
+        entries = _iter_yaml_entries(yaml_source, mode)
+        for _, item in _select_entries(entries, shard_index, num_shards):
+            if file_identifier not in item:
+                continue
+            file_kwargs = dict(item[file_identifier])
+            path = str(Path(file_kwargs.pop("path")).expanduser())
+            if matcher(path):
+                yield file_cls(mode=mode, path=path, **{**kwargs, **file_kwargs})
+
+    yield from _sort_within_buffer(_iter_files(), sort_buffer)
+
+
 def get_associations_from_yaml(
     yaml_source: Union[str, dict],
     file_classes: List[File],
     mode: Enum = FileMode.default,
+    shard_index: Optional[int] = None,
+    num_shards: Optional[int] = None,
 ):
-    
     """
     Retrieve file associations specified in a YAML source.
 
@@ -202,6 +464,8 @@ def get_associations_from_yaml(
         yaml_source (Union[str, dict]): The YAML source, either as a path or a dictionary.
         file_classes (List[File]): The list of file classes to be retrieved.
         mode (Enum, optional): The mode associated with the file, default is FileMode.default.
+        shard_index (Optional[int], optional): Only return the associations whose key is in this shard, see sourcelib.sharding. Defaults to None (all associations).
+        num_shards (Optional[int], optional): The number of shards. Defaults to None.
 
     Returns:
         Associations: The associations of files retrieved based on the criteria specified in the YAML.
@@ -210,26 +474,88 @@ def get_associations_from_yaml(
     data = _get_yaml_data(yaml_source, mode)
 
     associations = Associations()
-    for file_key, item in enumerate(data[mode.name]):
+    for file_key, item in _select_entries(data[mode.name], shard_index, num_shards):
         file_key = str(file_key)
         associations.add_file_key(file_key=file_key, mode=mode)
-        for _, file_data in file_classes.items():
-            file_cls = file_data["class"]
-            kwargs = file_data["kwargs"] if "kwargs" in file_data else {}
-            file_identifier = file_cls.IDENTIFIER
-            if file_identifier in item:
-                path = item[file_identifier].pop("path")
-                kwargs.update(item[file_identifier])
-                file = file_cls(mode=mode, path=path, **kwargs)
-                associations.add_file_with_key(file_key=file_key, file=file)
+        for file in _get_entry_files(item, file_classes, mode):
+            associations.add_file_with_key(file_key=file_key, file=file)
     return associations
 
 
+def iter_associations_from_yaml(
+    yaml_source: Union[str, dict],
+    file_classes: dict,
+    mode: Enum = FileMode.default,
+    shard_index: Optional[int] = None,
+    num_shards: Optional[int] = None,
+) -> Iterator[Tuple[str, AssociatedFiles]]:
+    """
+    Yield the file associations specified in a YAML source one by one.
+
+    A YAML file is streamed (see sourcelib.manifest.iter_manifest_entries), so the
+    first associations are yielded before the whole file is parsed.
+
+    Args:
+        yaml_source (Union[str, dict]): The YAML source, either as a path or a dictionary.
+        file_classes (dict): The file classes to be retrieved, as in get_associations_from_yaml.
+        mode (Enum, optional): The mode associated with the file, default is FileMode.default.
+        shard_index (Optional[int], optional): Only yield the associations whose key is in this shard, see sourcelib.sharding. Defaults to None (all associations).
+        num_shards (Optional[int], optional): The number of shards. Defaults to None.
+
+    Yields:
+        Tuple[str, AssociatedFiles]: The key and the associated files of every entry.
+    """
+
+    entries = _iter_yaml_entries(yaml_source, mode)
+    for file_key, item in _select_entries(entries, shard_index, num_shards):
+        file_key = str(file_key)
+        associated_files = AssociatedFiles(file_key, mode)
+        for file in _get_entry_files(item, file_classes, mode):
+            associated_files.add_file(file)
+        yield file_key, associated_files
+
+
+def _get_entry_files(item: Mapping, file_classes: dict, mode: Enum) -> Iterator[File]:
+    for _, file_data in file_classes.items():
+        file_cls = file_data["class"]
+        kwargs = file_data["kwargs"] if "kwargs" in file_data else {}
+        file_identifier = file_cls.IDENTIFIER
+        if file_identifier in item:
+            file_kwargs = dict(item[file_identifier])
+            path = file_kwargs.pop("path")
+            yield file_cls(mode=mode, path=path, **{**kwargs, **file_kwargs})
+
+
+def _select_entries(
+    entries: Iterable, shard_index: Optional[int], num_shards: Optional[int]
+) -> Iterator[Tuple[int, Mapping]]:
+    in_shard = get_shard_filter(shard_index, num_shards)
+    for index, item in enumerate(entries):
+        if in_shard is None or in_shard(index):
+            yield index, item
+
+
+def _iter_yaml_entries(source, mode: Enum) -> Iterator:
+    if isinstance(source, Mapping):
+        yield from _get_yaml_data(source, mode)[mode.name]
+        return
+    try:
+        yield from iter_manifest_entries(source, mode.name)
+    except KeyError:
+        raise NonExistentModeInYamlSource(
+            f"mode '{mode.name}' not in: {source}"
+        ) from None
+
+
 def copy_from_yml(
     yaml_source: Union[Path, dict],
     file_cls: File,
     copy_path: Path,
     modes: Tuple[Enum] = (FileMode.default,),
+    workers: Optional[int] = None,
+    strategy: str = "copy",
+    verify: str = "size",
+    scheduler: Optional[CopyScheduler] = None,
     **kwargs,
 ):
     """
@@ -240,8 +566,15 @@ def copy_from_yml(
         file_cls (File): The class for the files to be copied.
         copy_path (Path): The destination path where files should be copied.
         modes (Tuple[Enum], optional): The modes associated with the files, default is (FileMode.default,).
+        workers (Optional[int], optional): Number of concurrent copies, see sourcelib.staging.copy_files. Defaults to None (one by one).
+        strategy (str, optional): Transfer strategy, see sourcelib.copy.transfer. Defaults to "copy".
+        verify (str, optional): How existing copies are verified, see sourcelib.copy.is_complete. Defaults to "size".
+        scheduler (Optional[CopyScheduler], optional): Orders the copies (e.g., smallest first) and limits their concurrency and bandwidth, see sourcelib.staging.CopyScheduler. Defaults to None (in order).
     """
-    
+
+    if isinstance(yaml_source, (str, Path)):
+        yaml_source = load_manifest(yaml_source)
+
     data = []
     for mode in modes:
         data.extend(
@@ -252,5 +585,16 @@ def copy_from_yml(
                 **kwargs,
             )
         )
+    if workers is not None or scheduler is not None:
+        copy_files(
+            data,
+            copy_path,
+            workers=1 if workers is None else workers,
+            strategy=strategy,
+            verify=verify,
+            scheduler=scheduler,
+        )
+        return
+
     for d in data:
-        d.copy(copy_path)
+        d.copy(copy_path, strategy, verify)
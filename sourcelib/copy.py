@@ -1,33 +1,388 @@
+import errno
 import os
+from functools import partial
 from pathlib import Path
-from shutil import copy2, copytree
+from shutil import copy2, copystat, copytree
+from typing import Callable, Optional, Tuple
+
+from sourcelib.checksum import CHECKSUM_ALGORITHMS, file_checksum
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request number of FICLONE (linux/fs.h), used for reflinks on btrfs/xfs
+_FICLONE = 0x40049409
+
+TRANSFER_STRATEGIES = (
+    "auto",
+    "reflink",
+    "hardlink",
+    "symlink",
+    "copy_file_range",
+    "copy",
+)
+
+
+VERIFICATIONS = ("size",) + CHECKSUM_ALGORITHMS
+
+# Copies are written to a temporary name and renamed when they are complete.
+PARTIAL_SUFFIX = ".partial"
+
+# Interrupted byte copies resume at a multiple of this block size.
+RESUME_BLOCK_SIZE = 8 << 20
+
+# Tolerance for the mtime of copies on filesystems with a coarse timestamp resolution.
+_MTIME_TOLERANCE_NS = 2_000_000_000
+
+_LINK_STRATEGIES = ("reflink", "hardlink", "symlink")
 
 
 class NonExistingSourceFileError(Exception):
     ...
 
 
-def copy(source_path: Path, destination_folder: Path) -> Path:
+def copy(
+    source_path: Path,
+    destination_folder: Path,
+    strategy: str = "copy",
+    verify: str = "size",
+) -> Path:
 
     if not source_path.exists():
         raise NonExistingSourceFileError(
             f"Can not copy {source_path} because it does not exists"
         )
 
-    destination_path = _initialize_destination_path(source_path, destination_folder)
+    destination_folder = prepare_destination_folder(destination_folder)
+    destination_path, _ = copy_into(
+        source_path, destination_folder, strategy=strategy, verify=verify
+    )
+    return destination_path
+
+
+def copy_into(
+    source_path: Path,
+    destination_folder: Path,
+    verbose: bool = True,
+    strategy: str = "copy",
+    verify: str = "size",
+    throttle: Optional[Callable[[int], None]] = None,
+) -> Tuple[Path, bool]:
+    """Copies a file or folder into a folder that was prepared with prepare_destination_folder.
+
+    An existing destination file is only reused when it is complete, see is_complete.
+    Otherwise it is copied again.
 
-    if not destination_path.exists():
-        _transfer(source_path, destination_path)
+    Args:
+        source_path (Path): The file or folder to copy.
+        destination_folder (Path): The resolved, existing destination folder.
+        verbose (bool, optional): Whether to print the copy. Defaults to True.
+        strategy (str, optional): One of TRANSFER_STRATEGIES, see transfer. Defaults to "copy".
+        verify (str, optional): One of VERIFICATIONS, see is_complete. Defaults to "size".
+        throttle (Optional[Callable[[int], None]], optional): Limits the bandwidth, see transfer. Defaults to None.
+
+    Returns:
+        Tuple[Path, bool]: The destination path and whether it was transferred (False if it was already complete).
+    """
+    source_path = Path(source_path)
+    if not source_path.exists():
+        raise NonExistingSourceFileError(
+            f"Can not copy {source_path} because it does not exists"
+        )
+
+    destination_path = destination_folder / source_path.name
+    if is_complete(source_path, destination_path, verify):
+        return destination_path, False
+
+    transfer(source_path, destination_path, strategy, throttle)
+    if verbose:
         print(f"| Copied '{source_path}' | To: '{destination_path}'\n.")
-    return destination_path
+    return destination_path, True
 
 
-def _initialize_destination_path(source: Path, destination_folder: Path) -> Path:
+def prepare_destination_folder(destination_folder: Path) -> Path:
     destination_folder = Path(destination_folder).resolve()
     destination_folder.mkdir(parents=True, exist_ok=True)
-    return destination_folder / source.name
+    return destination_folder
+
+
+def is_complete(source: Path, destination_path: Path, verify: str = "size") -> bool:
+    """Checks whether a destination is a complete copy of the source.
+
+    Folders are complete when they exist, because copies of folders are renamed
+    into place only after all their files were copied.
+
+    Args:
+        source (Path): The source file or folder.
+        destination_path (Path): The copy.
+        verify (str, optional): "size" compares size and mtime; "blake2b" or "xxhash" also compare the checksums. Defaults to "size".
+
+    Returns:
+        bool: Whether the destination is complete.
+    """
+    if verify not in VERIFICATIONS:
+        raise ValueError(
+            f"Unknown verification '{verify}', choose from {VERIFICATIONS}"
+        )
+
+    try:
+        destination_stat = os.stat(destination_path)
+    except OSError:
+        return False
+    if os.path.isdir(source):
+        return True
+
+    source_stat = os.stat(source)
+    if destination_stat.st_size != source_stat.st_size:
+        return False
+    if (
+        abs(destination_stat.st_mtime_ns - source_stat.st_mtime_ns)
+        > _MTIME_TOLERANCE_NS
+    ):
+        return False
+    if verify == "size" or os.path.samefile(source, destination_path):
+        return True
+    return file_checksum(source, verify) == file_checksum(destination_path, verify)
+
+
+def transfer(
+    source: Path,
+    destination_path: Path,
+    strategy: str = "copy",
+    throttle: Optional[Callable[[int], None]] = None,
+) -> None:
+    """Transfers a file, or every file of a folder, with the given strategy.
+
+    Strategies:
+        - copy: shutil.copy2.
+        - copy_file_range: in-kernel copy with os.copy_file_range (Linux).
+        - reflink: copy-on-write clone (FICLONE) on filesystems such as btrfs and xfs.
+        - hardlink: os.link, shares the data with the source.
+        - symlink: a symbolic link to the source.
+        - auto: reflink, then copy_file_range, then copy.
+
+    Every strategy falls back to the next one in line, and finally to copy,
+    when it is not supported for the source and destination (e.g., a hardlink
+    or reflink across filesystems). Copies keep the metadata of the source.
+
+    The transfer is written to destination_path + PARTIAL_SUFFIX and renamed
+    to destination_path when it is complete, so an interrupted transfer never
+    leaves an incomplete file under the final name. The next transfer resumes
+    a partial byte copy from its last verified block, and a partial folder
+    copy from its last incomplete file.
+
+    With a throttle, byte copies are done in blocks of RESUME_BLOCK_SIZE, and
+    throttle is called with the size of every block before it is copied (e.g.,
+    sourcelib.staging.TokenBucket.consume, which blocks to limit the bandwidth).
+    Links do not copy data and are not throttled.
+
+    Args:
+        source (Path): The file or folder to transfer.
+        destination_path (Path): The path of the transferred file or folder.
+        strategy (str, optional): One of TRANSFER_STRATEGIES. Defaults to "copy".
+        throttle (Optional[Callable[[int], None]], optional): Called with the number of bytes before they are copied. Defaults to None.
+
+    Raises:
+        ValueError: If the strategy is unknown.
+    """
+    if strategy not in TRANSFER_STRATEGIES:
+        raise ValueError(
+            f"Unknown transfer strategy '{strategy}', choose from {TRANSFER_STRATEGIES}"
+        )
+
+    if not os.path.isdir(source):
+        _transfer_file(str(source), str(destination_path), strategy, throttle)
+        return
+
+    partial_path = str(destination_path) + PARTIAL_SUFFIX
+    if os.path.islink(partial_path):
+        # a symlink left by an interrupted symlink transfer would be copied into
+        os.remove(partial_path)
+    if strategy == "symlink" and not os.path.lexists(partial_path):
+        os.symlink(os.path.abspath(source), partial_path, target_is_directory=True)
+    else:
+        copytree(
+            str(source),
+            partial_path,
+            copy_function=partial(_resume_file, strategy=strategy, throttle=throttle),
+            dirs_exist_ok=True,
+        )
+    os.replace(partial_path, destination_path)
+
+
+def _resume_file(
+    source: str, destination_path: str, strategy: str, throttle: Optional[Callable]
+) -> str:
+    if not is_complete(source, destination_path):
+        _transfer_file(source, destination_path, strategy, throttle)
+    return destination_path
+
+
+def _transfer_file(
+    source: str,
+    destination_path: str,
+    strategy: str,
+    throttle: Optional[Callable] = None,
+) -> str:
+    partial_path = destination_path + PARTIAL_SUFFIX
+    _remove_linked_partial(source, partial_path)
+    for candidate in _FALLBACKS[strategy]:
+        if candidate in _LINK_STRATEGIES:
+            # links are all-or-nothing, a partial byte copy is resumed instead
+            if os.path.lexists(partial_path):
+                continue
+            try:
+                _FILE_TRANSFERS[candidate](source, partial_path)
+                break
+            except OSError:
+                if os.path.lexists(partial_path):
+                    os.remove(partial_path)
+        else:
+            try:
+                _FILE_TRANSFERS[candidate](source, partial_path, throttle)
+                break
+            except OSError:
+                if candidate == "copy":
+                    raise
+    os.replace(partial_path, destination_path)
+    return destination_path
+
+
+def _remove_linked_partial(source: str, partial_path: str) -> None:
+    """Removes a partial file that shares its data with the source.
+
+    An interrupted link strategy can leave a symlink or hardlink to the source as the
+    partial file. Resuming it as a byte copy would truncate and write the source.
+    """
+    try:
+        partial_stat = os.lstat(partial_path)
+    except OSError:
+        return
+    if (
+        os.path.islink(partial_path)
+        or partial_stat.st_nlink > 1
+        or os.path.samefile(source, partial_path)
+    ):
+        os.remove(partial_path)
+
+
+def _reflink(source: str, destination_path: str) -> None:
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflinks are not supported on this platform")
+
+    with open(source, "rb") as source_file, open(
+        destination_path, "xb"
+    ) as destination_file:
+        fcntl.ioctl(destination_file.fileno(), _FICLONE, source_file.fileno())
+    copystat(source, destination_path)
+
+
+def _copy_file_range(
+    source: str, destination_path: str, throttle: Optional[Callable] = None
+) -> None:
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "os.copy_file_range is not available")
+
+    with open(source, "rb") as source_file, _open_resumable(
+        source_file, destination_path
+    ) as destination_file:
+        offset = source_file.tell()
+        remaining = os.fstat(source_file.fileno()).st_size - offset
+        block_size = 1 << 30 if throttle is None else RESUME_BLOCK_SIZE
+        while remaining > 0:
+            if throttle is not None:
+                throttle(min(remaining, block_size))
+            copied = os.copy_file_range(
+                source_file.fileno(),
+                destination_file.fileno(),
+                min(remaining, block_size),
+                offset,
+                offset,
+            )
+            if copied == 0:
+                # e.g., the source was truncated, or the file system returned early
+                raise OSError(
+                    errno.EIO, "copy_file_range stopped before the end of the source"
+                )
+            offset += copied
+            remaining -= copied
+    copystat(source, destination_path)
+
+
+def _hardlink(source: str, destination_path: str) -> None:
+    os.link(source, destination_path)
+
+
+def _symlink(source: str, destination_path: str) -> None:
+    os.symlink(os.path.abspath(source), destination_path)
+
+
+def _copy(
+    source: str, destination_path: str, throttle: Optional[Callable] = None
+) -> None:
+    if throttle is None and (
+        not os.path.exists(destination_path) or not os.path.getsize(destination_path)
+    ):
+        copy2(source, destination_path)
+        return
+
+    with open(source, "rb") as source_file, _open_resumable(
+        source_file, destination_path
+    ) as destination_file:
+        remaining = os.fstat(source_file.fileno()).st_size - source_file.tell()
+        while remaining > 0:
+            if throttle is not None:
+                throttle(min(remaining, RESUME_BLOCK_SIZE))
+            block = source_file.read(RESUME_BLOCK_SIZE)
+            if not block:
+                break
+            destination_file.write(block)
+            remaining -= len(block)
+    copystat(source, destination_path)
+
+
+def _open_resumable(source_file, destination_path: str):
+    """Opens a partial copy and positions both files at the last verified block.
+
+    The partial copy is truncated to a multiple of RESUME_BLOCK_SIZE, and its last
+    block is compared with the source. When it differs, the copy starts over.
+    """
+    destination_file = os.fdopen(
+        os.open(destination_path, os.O_RDWR | os.O_CREAT, 0o644), "r+b"
+    )
+    size = os.fstat(destination_file.fileno()).st_size
+    offset = min(size, os.fstat(source_file.fileno()).st_size)
+    offset -= offset % RESUME_BLOCK_SIZE
+
+    if offset:
+        source_file.seek(offset - RESUME_BLOCK_SIZE)
+        destination_file.seek(offset - RESUME_BLOCK_SIZE)
+        if source_file.read(RESUME_BLOCK_SIZE) != destination_file.read(
+            RESUME_BLOCK_SIZE
+        ):
+            offset = 0
+
+    destination_file.truncate(offset)
+    source_file.seek(offset)
+    destination_file.seek(offset)
+    return destination_file
+
 
+_FILE_TRANSFERS = {
+    "reflink": _reflink,
+    "hardlink": _hardlink,
+    "symlink": _symlink,
+    "copy_file_range": _copy_file_range,
+    "copy": _copy,
+}
 
-def _transfer(source: Path, destination_path: Path) -> None:
-    transfer_function = copytree if os.path.isdir(source) else copy2
-    transfer_function(str(source), str(destination_path))
+_FALLBACKS = {
+    "auto": ("reflink", "copy_file_range", "copy"),
+    "reflink": ("reflink", "copy"),
+    "hardlink": ("hardlink", "copy"),
+    "symlink": ("symlink", "copy"),
+    "copy_file_range": ("copy_file_range", "copy"),
+    "copy": ("copy",),
+}
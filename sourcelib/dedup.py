@@ -0,0 +1,182 @@
+import os
+import stat
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List
+
+from sourcelib.associations import Associations
+from sourcelib.checksum import file_checksum, get_hasher
+from sourcelib.file import File
+from sourcelib.staging import get_files
+
+# Bytes hashed at the start and at the end of a file before it is hashed completely.
+PARTIAL_SIZE = 1 << 20
+
+
+def find_duplicates(
+    files: Iterable[File],
+    algorithm: str = "blake2b",
+    workers: int = 8,
+    partial_size: int = PARTIAL_SIZE,
+) -> List[List[File]]:
+    """Finds groups of files with the same content.
+
+    Files are compared in stages, and each stage only looks at the files that are
+    still candidates: first the sizes, then hard links to the same inode (which are
+    duplicates without reading them), then a hash of the first and last partial_size
+    bytes, and only then a hash of the whole file. Most files have a unique size or
+    partial hash, so they are never read completely. Hashes are computed in parallel,
+    with large reads (see sourcelib.checksum).
+
+    Args:
+        files (Iterable[File]): The files to compare.
+        algorithm (str, optional): One of sourcelib.checksum.CHECKSUM_ALGORITHMS. Defaults to "blake2b".
+        workers (int, optional): Number of files hashed at once. Defaults to 8.
+        partial_size (int, optional): Bytes hashed at the start and end of a file in the partial stage. Defaults to PARTIAL_SIZE.
+
+    Returns:
+        List[List[File]]: Groups of two or more duplicates, in the order of files.
+
+    Examples:
+        >>> for original, *duplicates in find_duplicates(files):
+        ...     print(original.path, [duplicate.path for duplicate in duplicates])
+    """
+    sizes: Dict[int, Dict[tuple, List[File]]] = {}
+    order = {}
+    for index, file in enumerate(files):
+        order[id(file)] = index
+        try:
+            file_stat = os.stat(file.path)
+        except OSError:
+            continue
+        if not stat.S_ISREG(file_stat.st_mode):
+            continue
+        inodes = sizes.setdefault(file_stat.st_size, {})
+        inodes.setdefault((file_stat.st_dev, file_stat.st_ino), []).append(file)
+
+    # a candidate is a group of inodes (each a list of hard linked files) of one size
+    duplicates = []
+    candidates = []
+    for size, inodes in sizes.items():
+        if len(inodes) > 1:
+            candidates.append((size, list(inodes.values())))
+        else:
+            duplicates.extend(group for group in inodes.values() if len(group) > 1)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        candidates = _split_candidates(
+            candidates,
+            lambda size, path: _partial_checksum(path, size, algorithm, partial_size),
+            executor,
+        )
+        # files of at most twice the partial size were hashed completely, and hard
+        # links of a single inode do not need to be compared
+        done, large = [], []
+        for candidate in candidates:
+            size, inode_groups = candidate
+            if size <= 2 * partial_size or len(inode_groups) == 1:
+                done.append(candidate)
+            else:
+                large.append(candidate)
+        large = _split_candidates(
+            large, lambda size, path: file_checksum(path, algorithm), executor
+        )
+
+    for _, inode_groups in done + large:
+        duplicates.append([file for group in inode_groups for file in group])
+    for group in duplicates:
+        group.sort(key=lambda file: order[id(file)])
+    duplicates.sort(key=lambda group: order[id(group[0])])
+    return duplicates
+
+
+def deduplicate(files: Iterable[File], collapse: bool = False, **kwargs) -> List[File]:
+    """Marks every duplicate file with the file it duplicates, see File.duplicate_of.
+
+    The first file of every group of duplicates is kept as the original. File.copy
+    hardlinks a duplicate to the copy of its original instead of copying it again.
+
+    Args:
+        files (Iterable[File]): The files.
+        collapse (bool, optional): Leave the duplicates out of the returned files. Defaults to False.
+        **kwargs: Passed to find_duplicates, e.g., workers.
+
+    Returns:
+        List[File]: The files, without duplicates if collapse.
+    """
+    files = list(files)
+    duplicate_ids = set()
+    for original, *duplicates in find_duplicates(files, **kwargs):
+        for duplicate in duplicates:
+            duplicate.duplicate_of = original
+            duplicate_ids.add(id(duplicate))
+    if collapse:
+        return [file for file in files if id(file) not in duplicate_ids]
+    return files
+
+
+def deduplicate_associations(
+    associations: Associations, collapse: bool = False, **kwargs
+) -> Associations:
+    """Marks the duplicate files in associations, see deduplicate.
+
+    Args:
+        associations (Associations): The associations, which are updated in place.
+        collapse (bool, optional): Remove associations whose files are all duplicates of the files of an earlier association (e.g., the same slide and annotation under another name). Defaults to False.
+        **kwargs: Passed to find_duplicates, e.g., workers.
+
+    Returns:
+        Associations: The associations.
+    """
+    deduplicate(get_files(associations), **kwargs)
+    if not collapse:
+        return associations
+
+    signatures = set()
+    for file_key, associated_files in list(associations.items()):
+        signature = frozenset(
+            (identifier, id(file.duplicate_of or file))
+            for identifier, identifier_files in associated_files.items()
+            for file in identifier_files
+        )
+        if signature in signatures:
+            del associations[file_key]
+        signatures.add(signature)
+    return associations
+
+
+def _partial_checksum(path, size: int, algorithm: str, partial_size: int) -> str:
+    hasher = get_hasher(algorithm)
+    with open(path, "rb", buffering=0) as file:
+        hasher.update(file.read(partial_size))
+        if size > partial_size:
+            file.seek(max(partial_size, size - partial_size))
+            hasher.update(file.read(partial_size))
+    return hasher.hexdigest()
+
+
+def _split_candidates(
+    candidates: List[tuple], hasher: Callable, executor: Executor
+) -> List[tuple]:
+    """Splits every candidate by the hash of its inodes, keeping groups of two or more files."""
+    jobs = [
+        (index, size, inode_group)
+        for index, (size, inode_groups) in enumerate(candidates)
+        for inode_group in inode_groups
+    ]
+    hashes = executor.map(lambda job: _hash_or_none(hasher, job[1], job[2][0]), jobs)
+    groups: Dict[tuple, tuple] = {}
+    for (index, size, inode_group), file_hash in zip(jobs, hashes):
+        if file_hash is not None:
+            groups.setdefault((index, file_hash), (size, []))[1].append(inode_group)
+    return [
+        (size, inode_groups)
+        for size, inode_groups in groups.values()
+        if sum(len(inode_group) for inode_group in inode_groups) > 1
+    ]
+
+
+def _hash_or_none(hasher: Callable, size: int, file: File):
+    try:
+        return hasher(size, file.path)
+    except OSError:
+        return None
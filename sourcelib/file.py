@@ -1,10 +1,16 @@
-from copy import copy
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
+import errno
 import os
+import sys
 from pathlib import Path
+from typing import Callable, Iterable, List, NamedTuple, Optional
 
 from sourcelib.copy import copy as copy_source
+from sourcelib.copy import copy_into as copy_source_into
+from sourcelib.copy import is_complete, transfer
 from sourcelib.extension import Extension, get_extension_constant_mapping
+from sourcelib.scan import get_suffix_lengths, match_suffix
 
 
 class ModeMisMatchError(Exception):
@@ -15,7 +21,41 @@ class FileMode(Enum):
     default = auto()
 
 
+class FileMetadata(NamedTuple):
+    """The size and modification time of a file, as cached by File."""
+
+    size: int
+    mtime_ns: int
+
+
+# cached for a file that does not exist
+_MISSING = FileMetadata(-1, -1)
+
+
 class File:
+    """A file with a mode and an extension.
+
+    Files are slotted and keep their path as an interned folder string, which is shared
+    by all files in the same folder, plus a name. The Path object is created on access.
+
+    The size, modification time and existence of the file are stat'ed once and cached,
+    so repeated access (e.g., filtering or sorting by size) costs no system calls. The
+    cache is filled on first access, by collection with with_stat, or in bulk by
+    prefetch_metadata, and is only updated by refresh() or when the file is copied.
+
+    Subclasses that do not define __slots__ get an instance __dict__ back; classes made
+    with generate_file_class stay slotted.
+    """
+
+    __slots__ = (
+        "_mode",
+        "_folder",
+        "_name",
+        "_extension",
+        "_duplicate_of",
+        "_metadata",
+    )
+
     EXTENSIONS: dict = {}
     IDENTIFIER: str = "file"
 
@@ -25,9 +65,10 @@ class File:
         mode: Enum = FileMode.default,
     ):
         self._mode = mode
-        self._path = Path(path).absolute()
-        self._original_path = copy(self._path)
-        self._extension = self._get_extension(self._path)
+        path = Path(path).absolute()
+        self._set_path(path)
+        self._extension = self._get_extension(path)
+        self._duplicate_of = None
 
     @property
     def mode(self) -> Enum:
@@ -35,29 +76,219 @@ class File:
 
     @property
     def path(self) -> Path:
-        return self._path
+        return Path(self._folder, self._name)
 
     @property
     def original_path(self) -> Path:
-        return self._path
+        return self.path
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def stem(self) -> str:
+        """The name without its last suffix, like Path.stem, without creating a Path."""
+        return get_stem(self._name)
+
+    def _set_path(self, path: Path) -> None:
+        self._folder = sys.intern(str(path.parent))
+        self._name = path.name
+        self._metadata = None
+
+    @property
+    def duplicate_of(self) -> Optional["File"]:
+        """The file with the same content that is kept, if this file is a duplicate (see sourcelib.dedup)."""
+        return self._duplicate_of
+
+    @duplicate_of.setter
+    def duplicate_of(self, file: Optional["File"]) -> None:
+        self._duplicate_of = file
 
     @property
     def exists(self) -> bool:
-        return self.path.exists()
+        """Whether the file existed when it was stat'ed."""
+        return self._get_metadata() is not _MISSING
+
+    @property
+    def size(self) -> int:
+        """The size in bytes.
+
+        Raises:
+            FileNotFoundError: If the file does not exist.
+        """
+        return self._get_existing_metadata().size
+
+    @property
+    def mtime_ns(self) -> int:
+        """The modification time in nanoseconds since the epoch, like os.stat_result.st_mtime_ns."""
+        return self._get_existing_metadata().mtime_ns
+
+    @property
+    def mtime(self) -> float:
+        """The modification time in seconds since the epoch, like os.stat_result.st_mtime."""
+        return self._get_existing_metadata().mtime_ns / 1e9
+
+    @property
+    def is_known(self) -> bool:
+        """Whether the file was stat'ed, i.e., exists is known without stat'ing it."""
+        return self._metadata is not None
+
+    @property
+    def metadata(self) -> Optional[FileMetadata]:
+        """The cached metadata without stat'ing the file: None if unknown (see is_known) or if the file does not exist."""
+        metadata = self._metadata
+        return None if metadata is _MISSING else metadata
+
+    def set_stat(self, stat: Optional[os.stat_result]) -> None:
+        """Caches the metadata of an os.stat_result (e.g., from os.DirEntry.stat), or None if the file does not exist."""
+        if stat is None:
+            self._metadata = _MISSING
+        else:
+            self._metadata = FileMetadata(stat.st_size, stat.st_mtime_ns)
+
+    def refresh(self) -> bool:
+        """Stats the file again.
+
+        Returns:
+            bool: Whether the file exists.
+        """
+        try:
+            self.set_stat(os.stat(os.path.join(self._folder, self._name)))
+        except OSError:
+            self.set_stat(None)
+        return self._metadata is not _MISSING
+
+    def _get_metadata(self) -> FileMetadata:
+        if self._metadata is None:
+            self.refresh()
+        return self._metadata
+
+    def _get_existing_metadata(self) -> FileMetadata:
+        metadata = self._get_metadata()
+        if metadata is _MISSING:
+            raise FileNotFoundError(
+                errno.ENOENT, os.strerror(errno.ENOENT), str(self.path)
+            )
+        return metadata
 
     def _get_extension(self, path: Path) -> Extension:
-        return self.EXTENSIONS[path.suffix]
+        suffix = match_suffix(
+            path.name, self.EXTENSIONS, get_suffix_lengths(self.EXTENSIONS)
+        )
+        return self.EXTENSIONS[path.suffix if suffix is None else suffix]
+
+    @property
+    def folder_coupled_path(self) -> Optional[Path]:
+        if self._extension.folder_coupled is None:
+            return None
+        return self._extension.folder_coupled(self.path)
+
+    def copy(
+        self,
+        destination_folder: Path,
+        strategy: str = "copy",
+        verify: str = "size",
+        cache=None,
+    ) -> None:
+        """Copies the file (and its folder coupled companion) into destination_folder.
 
-    def copy(self, destination_folder: Path) -> None:
-        if self._extension.folder_coupled is not None:
-            copy_source(self._extension.folder_coupled(self._path), destination_folder)
-        self._path = copy_source(self._path, destination_folder)
+        A duplicate whose original was already copied into the same folder is hardlinked
+        to that copy instead of being copied again (its companion is still copied). With a cache (see
+        sourcelib.stagingcache.StagingCache), the file is copied into the cache once
+        and linked from there into destination_folder.
+        """
+        if cache is not None:
+            if self.folder_coupled_path is not None:
+                cache.copy(
+                    self.folder_coupled_path, destination_folder, strategy, verify
+                )
+            self._set_path(cache.copy(self.path, destination_folder, strategy, verify))
+            return
+        if self.folder_coupled_path is not None:
+            copy_source(self.folder_coupled_path, destination_folder, strategy, verify)
+        if self._link_duplicate(destination_folder, verify):
+            return
+        self._set_path(copy_source(self.path, destination_folder, strategy, verify))
+
+    def _link_duplicate(self, destination_folder: Path, verify: str) -> bool:
+        original = self._duplicate_of
+        if original is None:
+            return False
+        destination_folder = Path(destination_folder).resolve()
+        original_copy = original.path
+        if original_copy.parent != destination_folder or not original_copy.exists():
+            return False
+        destination_path = destination_folder / self._name
+        if not is_complete(self.path, destination_path, verify):
+            transfer(original_copy, destination_path, "hardlink")
+        self._set_path(destination_path)
+        return True
+
+    def copy_into(
+        self,
+        destination_folder: Path,
+        verbose: bool = True,
+        strategy: str = "copy",
+        verify: str = "size",
+        throttle: Optional[Callable[[int], None]] = None,
+    ) -> bool:
+        """Copies the file, without its folder coupled companion, into a folder prepared with sourcelib.copy.prepare_destination_folder.
+
+        Returns:
+            bool: Whether the file was transferred (False if it already existed).
+        """
+        path, transferred = copy_source_into(
+            self.path, destination_folder, verbose, strategy, verify, throttle
+        )
+        self._set_path(path)
+        return transferred
 
     def __str__(self) -> str:
-        return f"Mode: {str(self._mode)} | Path:  {str(self._path)}"
+        return f"Mode: {str(self._mode)} | Path:  {str(self.path)}"
 
     def __repr__(self):
-        return f"File(path={str(self._path)}, mode={str(self._mode)}"
+        return f"File(path={str(self.path)}, mode={str(self._mode)}"
+
+
+def get_stem(name: str) -> str:
+    """Returns a file name without its last suffix, like Path.stem, without creating a Path."""
+    index = name.rfind(".")
+    if 0 < index < len(name) - 1:
+        return name[:index]
+    return name
+
+
+def prefetch_metadata(
+    files: Iterable[File], workers: int = 8, refresh: bool = False
+) -> List[File]:
+    """Stats many files at once, so their size, mtime and exists are cached.
+
+    On a network file system every stat is a round trip, so stat'ing in parallel
+    threads is much faster than stat'ing one file after another on first access.
+
+    Args:
+        files (Iterable[File]): The files.
+        workers (int, optional): Number of files stat'ed at once. Defaults to 8.
+        refresh (bool, optional): Also stat the files whose metadata is already cached. Defaults to False.
+
+    Returns:
+        List[File]: The files.
+
+    Examples:
+        >>> files = prefetch_metadata(get_files_from_folder(File, folder), workers=32)
+        >>> large_files = [file for file in files if file.exists and file.size > 1 << 30]
+    """
+    files = list(files)
+    stale = [file for file in files if refresh or not file.is_known]
+    if workers <= 1 or len(stale) <= 1:
+        for file in stale:
+            file.refresh()
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(File.refresh, stale):
+                pass
+    return files
 
 
 def generate_default_file_class(file, globs):
@@ -69,5 +300,9 @@ def generate_file_class(file, extension_mapping):
     return type(
         filename.capitalize() + File.__name__,
         (File,),
-        {"EXTENSIONS": extension_mapping, "IDENTIFIER": filename.lower()},
+        {
+            "__slots__": (),
+            "EXTENSIONS": extension_mapping,
+            "IDENTIFIER": filename.lower(),
+        },
     )
@@ -0,0 +1,551 @@
+import json
+import os
+import pickle
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Mapping, Optional, Tuple, Union
+
+import yaml
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# The libyaml bindings parse an order of magnitude faster than the pure Python loader.
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+SIDECAR_SUFFIX = ".pickle"
+
+# Number of parsed manifests kept in memory.
+MANIFEST_CACHE_SIZE = 8
+
+_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def load_manifest(
+    path: Union[str, Path], use_cache: bool = True, sidecar: bool = False
+) -> dict:
+    """Loads a manifest, reusing earlier parses of the same, unchanged file.
+
+    The format is chosen by the suffix of the path, see MANIFEST_FORMATS.
+
+    Parsed manifests are cached in memory by path and are parsed again when the size or
+    mtime of the file changed. The returned data is shared between callers and should
+    not be modified.
+
+    With sidecar, the parsed manifest is also pickled next to the manifest (e.g.,
+    data.yml.pickle), so a new process loads it without parsing it. The sidecar is
+    ignored when it does not match the size and mtime of the manifest. Only enable it
+    for folders you trust, as unpickling can execute code.
+
+    Args:
+        path (Union[str, Path]): The manifest.
+        use_cache (bool, optional): Whether to use the in-memory cache. Defaults to True.
+        sidecar (bool, optional): Whether to read and write a pickled sidecar. Defaults to False.
+
+    Returns:
+        dict: The parsed manifest.
+
+    Examples:
+        >>> data = load_manifest("/data/manifest.yml", sidecar=True)
+        >>> files = get_files_from_yaml(data, ImageFile, mode=FileMode.training)
+    """
+    path = os.path.abspath(os.path.expanduser(str(path)))
+    manifest_format = get_manifest_format(path)
+    stat = os.stat(path)
+    version = (stat.st_size, stat.st_mtime_ns)
+
+    if use_cache:
+        with _cache_lock:
+            cached = _cache.get(path)
+            if cached is not None and cached[0] == version:
+                _cache.move_to_end(path)
+                return cached[1]
+
+    data = _read_sidecar(path, version) if sidecar else None
+    if data is None:
+        data = manifest_format.load(path)
+        if sidecar:
+            _write_sidecar(path, version, data)
+
+    if use_cache:
+        with _cache_lock:
+            _cache[path] = (version, data)
+            _cache.move_to_end(path)
+            while len(_cache) > MANIFEST_CACHE_SIZE:
+                _cache.popitem(last=False)
+    return data
+
+
+def clear_manifest_cache() -> None:
+    with _cache_lock:
+        _cache.clear()
+
+
+def _read_sidecar(path: str, version: tuple):
+    try:
+        with open(path + SIDECAR_SUFFIX, "rb") as file:
+            sidecar_version, data = pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return None
+    return data if sidecar_version == version else None
+
+
+def _write_sidecar(path: str, version: tuple, data) -> None:
+    partial_path = f"{path}{SIDECAR_SUFFIX}.{os.getpid()}.partial"
+    try:
+        with open(partial_path, "wb") as file:
+            pickle.dump((version, data), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(partial_path, path + SIDECAR_SUFFIX)
+    except OSError:
+        # a read-only dataset folder should not break loading
+        try:
+            os.remove(partial_path)
+        except OSError:
+            pass
+
+
+def iter_manifest_entries(
+    path: Union[str, Path], mode_name: str, seek: bool = True
+) -> Iterator:
+    """Yields the entries under a mode of a manifest one by one.
+
+    Only one entry is built at a time, so memory does not grow with the size of the
+    manifest. A YAML manifest is parsed as a stream of YAML events. With seek, parsing
+    starts at the line of the mode key (e.g., 'training:') instead of at the start of
+    the file, so the other modes are not parsed at all. When that does not work (e.g.,
+    the entries refer to an anchor defined before the mode) the manifest is parsed
+    from the start instead.
+
+    Args:
+        path (Union[str, Path]): The manifest, in one of the MANIFEST_FORMATS.
+        mode_name (str): The top level key of the entries, e.g., FileMode.training.name.
+        seek (bool, optional): Whether to start parsing a YAML manifest at the mode key. Defaults to True.
+
+    Raises:
+        KeyError: If the mode is not a top level key of the manifest.
+
+    Yields:
+        The entries under the mode, e.g., dicts of file identifiers and file data.
+
+    Examples:
+        >>> for entry in iter_manifest_entries("/data/manifest.yml", "training"):
+        ...     print(entry["image"]["path"])
+    """
+    path = os.path.expanduser(str(path))
+    manifest_format = get_manifest_format(path)
+    if not isinstance(manifest_format, YamlManifest):
+        yield from manifest_format.iter_entries(path, mode_name)
+        return
+
+    offset = _find_mode_offset(path, mode_name) if seek else None
+    yielded = 0
+    if offset is not None:
+        try:
+            for entry in _iter_entries(path, mode_name, offset):
+                yield entry
+                yielded += 1
+            return
+        except (yaml.YAMLError, KeyError):
+            pass
+
+    for index, entry in enumerate(_iter_entries(path, mode_name, 0)):
+        if index >= yielded:
+            yield entry
+
+
+def _find_mode_offset(path: str, mode_name: str) -> Optional[int]:
+    keys = tuple(
+        f"{quote}{mode_name}{quote}:".encode("utf-8") for quote in ("", '"', "'")
+    )
+    offset = 0
+    with open(path, "rb") as file:
+        for line in file:
+            if line.startswith(keys):
+                key_length = next(len(key) for key in keys if line.startswith(key))
+                if line[key_length : key_length + 1] in (b"", b" ", b"\t", b"\r", b"\n"):
+                    return offset
+            offset += len(line)
+    return None
+
+
+def _iter_entries(path: str, mode_name: str, offset: int) -> Iterator:
+    with open(path, "rb") as file:
+        file.seek(offset)
+        loader = YAML_LOADER(file)
+        try:
+            yield from _iter_mode_entries(loader, mode_name)
+        finally:
+            loader.dispose()
+
+
+def _iter_mode_entries(loader, mode_name: str) -> Iterator:
+    anchors = {}
+    loader.get_event()
+    if not loader.check_event(yaml.DocumentStartEvent):
+        raise KeyError(mode_name)
+    loader.get_event()
+    if not loader.check_event(yaml.MappingStartEvent):
+        raise KeyError(mode_name)
+    loader.get_event()
+
+    while not loader.check_event(yaml.MappingEndEvent):
+        key = loader.peek_event()
+        if not (isinstance(key, yaml.ScalarEvent) and key.value == mode_name):
+            _skip(loader, anchors)
+            _skip(loader, anchors)
+            continue
+
+        loader.get_event()
+        if loader.check_event(yaml.SequenceStartEvent):
+            loader.get_event()
+            while not loader.check_event(yaml.SequenceEndEvent):
+                yield loader.construct_document(_compose(loader, anchors))
+        else:
+            entries = loader.construct_document(_compose(loader, anchors))
+            yield from entries or ()
+        return
+    raise KeyError(mode_name)
+
+
+def _skip(loader, anchors: dict) -> None:
+    """Consumes a node without building it, unless it defines an anchor."""
+    event = loader.peek_event()
+    if getattr(event, "anchor", None) is not None and not isinstance(
+        event, yaml.AliasEvent
+    ):
+        _compose(loader, anchors)
+        return
+    loader.get_event()
+    if isinstance(event, yaml.SequenceStartEvent):
+        while not loader.check_event(yaml.SequenceEndEvent):
+            _skip(loader, anchors)
+        loader.get_event()
+    elif isinstance(event, yaml.MappingStartEvent):
+        while not loader.check_event(yaml.MappingEndEvent):
+            _skip(loader, anchors)
+        loader.get_event()
+
+
+def _compose(loader, anchors: dict) -> yaml.Node:
+    """Builds the node of the next events, like yaml.composer.Composer.compose_node."""
+    event = loader.get_event()
+    if isinstance(event, yaml.AliasEvent):
+        if event.anchor not in anchors:
+            raise yaml.composer.ComposerError(
+                None, None, f"found undefined alias {event.anchor!r}", event.start_mark
+            )
+        return anchors[event.anchor]
+
+    if isinstance(event, yaml.ScalarEvent):
+        tag = _resolve(loader, yaml.ScalarNode, event.tag, event.value, event.implicit)
+        node = yaml.ScalarNode(
+            tag, event.value, event.start_mark, event.end_mark, style=event.style
+        )
+    elif isinstance(event, yaml.SequenceStartEvent):
+        tag = _resolve(loader, yaml.SequenceNode, event.tag, None, event.implicit)
+        node = yaml.SequenceNode(
+            tag, [], event.start_mark, None, flow_style=event.flow_style
+        )
+    else:
+        tag = _resolve(loader, yaml.MappingNode, event.tag, None, event.implicit)
+        node = yaml.MappingNode(
+            tag, [], event.start_mark, None, flow_style=event.flow_style
+        )
+
+    if event.anchor is not None:
+        anchors[event.anchor] = node
+    if isinstance(node, yaml.SequenceNode):
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node.value.append(_compose(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+    elif isinstance(node, yaml.MappingNode):
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _compose(loader, anchors)
+            node.value.append((key, _compose(loader, anchors)))
+        node.end_mark = loader.get_event().end_mark
+    return node
+
+
+def _resolve(loader, kind, tag, value, implicit):
+    if tag is None or tag == "!":
+        return loader.resolve(kind, value, implicit)
+    return tag
+
+
+class ManifestFormat(ABC):
+    """Reads and writes manifests with the schema {mode: [{identifier: {path, **kwargs}}]}.
+
+    Formats implement iter_records and write; load and iter_entries are built on
+    iter_records.
+    """
+
+    def load(self, path: str) -> dict:
+        """Returns all modes and their entries."""
+        data = {}
+        for mode_name, entry in self.iter_records(path):
+            entries = data.setdefault(mode_name, [])
+            if entry is not None:
+                entries.append(entry)
+        return data
+
+    def iter_entries(self, path: str, mode_name: str) -> Iterator:
+        """Yields the entries of a mode, raises KeyError if the mode does not exist."""
+        found = False
+        for record_mode_name, entry in self.iter_records(path, mode_name):
+            if record_mode_name != mode_name:
+                continue
+            found = True
+            if entry is not None:
+                yield entry
+        if not found:
+            raise KeyError(mode_name)
+
+    @abstractmethod
+    def iter_records(
+        self, path: str, mode_name: Optional[str] = None
+    ) -> Iterator[Tuple]:
+        """Yields (mode name, entry) records; entry None declares an empty mode."""
+
+    @abstractmethod
+    def write(self, path: str, data: Mapping[str, Iterable]) -> None:
+        """Writes the entries per mode name to path."""
+
+
+class YamlManifest(ManifestFormat):
+    def load(self, path: str) -> dict:
+        with open(path, encoding="utf-8") as file:
+            return yaml.load(file, Loader=YAML_LOADER)
+
+    def iter_records(
+        self, path: str, mode_name: Optional[str] = None
+    ) -> Iterator[Tuple]:
+        for record_mode_name, entries in self.load(path).items():
+            if mode_name is not None and record_mode_name != mode_name:
+                continue
+            if not entries:
+                yield record_mode_name, None
+            for entry in entries or ():
+                yield record_mode_name, entry
+
+    def write(self, path: str, data: Mapping[str, Iterable]) -> None:
+        with open(path, "w", encoding="utf-8") as file:
+            yaml.dump(
+                {mode_name: list(entries) for mode_name, entries in data.items()},
+                file,
+                Dumper=YAML_DUMPER,
+                sort_keys=False,
+            )
+
+
+class JsonLinesManifest(ManifestFormat):
+    """One JSON object per line: {"mode": mode name, "entry": entry}."""
+
+    def iter_records(
+        self, path: str, mode_name: Optional[str] = None
+    ) -> Iterator[Tuple]:
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record["mode"], record.get("entry")
+
+    def write(self, path: str, data: Mapping[str, Iterable]) -> None:
+        with open(path, "w", encoding="utf-8") as file:
+            for mode_name, entry in _iter_data_records(data):
+                record = {"mode": mode_name}
+                if entry is not None:
+                    record["entry"] = entry
+                file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+class SqliteManifest(ManifestFormat):
+    """An entries table with the mode name and the JSON encoded entry, indexed by mode."""
+
+    def iter_records(
+        self, path: str, mode_name: Optional[str] = None
+    ) -> Iterator[Tuple]:
+        connection = sqlite3.connect(
+            f"{Path(path).absolute().as_uri()}?mode=ro", uri=True
+        )
+        try:
+            if mode_name is None:
+                rows = connection.execute(
+                    "SELECT mode, entry FROM entries ORDER BY mode_index, position"
+                )
+            else:
+                rows = connection.execute(
+                    "SELECT mode, entry FROM entries WHERE mode = ? ORDER BY position",
+                    (mode_name,),
+                )
+            for row_mode_name, entry in rows:
+                yield row_mode_name, None if entry is None else json.loads(entry)
+        finally:
+            connection.close()
+
+    def write(self, path: str, data: Mapping[str, Iterable]) -> None:
+        connection = sqlite3.connect(path)
+        try:
+            connection.executescript("""
+                CREATE TABLE entries (
+                    mode TEXT NOT NULL,
+                    mode_index INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    entry TEXT
+                );
+                CREATE INDEX entries_mode ON entries (mode, position);
+                """)
+            mode_indices = {}
+            connection.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?, ?)",
+                (
+                    (
+                        mode_name,
+                        mode_indices.setdefault(mode_name, len(mode_indices)),
+                        position,
+                        None if entry is None else json.dumps(entry),
+                    )
+                    for position, (mode_name, entry) in enumerate(
+                        _iter_data_records(data)
+                    )
+                ),
+            )
+            connection.commit()
+        finally:
+            connection.close()
+
+
+class ParquetManifest(ManifestFormat):
+    """A table with a mode and a JSON encoded entry column, requires pyarrow."""
+
+    BATCH_SIZE = 65536
+
+    def iter_records(
+        self, path: str, mode_name: Optional[str] = None
+    ) -> Iterator[Tuple]:
+        _check_pyarrow()
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        for batch in parquet_file.iter_batches(
+            self.BATCH_SIZE, columns=["mode", "entry"]
+        ):
+            columns = batch.to_pydict()
+            for row_mode_name, entry in zip(columns["mode"], columns["entry"]):
+                if mode_name is None or row_mode_name == mode_name:
+                    yield row_mode_name, None if entry is None else json.loads(entry)
+
+    def write(self, path: str, data: Mapping[str, Iterable]) -> None:
+        _check_pyarrow()
+        mode_names, entries = [], []
+        for mode_name, entry in _iter_data_records(data):
+            mode_names.append(mode_name)
+            entries.append(None if entry is None else json.dumps(entry))
+        table = pyarrow.table(
+            {
+                "mode": pyarrow.array(mode_names, pyarrow.string()),
+                "entry": pyarrow.array(entries, pyarrow.string()),
+            }
+        )
+        pyarrow.parquet.write_table(table, path, compression="zstd")
+
+
+MANIFEST_FORMATS: Dict[str, ManifestFormat] = {
+    ".yml": YamlManifest(),
+    ".yaml": YamlManifest(),
+    ".jsonl": JsonLinesManifest(),
+    ".sqlite": SqliteManifest(),
+    ".db": SqliteManifest(),
+    ".parquet": ParquetManifest(),
+}
+
+
+def get_manifest_format(path: Union[str, Path]) -> ManifestFormat:
+    """Returns the manifest format for the suffix of path, YAML for unknown suffixes."""
+    return MANIFEST_FORMATS.get(Path(path).suffix.lower(), MANIFEST_FORMATS[".yml"])
+
+
+def write_manifest(path: Union[str, Path], data: Mapping[str, Iterable]) -> Path:
+    """Writes a manifest in the format of the suffix of path.
+
+    The manifest is written to a partial file first and then renamed, so readers never
+    see a half written manifest.
+
+    Args:
+        path (Union[str, Path]): The manifest, in one of the MANIFEST_FORMATS.
+        data (Mapping[str, Iterable]): The entries per mode name.
+
+    Returns:
+        Path: The path of the manifest.
+
+    Examples:
+        >>> data = load_manifest("/data/manifest.yml")
+        >>> write_manifest("/data/manifest.sqlite", data)
+    """
+    path = Path(path).expanduser()
+    manifest_format = get_manifest_format(path)
+    partial_path = path.with_name(f"{path.name}.{os.getpid()}.partial")
+    try:
+        manifest_format.write(str(partial_path), data)
+        os.replace(partial_path, path)
+    finally:
+        if partial_path.exists():
+            partial_path.unlink()
+    return path
+
+
+def export_associations(associations: Mapping, path: Union[str, Path]) -> Path:
+    """Writes associations as a manifest, with one entry per association key.
+
+    Reading the manifest with get_associations_from_yaml gives the same files per
+    entry, with keys numbered in order instead of the original keys.
+
+    Args:
+        associations (Mapping): sourcelib.associations.Associations.
+        path (Union[str, Path]): The manifest, in one of the MANIFEST_FORMATS.
+
+    Raises:
+        ValueError: If an association has more than one file of a file class, which the manifest schema cannot express.
+
+    Returns:
+        Path: The path of the manifest.
+
+    Examples:
+        >>> associations = associate_files(images, annotations)
+        >>> export_associations(associations, "/data/manifest.jsonl")
+    """
+    data = {}
+    for file_key, associated_files in associations.items():
+        entry = {}
+        mode = None
+        for identifier, files in associated_files.items():
+            if len(files) > 1:
+                raise ValueError(
+                    f"Association '{file_key}' has {len(files)} '{identifier}' files, "
+                    "a manifest entry can only have one file per identifier"
+                )
+            entry[identifier] = {"path": str(files[0].path)}
+            mode = files[0].mode
+        if mode is not None:
+            data.setdefault(mode.name, []).append(entry)
+    return write_manifest(path, data)
+
+
+def _iter_data_records(data: Mapping[str, Iterable]) -> Iterator[Tuple]:
+    for mode_name, entries in data.items():
+        empty = True
+        for entry in entries:
+            empty = False
+            yield mode_name, entry
+        if empty:
+            yield mode_name, None
+
+
+def _check_pyarrow() -> None:
+    if pyarrow is None:
+        raise ValueError("Parquet manifests require: pip install pyarrow")
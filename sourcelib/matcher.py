@@ -0,0 +1,155 @@
+import re
+from collections import deque
+from fnmatch import translate
+from typing import Iterable, List, Optional, Pattern, Union
+
+GLOB_CHARACTERS = "*?["
+NEGATION_PREFIX = "!"
+
+
+class SubstringAutomaton:
+    """Aho-Corasick automaton that checks whether a text contains any of many substrings.
+
+    The cost of a search depends on the length of the text, not on the number of substrings.
+
+    Args:
+        substrings (Iterable[str]): The substrings to search for.
+
+    Examples:
+        >>> automaton = SubstringAutomaton(["_he_", "thumb"])
+        >>> automaton.search("/data/slide_he_1.tif")
+        True
+    """
+
+    def __init__(self, substrings: Iterable[str]):
+        self._transitions = [{}]
+        self._failures = [0]
+        self._outputs = [False]
+        for substring in substrings:
+            self._add(substring)
+        self._link()
+
+    def _add(self, substring: str) -> None:
+        state = 0
+        for character in substring:
+            next_state = self._transitions[state].get(character)
+            if next_state is None:
+                next_state = len(self._transitions)
+                self._transitions.append({})
+                self._failures.append(0)
+                self._outputs.append(False)
+                self._transitions[state][character] = next_state
+            state = next_state
+        self._outputs[state] = True
+
+    def _link(self) -> None:
+        queue = deque(self._transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self._transitions[state].items():
+                queue.append(next_state)
+                failure = self._failures[state]
+                while failure and character not in self._transitions[failure]:
+                    failure = self._failures[failure]
+                failure = self._transitions[failure].get(character, 0)
+                self._failures[next_state] = failure
+                self._outputs[next_state] = (
+                    self._outputs[next_state] or self._outputs[failure]
+                )
+
+    def search(self, text: str) -> bool:
+        """Returns whether text contains any of the substrings."""
+        transitions, failures, outputs = (
+            self._transitions,
+            self._failures,
+            self._outputs,
+        )
+        if outputs[0]:
+            return True
+        state = 0
+        for character in text:
+            while state and character not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(character, 0)
+            if outputs[state]:
+                return True
+        return False
+
+
+class _PatternSet:
+    """Plain substrings (matched anywhere) and globs (matched against the whole path)."""
+
+    def __init__(self, patterns: Iterable[str]):
+        patterns = list(patterns)
+        substrings, globs = [], []
+        for pattern in patterns:
+            is_glob = any(character in pattern for character in GLOB_CHARACTERS)
+            (globs if is_glob else substrings).append(pattern)
+        self._automaton = SubstringAutomaton(substrings) if substrings else None
+        self._globs = (
+            re.compile("|".join(translate(glob) for glob in globs)) if globs else None
+        )
+        self.empty = not patterns
+
+    def search(self, path: str) -> bool:
+        if self._automaton is not None and self._automaton.search(path):
+            return True
+        return self._globs is not None and self._globs.match(path) is not None
+
+
+class PathMatcher:
+    """Filters, excludes and a regex compiled once into a single path matcher.
+
+    A path is selected when it matches none of the excludes, at least one of the filters
+    (if there are filters) and the regex (if given), like get_files_from_paths does.
+    Patterns are plain substrings, matched with one Aho-Corasick automaton, unless they
+    contain glob characters (*?[); globs are matched against the whole path, and their
+    * also matches /. A pattern prefixed with ! is negated: a negated filter excludes
+    the paths that match it, and a negated exclude keeps the paths that match it even
+    when they match another exclude.
+
+    Args:
+        filters (Optional[Iterable[str]], optional): Paths must match one of these. Defaults to ().
+        excludes (Optional[Iterable[str]], optional): Paths must not match any of these. Defaults to ().
+        regex (Optional[Union[str, Pattern]], optional): Paths must match this regular expression. Defaults to None.
+
+    Examples:
+        >>> matcher = PathMatcher(filters=["*.tif"], excludes=["thumb", "!thumb_keep"])
+        >>> matcher.select(["/a/b.tif", "/a/thumb.tif", "/a/thumb_keep.tif"])
+        ['/a/b.tif', '/a/thumb_keep.tif']
+    """
+
+    def __init__(
+        self,
+        filters: Optional[Iterable[str]] = (),
+        excludes: Optional[Iterable[str]] = (),
+        regex: Optional[Union[str, Pattern]] = None,
+    ):
+        filters, negated_filters = _split_negations(filters or ())
+        excludes, negated_excludes = _split_negations(excludes or ())
+        self._filters = _PatternSet(filters)
+        self._excludes = _PatternSet(excludes + negated_filters)
+        self._keeps = _PatternSet(negated_excludes)
+        self._regex = None if regex is None else re.compile(regex)
+
+    def __call__(self, path: str) -> bool:
+        if not self._excludes.empty and self._excludes.search(path):
+            if self._keeps.empty or not self._keeps.search(path):
+                return False
+        if not self._filters.empty and not self._filters.search(path):
+            return False
+        return self._regex is None or self._regex.search(path) is not None
+
+    def select(self, paths: Iterable[str]) -> List[str]:
+        """Returns the selected paths, in order."""
+        return [path for path in paths if self(path)]
+
+
+def _split_negations(patterns: Iterable[str]):
+    positives, negatives = [], []
+    for pattern in patterns:
+        if len(pattern) > 1 and pattern.startswith(NEGATION_PREFIX):
+            negatives.append(pattern[len(NEGATION_PREFIX) :])
+        else:
+            positives.append(pattern)
+    return positives, negatives
@@ -0,0 +1,184 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterator, List, Mapping, Optional, Tuple, Union
+
+
+def get_suffix_lengths(suffixes: Mapping) -> Tuple[int, ...]:
+    """Returns the distinct lengths of the suffixes, longest first.
+
+    Args:
+        suffixes (Mapping): Mapping with suffixes as keys, e.g., File.EXTENSIONS.
+
+    Returns:
+        Tuple[int, ...]: The distinct suffix lengths in descending order.
+    """
+    return tuple(sorted({len(suffix) for suffix in suffixes if suffix}, reverse=True))
+
+
+def match_suffix(
+    name: str, suffixes: Mapping, suffix_lengths: Tuple[int, ...]
+) -> Optional[str]:
+    """Looks up the longest suffix of name that is present in suffixes.
+
+    Multi-part suffixes such as '.ome.tif' are matched before '.tif'.
+
+    Args:
+        name (str): The file name.
+        suffixes (Mapping): Mapping with suffixes as keys, e.g., File.EXTENSIONS.
+        suffix_lengths (Tuple[int, ...]): Result of get_suffix_lengths(suffixes).
+
+    Returns:
+        Optional[str]: The matching suffix or None.
+
+    Examples:
+        >>> suffixes = {".tif": None, ".ome.tif": None}
+        >>> match_suffix("slide.ome.tif", suffixes, get_suffix_lengths(suffixes))
+        '.ome.tif'
+    """
+    name_length = len(name)
+    for suffix_length in suffix_lengths:
+        if suffix_length > name_length:
+            continue
+        suffix = name[name_length - suffix_length :]
+        if suffix in suffixes:
+            return suffix
+    return None
+
+
+def list_directory(
+    directory: str,
+    suffixes: Mapping,
+    suffix_lengths: Tuple[int, ...],
+    with_stat: bool = False,
+) -> Tuple[List[Tuple], List[str]]:
+    """Lists one directory.
+
+    Args:
+        directory (str): The directory to list.
+        suffixes (Mapping): Mapping with suffixes as keys, e.g., File.EXTENSIONS.
+        suffix_lengths (Tuple[int, ...]): Result of get_suffix_lengths(suffixes).
+        with_stat (bool, optional): Also return the os.stat_result of every matching entry (None if it vanished). Defaults to False.
+
+    Returns:
+        Tuple[List[Tuple], List[str]]: The (suffix, path) or (suffix, path, stat) of every matching entry and the paths of all subdirectories.
+    """
+    matches = []
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                suffix = match_suffix(entry.name, suffixes, suffix_lengths)
+                if suffix is not None:
+                    if with_stat:
+                        matches.append((suffix, entry.path, get_stat(entry)))
+                    else:
+                        matches.append((suffix, entry.path))
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                except OSError:
+                    continue
+    except (PermissionError, FileNotFoundError, NotADirectoryError):
+        pass
+    return matches, subdirectories
+
+
+def get_stat(entry: Union[str, os.DirEntry]) -> Optional[os.stat_result]:
+    """Returns the os.stat_result of a path or directory entry (following symlinks), or None if it does not exist."""
+    try:
+        return entry.stat() if isinstance(entry, os.DirEntry) else os.stat(entry)
+    except OSError:
+        return None
+
+
+def iter_scan_folder(
+    folder: Union[str, Path],
+    suffixes: Mapping,
+    recursive: bool = False,
+    workers: Optional[int] = None,
+    cache=None,
+    with_stat: bool = False,
+) -> Iterator[Tuple]:
+    """Walks a folder once and yields every entry that ends with one of the suffixes.
+
+    Symlinked directories are not followed, and unreadable directories are skipped.
+    With workers, directories are listed ahead of time on a thread pool, which hides
+    the latency of readdir/stat calls on network storage. At most workers * 4
+    directory listings are in flight at once, and entries are yielded in the same
+    order as the serial walk.
+
+    Args:
+        folder (Union[str, Path]): The folder to scan.
+        suffixes (Mapping): Mapping with suffixes as keys, e.g., File.EXTENSIONS.
+        recursive (bool, optional): Whether to descend into subdirectories.
+        workers (Optional[int], optional): Number of threads that list directories. Defaults to None (serial).
+        cache (Optional[ScanCache], optional): Cache that reuses listings of directories that did not change. Defaults to None.
+        with_stat (bool, optional): Also yield the os.stat_result of every entry, taken while listing (on the workers, if any). Defaults to False.
+
+    Yields:
+        Tuple: The matched suffix and the path of the entry, and its stat (or None) with with_stat.
+    """
+    root = os.fspath(Path(folder))
+    lister = partial(
+        list_directory,
+        suffixes=suffixes,
+        suffix_lengths=get_suffix_lengths(suffixes),
+        with_stat=with_stat,
+    )
+    if cache is None:
+        yield from _walk(root, lister, recursive, workers)
+    else:
+        with cache.session(suffixes, lister, with_stat) as cached_lister:
+            yield from _walk(root, cached_lister, recursive, workers)
+
+
+def _walk(
+    root: str, lister: Callable, recursive: bool, workers: Optional[int]
+) -> Iterator[Tuple[str, str]]:
+    if not recursive or workers is None or workers <= 1:
+        yield from _walk_serial(root, lister, recursive)
+    else:
+        yield from _walk_parallel(root, lister, workers)
+
+
+def _walk_serial(
+    root: str, lister: Callable, recursive: bool
+) -> Iterator[Tuple[str, str]]:
+    directories = [root]
+    while directories:
+        matches, subdirectories = lister(directories.pop())
+        yield from matches
+        if recursive:
+            directories.extend(reversed(subdirectories))
+
+
+def _walk_parallel(
+    root: str, lister: Callable, workers: int
+) -> Iterator[Tuple[str, str]]:
+    # The stack holds the same directories, in the same order, as the serial walk.
+    # Directories close to the top of the stack are submitted to the pool before
+    # they are needed, so the walk order (and thus the output) stays deterministic.
+    max_in_flight = workers * 4
+    stack: List[Union[str, Future]] = [root]
+    in_flight = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while stack:
+                position = len(stack) - 1
+                while position >= 0 and in_flight < max_in_flight:
+                    if isinstance(stack[position], str):
+                        stack[position] = executor.submit(lister, stack[position])
+                        in_flight += 1
+                    position -= 1
+
+                listing = stack.pop()
+                in_flight -= 1
+                matches, subdirectories = listing.result()
+                yield from matches
+                stack.extend(reversed(subdirectories))
+        finally:
+            for item in stack:
+                if isinstance(item, Future):
+                    item.cancel()
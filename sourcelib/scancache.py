@@ -0,0 +1,191 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterator, List, Mapping, Optional, Tuple, Union
+
+from sourcelib.scan import get_stat, get_suffix_lengths, match_suffix
+
+_SEPARATOR = "\0"
+
+# Directories modified less than this many seconds before they are listed are not
+# cached, because a change within the same mtime tick would go unnoticed.
+_RACY_SECONDS = 2.0
+
+
+def default_cache_folder() -> Path:
+    """Returns the default cache folder: $XDG_CACHE_HOME/sourcelib or ~/.cache/sourcelib."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "sourcelib"
+
+
+@dataclass
+class ScanCacheStats:
+    """Counts directory listings that were served from the cache (hits) and listed from disk (misses)."""
+
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class ScanCache:
+    """Persistent cache of directory listings, invalidated by directory mtimes.
+
+    A directory is only read again when its mtime changed, i.e., when entries were
+    added, removed or renamed in it. Listings are stored per set of suffixes (e.g.,
+    File.EXTENSIONS), so the same cache serves any folder, recursion setting, filter
+    and regex; those are applied to the cached listings on every call.
+
+    Args:
+        cache_folder (Optional[Union[str, Path]]): Folder of the SQLite database. Defaults to default_cache_folder().
+
+    Examples:
+        >>> cache = ScanCache("/tmp/sourcelib-cache")
+        >>> files = get_files_from_folder(ImageFile, "/data/slides", recursive=True, cache=cache)
+        >>> cache.stats
+        ScanCacheStats(hits=0, misses=1204)
+    """
+
+    FILENAME = "scan_cache.sqlite"
+
+    def __init__(self, cache_folder: Optional[Union[str, Path]] = None):
+        self._cache_folder = Path(
+            default_cache_folder() if cache_folder is None else cache_folder
+        )
+        self._cache_folder.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            str(self._cache_folder / self.FILENAME), check_same_thread=False
+        )
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS scans (
+                id INTEGER PRIMARY KEY,
+                suffixes TEXT UNIQUE NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS directories (
+                scan_id INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                matches TEXT NOT NULL,
+                subdirectories TEXT NOT NULL,
+                PRIMARY KEY (scan_id, path)
+            );
+            """
+        )
+        self.stats = ScanCacheStats()
+
+    @property
+    def path(self) -> Path:
+        return self._cache_folder / self.FILENAME
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM directories")
+            self._connection.execute("DELETE FROM scans")
+            self._connection.commit()
+        self.stats = ScanCacheStats()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    @contextmanager
+    def session(
+        self, suffixes: Mapping, lister: Callable, with_stat: bool = False
+    ) -> Iterator[Callable]:
+        """Wraps a directory lister (see sourcelib.scan.list_directory) with the cache.
+
+        New listings are written when the session ends.
+
+        Args:
+            suffixes (Mapping): Mapping with suffixes as keys, e.g., File.EXTENSIONS.
+            lister (Callable): Lists a directory when it is not cached or changed.
+            with_stat (bool, optional): Whether lister returns the stat of every match, which is then also taken for cached listings. Defaults to False.
+
+        Yields:
+            Callable: A lister with the same signature as lister.
+        """
+        scan_id = self._get_scan_id(suffixes)
+        suffix_lengths = get_suffix_lengths(suffixes)
+        updates = []
+
+        def cached_lister(directory: str) -> Tuple[List[Tuple], List[str]]:
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                return lister(directory)
+
+            with self._lock:
+                row = self._connection.execute(
+                    "SELECT mtime_ns, matches, subdirectories FROM directories "
+                    "WHERE scan_id = ? AND path = ?",
+                    (scan_id, directory),
+                ).fetchone()
+                hit = row is not None and row[0] == mtime_ns
+                if hit:
+                    self.stats.hits += 1
+                else:
+                    self.stats.misses += 1
+
+            if hit:
+                matches = [
+                    (
+                        match_suffix(name, suffixes, suffix_lengths),
+                        os.path.join(directory, name),
+                    )
+                    for name in _split(row[1])
+                ]
+                if with_stat:
+                    matches = [
+                        (suffix, path, get_stat(path)) for suffix, path in matches
+                    ]
+                return (
+                    matches,
+                    [os.path.join(directory, name) for name in _split(row[2])],
+                )
+
+            matches, subdirectories = lister(directory)
+            if time.time() - mtime_ns / 1e9 > _RACY_SECONDS:
+                updates.append(
+                    (
+                        scan_id,
+                        directory,
+                        mtime_ns,
+                        _SEPARATOR.join(
+                            os.path.basename(match[1]) for match in matches
+                        ),
+                        _SEPARATOR.join(os.path.basename(p) for p in subdirectories),
+                    )
+                )
+            return matches, subdirectories
+
+        try:
+            yield cached_lister
+        finally:
+            with self._lock:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)", updates
+                )
+                self._connection.commit()
+
+    def _get_scan_id(self, suffixes: Mapping) -> int:
+        key = _SEPARATOR.join(sorted(suffixes))
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO scans (suffixes) VALUES (?)", (key,)
+            )
+            self._connection.commit()
+            return self._connection.execute(
+                "SELECT id FROM scans WHERE suffixes = ?", (key,)
+            ).fetchone()[0]
+
+
+def _split(names: str) -> List[str]:
+    return names.split(_SEPARATOR) if names else []
@@ -0,0 +1,75 @@
+import zlib
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+def get_shard_index(key: str, num_shards: int) -> int:
+    """Returns the shard of a key.
+
+    The shard only depends on the key and the number of shards, so it is the same on
+    every node, in every process and in every Python version (unlike hash()).
+
+    Args:
+        key (str): The key, e.g., an association key.
+        num_shards (int): The number of shards.
+
+    Returns:
+        int: The shard index, in range(num_shards).
+
+    Examples:
+        >>> get_shard_index("slide_1", num_shards=16)
+        11
+    """
+    return zlib.crc32(str(key).encode("utf-8")) % num_shards
+
+
+def check_shard(shard_index: Optional[int], num_shards: Optional[int]) -> None:
+    """Checks that shard_index and num_shards are both None or describe a valid shard.
+
+    Raises:
+        ValueError: If only one of them is given, or shard_index is not in range(num_shards).
+    """
+    if shard_index is None and num_shards is None:
+        return
+    if shard_index is None or num_shards is None:
+        raise ValueError("shard_index and num_shards should be given together")
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(
+            f"shard_index {shard_index} should be in range(num_shards={num_shards})"
+        )
+
+
+def get_shard_filter(
+    shard_index: Optional[int], num_shards: Optional[int], key: Callable = str
+) -> Optional[Callable[[T], bool]]:
+    """Returns a function that tells whether an item is in the shard, or None without sharding.
+
+    Args:
+        shard_index (Optional[int]): The shard to keep, or None to keep everything.
+        num_shards (Optional[int]): The number of shards, or None to keep everything.
+        key (Callable, optional): Returns the key of an item. Defaults to str.
+
+    Raises:
+        ValueError: If the shard is invalid, see check_shard.
+    """
+    check_shard(shard_index, num_shards)
+    if shard_index is None:
+        return None
+
+    def in_shard(item: T) -> bool:
+        return get_shard_index(key(item), num_shards) == shard_index
+
+    return in_shard
+
+
+def select_shard(
+    items: Iterable[T], shard_index: int, num_shards: int, key: Callable = str
+) -> Iterator[T]:
+    """Yields the items whose key is in the shard.
+
+    Examples:
+        >>> files = select_shard(files, shard_index=3, num_shards=16, key=stem_file_associater)
+    """
+    in_shard = get_shard_filter(shard_index, num_shards, key)
+    return iter(items) if in_shard is None else filter(in_shard, items)
@@ -0,0 +1,573 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import closing
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from sourcelib.associations import AssociatedFiles, Associations
+from sourcelib.copy import copy_into, prepare_destination_folder
+from sourcelib.file import File
+
+
+@dataclass
+class CopyReport:
+    """Summary of a bulk copy.
+
+    Args:
+        transferred (int): Number of files and folders that were copied.
+        skipped (int): Number of files and folders that were already complete at the destination.
+        bytes (int): Number of bytes copied.
+        seconds (float): Wall time of the bulk copy.
+    """
+
+    transferred: int = 0
+    skipped: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+
+    def add(self, size: int) -> None:
+        """Adds the result of a copy job: the copied size, or -1 if the copy was skipped."""
+        if size < 0:
+            self.skipped += 1
+        else:
+            self.transferred += 1
+            self.bytes += size
+
+    @property
+    def throughput(self) -> float:
+        """Copied bytes per second."""
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"| Copied {self.transferred} (skipped {self.skipped}) | "
+            f"{self.bytes / 1e6:.1f} MB in {self.seconds:.1f}s | "
+            f"{self.throughput / 1e6:.1f} MB/s"
+        )
+
+
+COPY_ORDERS = ("largest", "smallest", None)
+
+
+class TokenBucket:
+    """Limits the rate at which a shared resource is used, e.g., the bytes copied per second by all threads.
+
+    Tokens are added at rate per second, up to capacity. A consumer that takes more
+    tokens than are available goes into debt and sleeps until the debt is paid, so
+    concurrent consumers are served in the order they arrive.
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (Optional[float], optional): Tokens that accumulate while the bucket is not used (the burst). Defaults to None (one second of tokens).
+
+    Examples:
+        >>> bucket = TokenBucket(100e6)  # 100 MB/s
+        >>> transfer(source, destination, throttle=bucket.consume)
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError(f"rate should be positive, not {rate}")
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self._tokens = self.capacity
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens: float) -> float:
+        """Takes tokens, and sleeps until they are available.
+
+        Returns:
+            float: The seconds slept.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._time) * self.rate
+            )
+            self._time = now
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class CopyScheduler:
+    """Decides the order of copy jobs, and limits their concurrency and bandwidth.
+
+    Jobs are ordered by priority (highest first) and then by size: largest first
+    minimizes the time until all files are copied, because a large file never starts
+    last, while smallest first makes most files available early. Sizes of files are
+    read from the cached File metadata (see File.size and prefetch_metadata).
+
+    A scheduler can be shared by copies that run at the same time (e.g., of several
+    datasets or tenants): the bandwidth limit applies to all their copies together,
+    and at most max_per_destination of their copies write to the same destination
+    folder at once. The destination limit is applied when jobs are submitted (see
+    get_slots), so jobs over the limit wait without occupying a worker thread.
+
+    Args:
+        order (Optional[str], optional): One of COPY_ORDERS: "largest" first, "smallest" first, or None to keep the order of the files. Defaults to "largest".
+        priorities (Optional[Mapping[Union[str, type], int]], optional): Priority per File subclass or IDENTIFIER; files without one have priority 0. Defaults to None.
+        bandwidth (Optional[float], optional): Maximum bytes per second of all copies, see TokenBucket. Defaults to None (unlimited).
+        burst (Optional[float], optional): Bytes that can be copied at once above the bandwidth. Defaults to None (one second of bandwidth).
+        max_per_destination (Optional[int], optional): Maximum number of concurrent copies into one destination folder. Defaults to None (unlimited).
+        destination_limits (Optional[Mapping[Path, int]], optional): Maximum number of concurrent copies into particular destination folders, overriding max_per_destination. Defaults to None.
+
+    Examples:
+        >>> scheduler = CopyScheduler("smallest", priorities={"annotation": 1}, bandwidth=200e6)
+        >>> report = copy_files(associations, "/scratch/dataset", workers=16, scheduler=scheduler)
+    """
+
+    def __init__(
+        self,
+        order: Optional[str] = "largest",
+        priorities: Optional[Mapping[Union[str, type], int]] = None,
+        bandwidth: Optional[float] = None,
+        burst: Optional[float] = None,
+        max_per_destination: Optional[int] = None,
+        destination_limits: Optional[Mapping[Path, int]] = None,
+    ):
+        if order not in COPY_ORDERS:
+            raise ValueError(f"Unknown copy order '{order}', choose from {COPY_ORDERS}")
+        self.order = order
+        self.priorities = dict(priorities or {})
+        self.bucket = None if bandwidth is None else TokenBucket(bandwidth, burst)
+        self.max_per_destination = max_per_destination
+        self.destination_limits = {
+            str(Path(folder).resolve()): limit
+            for folder, limit in (destination_limits or {}).items()
+        }
+        self._semaphores: Dict[str, threading.Semaphore] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def throttle(self) -> Optional[Callable[[int], float]]:
+        """Limits the bandwidth of a transfer, see sourcelib.copy.transfer."""
+        return None if self.bucket is None else self.bucket.consume
+
+    def get_priority(self, file: File) -> int:
+        """Returns the priority of the class of file (or a base class), else of its IDENTIFIER, else 0."""
+        for cls in type(file).__mro__:
+            if cls in self.priorities:
+                return self.priorities[cls]
+        return self.priorities.get(file.IDENTIFIER, 0)
+
+    def schedule(
+        self,
+        jobs: Iterable[Tuple[File, Path, Callable[[], int]]],
+        destination_folder: Path,
+    ) -> List[Callable[[], int]]:
+        """Orders copy jobs.
+
+        Args:
+            jobs (Iterable[Tuple[File, Path, Callable[[], int]]]): The file, the copied path (the file or its folder coupled companion) and the job.
+            destination_folder (Path): The destination folder of the jobs.
+
+        Returns:
+            List[Callable[[], int]]: The jobs, in the order in which they should start.
+        """
+        jobs = list(jobs)
+        if self.order is not None:
+            sign = -1 if self.order == "largest" else 1
+            jobs.sort(key=lambda job: sign * _get_source_size(job[0], job[1]))
+        jobs.sort(key=lambda job: -self.get_priority(job[0]))
+        return [job for *_, job in jobs]
+
+    def get_slots(self, destination_folder: Path) -> Optional[threading.Semaphore]:
+        """Returns the semaphore that limits the concurrent copies into destination_folder, or None without a limit.
+
+        A slot is acquired before a job is submitted, and released when it is done.
+        """
+        folder = str(Path(destination_folder).resolve())
+        limit = self.destination_limits.get(folder, self.max_per_destination)
+        if limit is None:
+            return None
+        with self._lock:
+            if folder not in self._semaphores:
+                self._semaphores[folder] = threading.Semaphore(limit)
+            return self._semaphores[folder]
+
+
+def get_files(files: Union[Iterable[File], Associations]) -> List[File]:
+    """Flattens an Associations object into its files; other iterables are returned as a list.
+
+    Args:
+        files (Union[Iterable[File], Associations]): Files or associations.
+
+    Returns:
+        List[File]: The files, each file once.
+    """
+    if isinstance(files, Associations):
+        files = (
+            file
+            for associated_files in files.values()
+            for identifier_files in associated_files.values()
+            for file in identifier_files
+        )
+    return list({id(file): file for file in files}.values())
+
+
+def copy_files(
+    files: Union[Iterable[File], Associations],
+    destination_folder: Path,
+    workers: int = 8,
+    verbose: bool = True,
+    strategy: str = "copy",
+    verify: str = "size",
+    scheduler: Optional[CopyScheduler] = None,
+) -> CopyReport:
+    """Copies many files, including their folder coupled companions, over a thread pool.
+
+    The destination folder is created once, and every file and companion is a
+    separate copy job. The paths of the files are updated to their copies, as with File.copy.
+    Without a scheduler, the jobs start in the order of the files, each
+    folder coupled companion right before its file.
+
+    Args:
+        files (Union[Iterable[File], Associations]): The files, or all files of the associations, to copy.
+        destination_folder (Path): The destination folder.
+        workers (int, optional): Number of concurrent copies. Defaults to 8.
+        verbose (bool, optional): Whether to print the report. Defaults to True.
+        strategy (str, optional): Transfer strategy, see sourcelib.copy.transfer. Defaults to "copy".
+        verify (str, optional): How existing copies are verified, see sourcelib.copy.is_complete. Defaults to "size".
+        scheduler (Optional[CopyScheduler], optional): Orders the jobs and limits their concurrency and bandwidth. Defaults to None.
+
+    Returns:
+        CopyReport: The number of copies, bytes and throughput.
+
+    Examples:
+        >>> associations = associate_files(images, annotations)
+        >>> report = copy_files(associations, "/scratch/dataset", workers=16)
+    """
+    start_time = time.perf_counter()
+    destination_folder = prepare_destination_folder(destination_folder)
+    jobs = get_copy_jobs(files, destination_folder, strategy, verify, scheduler)
+
+    slots = None if scheduler is None else scheduler.get_slots(destination_folder)
+    report = CopyReport()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [_submit(executor, job, slots) for job in jobs]
+        for future in futures:
+            report.add(future.result())
+    report.seconds = time.perf_counter() - start_time
+
+    if verbose:
+        print(report)
+    return report
+
+
+def get_copy_jobs(
+    files: Union[Iterable[File], Associations],
+    destination_folder: Path,
+    strategy: str = "copy",
+    verify: str = "size",
+    scheduler: Optional[CopyScheduler] = None,
+) -> List[Callable[[], int]]:
+    """Creates one copy job per folder coupled companion and per file.
+
+    The jobs are ordered by the scheduler; its destination limit is applied by the
+    caller when it submits them (see CopyScheduler.get_slots).
+
+    Args:
+        files (Union[Iterable[File], Associations]): The files, or all files of the associations, to copy.
+        destination_folder (Path): Destination folder prepared with sourcelib.copy.prepare_destination_folder.
+        strategy (str, optional): Transfer strategy, see sourcelib.copy.transfer. Defaults to "copy".
+        verify (str, optional): How existing copies are verified, see sourcelib.copy.is_complete. Defaults to "size".
+        scheduler (Optional[CopyScheduler], optional): Orders the jobs and limits their bandwidth. Defaults to None.
+
+    Returns:
+        List[Callable[[], int]]: Jobs that return the copied size, or -1 if the copy was skipped.
+    """
+    jobs = _get_copy_jobs(files, destination_folder, strategy, verify, scheduler)
+    if scheduler is None:
+        return [job for *_, job in jobs]
+    return scheduler.schedule(jobs, destination_folder)
+
+
+def stage_associations(
+    associations: Union[Associations, Iterable[Tuple[str, AssociatedFiles]]],
+    destination_folder: Path,
+    workers: int = 8,
+    strategy: str = "copy",
+    verify: str = "size",
+    scheduler: Optional[CopyScheduler] = None,
+    report: Optional[CopyReport] = None,
+) -> Iterator[Tuple[str, AssociatedFiles]]:
+    """Copies the files of associations over a thread pool, and yields every association as soon as all its files are copied.
+
+    An association is yielded when all its files, and their folder coupled companions,
+    are complete at the destination, so a consumer (e.g., a training job) can start
+    on the first associations while the others are still being copied. Without a
+    scheduler, the files are copied association by association, in order, so that
+    associations complete as early as possible. Copies that are still queued are
+    cancelled when the consumer stops iterating or a copy fails.
+
+    Args:
+        associations (Union[Associations, Iterable[Tuple[str, AssociatedFiles]]]): The associations, or (key, AssociatedFiles) pairs as yielded by iter_associations_from_yaml.
+        destination_folder (Path): The destination folder.
+        workers (int, optional): Number of concurrent copies. Defaults to 8.
+        strategy (str, optional): Transfer strategy, see sourcelib.copy.transfer. Defaults to "copy".
+        verify (str, optional): How existing copies are verified, see sourcelib.copy.is_complete. Defaults to "size".
+        scheduler (Optional[CopyScheduler], optional): Orders the copies and limits their concurrency and bandwidth. Defaults to None.
+        report (Optional[CopyReport], optional): Report that is updated as the files are copied. Defaults to None.
+
+    Yields:
+        Tuple[str, AssociatedFiles]: The key and the files of an association, whose paths are the copies.
+
+    Examples:
+        >>> associations = get_associations_from_yaml("data.yml", file_classes, mode)
+        >>> for key, associated_files in stage_associations(associations, "/scratch/dataset"):
+        ...     dataset.add(associated_files)
+    """
+    start_time = time.perf_counter()
+    if isinstance(associations, Mapping):
+        associations = associations.items()
+    associations = list(associations)
+    destination_folder = prepare_destination_folder(destination_folder)
+    jobs = _get_copy_jobs(
+        get_files(
+            file
+            for _, associated_files in associations
+            for identifier_files in associated_files.values()
+            for file in identifier_files
+        ),
+        destination_folder,
+        strategy,
+        verify,
+        scheduler,
+    )
+
+    remaining, waiting = _get_waiting_associations(associations, jobs)
+    jobs = _schedule_indexed(jobs, destination_folder, scheduler)
+
+    report = CopyReport() if report is None else report
+    for association_index, count in enumerate(remaining):
+        if not count:
+            yield associations[association_index]
+
+    slots = None if scheduler is None else scheduler.get_slots(destination_folder)
+    with closing(_run_jobs(jobs, workers, slots)) as results:
+        for index, size in results:
+            report.add(size)
+            report.seconds = time.perf_counter() - start_time
+            for association_index in waiting.get(index, ()):
+                remaining[association_index] -= 1
+                if not remaining[association_index]:
+                    yield associations[association_index]
+
+
+def _get_waiting_associations(
+    associations: List[Tuple[str, AssociatedFiles]],
+    jobs: List[Tuple[File, Path, Callable[[], int]]],
+) -> Tuple[List[int], Dict[int, List[int]]]:
+    """Returns the number of jobs every association waits for, and the associations waiting for every job."""
+    job_indices = {
+        (id(file) if path == file.path else path): index
+        for index, (file, path, _) in enumerate(jobs)
+    }
+    remaining = []
+    waiting: Dict[int, List[int]] = {}
+    for association_index, (_, associated_files) in enumerate(associations):
+        indices = set()
+        for identifier_files in associated_files.values():
+            for file in identifier_files:
+                indices.add(job_indices[id(file)])
+                if file.folder_coupled_path is not None:
+                    indices.add(job_indices[file.folder_coupled_path])
+        remaining.append(len(indices))
+        for index in indices:
+            waiting.setdefault(index, []).append(association_index)
+    return remaining, waiting
+
+
+def _schedule_indexed(
+    jobs: List[Tuple[File, Path, Callable[[], int]]],
+    destination_folder: Path,
+    scheduler: Optional[CopyScheduler],
+) -> List[Callable[[], Tuple[int, int]]]:
+    """Orders the jobs, which return their index (in jobs) and the copied size."""
+    jobs = [
+        (file, path, partial(_run_indexed, index, job))
+        for index, (file, path, job) in enumerate(jobs)
+    ]
+    if scheduler is None:
+        return [job for *_, job in jobs]
+    return scheduler.schedule(jobs, destination_folder)
+
+
+def _run_jobs(
+    jobs: List[Callable[[], Tuple[int, int]]],
+    workers: int,
+    slots: Optional[threading.Semaphore],
+) -> Iterator[Tuple[int, int]]:
+    """Runs the jobs over a thread pool and yields their results as they complete.
+
+    Queued jobs are cancelled when the generator is closed or a job fails.
+    """
+    jobs = deque(jobs)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = set()
+    try:
+        while jobs or pending:
+            # submit while there are free slots, and wait for one if nothing runs
+            while jobs:
+                future = _submit(executor, jobs[0], slots, blocking=not pending)
+                if future is None:
+                    break
+                jobs.popleft()
+                pending.add(future)
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _get_copy_jobs(
+    files: Union[Iterable[File], Associations],
+    destination_folder: Path,
+    strategy: str,
+    verify: str,
+    scheduler: Optional[CopyScheduler],
+) -> List[Tuple[File, Path, Callable[[], int]]]:
+    """Creates the copy jobs of get_copy_jobs, with the file and the path (the file or its companion) that each job copies.
+
+    Jobs are in the order of the files, with the companion of a file right before
+    it, so the files of an association (see get_files) are copied together.
+    """
+    files = get_files(files)
+    throttle = None if scheduler is None else scheduler.throttle
+    jobs = []
+    companions = set()
+    for file in files:
+        path = file.folder_coupled_path
+        if path is not None and path not in companions:
+            companions.add(path)
+            jobs.append(
+                (
+                    file,
+                    path,
+                    partial(
+                        _copy_companion,
+                        path,
+                        destination_folder,
+                        strategy,
+                        verify,
+                        throttle,
+                    ),
+                )
+            )
+        jobs.append(
+            (
+                file,
+                file.path,
+                partial(
+                    _copy_file, file, destination_folder, strategy, verify, throttle
+                ),
+            )
+        )
+    return jobs
+
+
+def _copy_companion(
+    path: Path,
+    destination_folder: Path,
+    strategy: str,
+    verify: str,
+    throttle: Optional[Callable] = None,
+) -> int:
+    destination_path, transferred = copy_into(
+        path,
+        destination_folder,
+        verbose=False,
+        strategy=strategy,
+        verify=verify,
+        throttle=throttle,
+    )
+    return _get_size(destination_path) if transferred else -1
+
+
+def _copy_file(
+    file: File,
+    destination_folder: Path,
+    strategy: str,
+    verify: str,
+    throttle: Optional[Callable] = None,
+) -> int:
+    transferred = file.copy_into(
+        destination_folder,
+        verbose=False,
+        strategy=strategy,
+        verify=verify,
+        throttle=throttle,
+    )
+    return _get_size(file.path) if transferred else -1
+
+
+def _run_indexed(index: int, job: Callable[[], int]) -> Tuple[int, int]:
+    return index, job()
+
+
+def _submit(
+    executor: Executor,
+    job: Callable[[], int],
+    slots: Optional[threading.Semaphore],
+    blocking: bool = True,
+) -> Optional[Future]:
+    """Submits a job once it gets a slot, or returns None if not blocking and there is no free slot."""
+    if slots is None:
+        return executor.submit(job)
+    if not slots.acquire(blocking=blocking):
+        return None
+    try:
+        future = executor.submit(job)
+    except BaseException:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return future
+
+
+def _get_source_size(file: File, path: Path) -> int:
+    """The size of file, or of its folder coupled companion at path, or 0 if it does not exist."""
+    try:
+        if path == file.path:
+            return file.size if file.exists else 0
+        return _get_size(path)
+    except OSError:
+        return 0
+
+
+def _get_size(path: Path) -> int:
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
@@ -0,0 +1,347 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Optional, Tuple, Union
+
+from sourcelib.checksum import CHECKSUM_ALGORITHMS, file_checksum
+from sourcelib.copy import (
+    NonExistingSourceFileError,
+    is_complete,
+    prepare_destination_folder,
+    transfer,
+)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+EVICTION_POLICIES = ("lru", "lfu")
+
+ADDRESSES = ("identity",) + CHECKSUM_ALGORITHMS
+
+_ORDER_BY = {"lru": "last_access", "lfu": "hits, last_access"}
+
+
+@dataclass
+class StagingCacheStats:
+    """Counts fetches served from the cache (hits) or copied from the source (misses), and evicted entries."""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class StagingCache:
+    """Node-local cache of staged files and folders, shared by all processes on the node.
+
+    Every source is copied into the cache once, under a key derived from its content
+    address, and is then linked (by default reflinked, with a fallback to copying)
+    into any number of destination folders. The address of a source is its identity
+    (absolute path, size and mtime), so a changed source gets a new entry, or the
+    checksum of its content, which also shares the entry of identical files at
+    different paths at the cost of reading every source. Folders (folder coupled
+    companions) are always addressed by identity.
+
+    When the entries exceed the byte budget, the least recently used (lru) or least
+    frequently used (lfu) entries are removed. An entry is pinned while it is in use
+    (see pinned), and pinned entries are never evicted. Fetches and pins hold file
+    locks (fcntl.flock) on the entry, so concurrent processes fetching the same
+    source wait for a single copy, and locks of crashed processes are released by
+    the operating system. Copies in destination folders remain valid after their
+    entry is evicted.
+
+    Warning:
+        With link_strategy="hardlink" (or "symlink"), every destination shares the
+        data of the cache entry. A job that writes to its staged file changes the
+        entry, and the files of all other jobs staged from it. Only use links for
+        files that are never modified. Hardlinked copies also keep using disk space
+        after their entry is evicted, until they are removed.
+
+    Args:
+        cache_folder (Union[str, Path]): Folder of the cache, e.g., on node-local SSD.
+        budget (Optional[int], optional): Maximum number of bytes of all entries. Defaults to None (unlimited).
+        policy (str, optional): One of EVICTION_POLICIES. Defaults to "lru".
+        address (str, optional): One of ADDRESSES: "identity" or a checksum algorithm. Defaults to "identity".
+        link_strategy (str, optional): Transfer strategy from the cache into destination folders, see sourcelib.copy.transfer and the warning above. Defaults to "reflink" (copy-on-write where supported, else a copy).
+
+    Examples:
+        >>> cache = StagingCache("/local/ssd/sourcelib", budget=500 << 30)
+        >>> for file in files:
+        ...     file.copy("/local/ssd/job_1", cache=cache)
+    """
+
+    FILENAME = "staging_cache.sqlite"
+
+    def __init__(
+        self,
+        cache_folder: Union[str, Path],
+        budget: Optional[int] = None,
+        policy: str = "lru",
+        address: str = "identity",
+        link_strategy: str = "reflink",
+    ):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(
+                f"Unknown eviction policy '{policy}', choose from {EVICTION_POLICIES}"
+            )
+        if address not in ADDRESSES:
+            raise ValueError(f"Unknown address '{address}', choose from {ADDRESSES}")
+        self.budget = budget
+        self.policy = policy
+        self.address = address
+        self.link_strategy = link_strategy
+        self._cache_folder = Path(cache_folder)
+        (self._cache_folder / "objects").mkdir(parents=True, exist_ok=True)
+        (self._cache_folder / "locks").mkdir(exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            str(self._cache_folder / self.FILENAME), timeout=60, check_same_thread=False
+        )
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                hits INTEGER NOT NULL
+            );
+            """
+        )
+        self.stats = StagingCacheStats()
+
+    @property
+    def path(self) -> Path:
+        return self._cache_folder / self.FILENAME
+
+    @property
+    def size(self) -> int:
+        """The number of bytes of all entries."""
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()[0]
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "StagingCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def get_key(self, source: Union[str, Path]) -> str:
+        """Returns the key of the entry of a source file or folder.
+
+        Raises:
+            NonExistingSourceFileError: If the source does not exist.
+        """
+        source = os.path.abspath(source)
+        try:
+            source_stat = os.stat(source)
+        except OSError:
+            raise NonExistingSourceFileError(
+                f"Can not stage {source} because it does not exists"
+            ) from None
+        if self.address != "identity" and not os.path.isdir(source):
+            return file_checksum(source, self.address)
+        identity = f"{source}\0{source_stat.st_size}\0{source_stat.st_mtime_ns}"
+        return hashlib.blake2b(identity.encode("utf-8"), digest_size=16).hexdigest()
+
+    @contextmanager
+    def pinned(
+        self, source: Union[str, Path], strategy: str = "copy"
+    ) -> Iterator[Path]:
+        """Fetches a source into the cache, and keeps its entry from being evicted while in use.
+
+        Args:
+            source (Union[str, Path]): The source file or folder.
+            strategy (str, optional): Transfer strategy from the source into the cache, see sourcelib.copy.transfer. Defaults to "copy".
+
+        Yields:
+            Path: The cached file or folder.
+        """
+        key = self.get_key(source)
+        while True:
+            with self._locked(key) as lock_file:
+                path, fetched = self._fetch(key, Path(source), strategy)
+                # downgrade to a shared lock, which only keeps the entry from
+                # eviction; if it was evicted in between, it is fetched again
+                _flock(lock_file, shared=True)
+                if self._holds(lock_file, key) and os.path.lexists(path):
+                    if fetched:
+                        self.evict()
+                    yield path
+                    return
+
+    def copy(
+        self,
+        source: Union[str, Path],
+        destination_folder: Union[str, Path],
+        strategy: str = "copy",
+        verify: str = "size",
+    ) -> Path:
+        """Copies a source file or folder into destination_folder through the cache.
+
+        Args:
+            source (Union[str, Path]): The source file or folder.
+            destination_folder (Union[str, Path]): The destination folder.
+            strategy (str, optional): Transfer strategy from the source into the cache, see sourcelib.copy.transfer. Defaults to "copy".
+            verify (str, optional): How existing copies in destination_folder are verified, see sourcelib.copy.is_complete. Defaults to "size".
+
+        Returns:
+            Path: The destination path, with the name of the source.
+        """
+        destination_folder = prepare_destination_folder(destination_folder)
+        destination_path = destination_folder / Path(source).name
+        with self.pinned(source, strategy) as cached_path:
+            if not is_complete(cached_path, destination_path, verify):
+                transfer(cached_path, destination_path, self.link_strategy)
+        return destination_path
+
+    def evict(self, budget: Optional[int] = None) -> int:
+        """Removes entries, in the order of the eviction policy, until they fit in the budget.
+
+        Entries that are pinned or being fetched are skipped.
+
+        Args:
+            budget (Optional[int], optional): The budget in bytes. Defaults to None (the budget of the cache).
+
+        Returns:
+            int: The number of bytes removed.
+        """
+        budget = self.budget if budget is None else budget
+        if budget is None or self.size <= budget:
+            return 0
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT key, size FROM entries ORDER BY {_ORDER_BY[self.policy]}"
+            ).fetchall()
+        total = sum(size for _, size in rows)
+        removed = 0
+        for key, size in rows:
+            if total <= budget:
+                break
+            with self._locked(key, blocking=False) as lock_file:
+                if lock_file is None:
+                    continue
+                shutil.rmtree(self._get_entry_folder(key), ignore_errors=True)
+                with self._lock:
+                    self._connection.execute(
+                        "DELETE FROM entries WHERE key = ?", (key,)
+                    )
+                    self._connection.commit()
+                    self.stats.evictions += 1
+                # processes waiting on the removed lock file notice it, see _locked
+                os.remove(self._get_lock_path(key))
+            total -= size
+            removed += size
+        return removed
+
+    def clear(self) -> int:
+        """Removes all entries that are not pinned, and returns the number of bytes removed."""
+        return self.evict(budget=0)
+
+    def _fetch(self, key: str, source: Path, strategy: str) -> Tuple[Path, bool]:
+        """Returns the cached path of source, and whether it was copied into the cache."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT name FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+        if row is not None:
+            path = self._get_entry_folder(key) / row[0]
+            if os.path.lexists(path):
+                with self._lock:
+                    self._connection.execute(
+                        "UPDATE entries SET last_access = ?, hits = hits + 1 "
+                        "WHERE key = ?",
+                        (time.time(), key),
+                    )
+                    self._connection.commit()
+                    self.stats.hits += 1
+                return path, False
+
+        with self._lock:
+            self.stats.misses += 1
+        path = self._get_entry_folder(key) / source.name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        transfer(source, path, strategy)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, source.name, _get_size(path), time.time(), 1),
+            )
+            self._connection.commit()
+        return path, True
+
+    def _get_entry_folder(self, key: str) -> Path:
+        return self._cache_folder / "objects" / key[:2] / key
+
+    def _get_lock_path(self, key: str) -> str:
+        return str(self._cache_folder / "locks" / f"{key}.lock")
+
+    @contextmanager
+    def _locked(self, key: str, blocking: bool = True) -> Iterator[Optional[int]]:
+        """Holds an exclusive lock on an entry; yields None if not blocking and the entry is locked."""
+        while True:
+            lock_file = os.open(self._get_lock_path(key), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if not _flock(lock_file, blocking=blocking):
+                    os.close(lock_file)
+                    yield None
+                    return
+                if self._holds(lock_file, key):
+                    break
+            except BaseException:
+                os.close(lock_file)
+                raise
+            # the lock file was removed by an eviction while waiting for it
+            os.close(lock_file)
+        try:
+            yield lock_file
+        finally:
+            os.close(lock_file)
+
+    def _holds(self, lock_file: int, key: str) -> bool:
+        """Whether lock_file is still the lock file of the entry, i.e., it was not evicted."""
+        if fcntl is None:
+            return True
+        try:
+            path_stat = os.stat(self._get_lock_path(key))
+        except FileNotFoundError:
+            return False
+        return os.path.samestat(path_stat, os.fstat(lock_file))
+
+
+def _flock(lock_file: int, shared: bool = False, blocking: bool = True) -> bool:
+    if fcntl is None:
+        return True
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    try:
+        fcntl.flock(lock_file, operation if blocking else operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def _get_size(path: Path) -> int:
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
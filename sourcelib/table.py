@@ -0,0 +1,254 @@
+import os
+from array import array
+from enum import Enum
+from itertools import compress, repeat
+from operator import and_
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+from sourcelib.file import File
+from sourcelib.scan import get_suffix_lengths, match_suffix
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class StringPool:
+    """Stores every distinct string once and refers to it by an integer code.
+
+    Examples:
+        >>> pool = StringPool()
+        >>> pool.encode("slide")
+        0
+        >>> pool.decode(0)
+        'slide'
+    """
+
+    def __init__(self):
+        self._strings: List[str] = []
+        self._codes: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._strings)
+
+    def encode(self, string: str) -> int:
+        code = self._codes.get(string)
+        if code is None:
+            code = self._codes[string] = len(self._strings)
+            self._strings.append(string)
+        return code
+
+    def get_code(self, string: str) -> Optional[int]:
+        return self._codes.get(string)
+
+    def decode(self, code: int) -> str:
+        return self._strings[code]
+
+
+class FileTable:
+    """Column-oriented table of files, backed by integer arrays and a string pool.
+
+    String columns (folder, name, stem, suffix, identifier and key) are stored as codes
+    into one StringPool, so a filter or group by compares integers instead of strings
+    and a million rows cost a few arrays instead of a million objects. With numpy, filter
+    and take work on whole columns at once. The stem is the
+    name without the longest matching suffix of File.EXTENSIONS (e.g., 'a' for
+    'a.ome.tif'), the key is the association key (empty if the row is not associated),
+    and size is -1 when unknown.
+
+    Examples:
+        >>> table = get_files_from_folder(ImageFile, "/data", as_table=True)
+        >>> tifs = table.filter(suffix=".tif")
+        >>> groups = tifs.group_by("stem")
+        >>> files = groups["slide_1"].to_files()
+    """
+
+    STRING_COLUMNS = ("folder", "name", "stem", "suffix", "identifier", "key")
+
+    def __init__(self, pool: Optional[StringPool] = None):
+        self._pool = StringPool() if pool is None else pool
+        self._columns = {column: array("l") for column in self.STRING_COLUMNS}
+        self._sizes = array("q")
+        self._file_classes: List[type] = []
+        self._modes: List[Enum] = []
+        self._file_class_codes = array("l")
+        self._mode_codes = array("l")
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    @classmethod
+    def from_files(
+        cls, files: Iterable[File], keys: Optional[Iterable[str]] = None
+    ) -> "FileTable":
+        table = cls()
+        for file, key in zip(files, repeat(None) if keys is None else keys):
+            table.append_file(file, key)
+        return table
+
+    @classmethod
+    def from_associations(cls, associations) -> "FileTable":
+        table = cls()
+        for key, associated_files in associations.items():
+            for identifier_files in associated_files.values():
+                for file in identifier_files:
+                    table.append_file(file, key)
+        return table
+
+    def append_file(
+        self, file: File, key: Optional[str] = None, size: int = -1
+    ) -> None:
+        self.append_path(type(file), file.mode, str(file.path), key, size)
+
+    def append_path(
+        self,
+        file_cls: type,
+        mode: Enum,
+        path: Union[str, Path],
+        key: Optional[str] = None,
+        size: int = -1,
+    ) -> None:
+        folder, name = os.path.split(str(Path(path).absolute()))
+        suffix = match_suffix(
+            name, file_cls.EXTENSIONS, get_suffix_lengths(file_cls.EXTENSIONS)
+        )
+        if suffix is None:
+            suffix = Path(name).suffix
+        stem = name[: len(name) - len(suffix)] if suffix else name
+
+        encode = self._pool.encode
+        columns = self._columns
+        columns["folder"].append(encode(folder))
+        columns["name"].append(encode(name))
+        columns["stem"].append(encode(stem))
+        columns["suffix"].append(encode(suffix))
+        columns["identifier"].append(encode(file_cls.IDENTIFIER))
+        columns["key"].append(encode("" if key is None else str(key)))
+        self._sizes.append(size)
+        self._file_class_codes.append(_get_object_code(self._file_classes, file_cls))
+        self._mode_codes.append(_get_object_code(self._modes, mode))
+
+    def column(self, column: str) -> list:
+        """Returns the values of a column: one of STRING_COLUMNS, 'path', 'size', 'file_cls' or 'mode'."""
+        if column == "path":
+            return [
+                os.path.join(folder, name)
+                for folder, name in zip(self.column("folder"), self.column("name"))
+            ]
+        if column == "size":
+            return list(self._sizes)
+        if column == "file_cls":
+            return [self._file_classes[code] for code in self._file_class_codes]
+        if column == "mode":
+            return [self._modes[code] for code in self._mode_codes]
+        decode = self._pool.decode
+        return [decode(code) for code in self._columns[column]]
+
+    def filter(self, min_size: Optional[int] = None, **conditions) -> "FileTable":
+        """Selects the rows whose columns equal (or are in) the given values.
+
+        Args:
+            min_size (Optional[int], optional): Only keep rows of at least this size. Defaults to None.
+            **conditions: Column names of STRING_COLUMNS with a string or a collection of strings.
+
+        Returns:
+            FileTable: A table with the selected rows.
+
+        Examples:
+            >>> table.filter(suffix=(".tif", ".svs"), identifier="image")
+        """
+        selected = {}
+        for column, values in conditions.items():
+            values = (values,) if isinstance(values, str) else values
+            selected[column] = {self._pool.get_code(value) for value in values} - {None}
+
+        if numpy is not None:
+            mask = numpy.ones(len(self), dtype=bool)
+            for column, codes in selected.items():
+                mask &= numpy.isin(_as_numpy(self._columns[column]), list(codes))
+            if min_size is not None:
+                mask &= _as_numpy(self._sizes) >= min_size
+            return self.take(numpy.flatnonzero(mask))
+
+        # a lazy mask over all conditions, evaluated in one pass without Python code per row
+        masks = [
+            map(codes.__contains__, self._columns[column])
+            for column, codes in selected.items()
+        ]
+        if min_size is not None:
+            masks.append(map(min_size.__le__, self._sizes))
+        mask = masks[0] if masks else repeat(True, len(self))
+        for other_mask in masks[1:]:
+            mask = map(and_, mask, other_mask)
+        return self.take(list(compress(range(len(self)), mask)))
+
+    def group_by(self, column: str) -> Dict[str, "FileTable"]:
+        """Splits the table by the values of one of STRING_COLUMNS, in order of first appearance."""
+        groups: Dict[int, List[int]] = {}
+        for index, code in enumerate(self._columns[column]):
+            groups.setdefault(code, []).append(index)
+        return {
+            self._pool.decode(code): self.take(indices)
+            for code, indices in groups.items()
+        }
+
+    def take(self, indices: Sequence[int]) -> "FileTable":
+        """Returns a table with the given rows, sharing the string pool."""
+        if numpy is not None:
+            indices = numpy.asarray(indices, dtype=numpy.intp)
+        table = FileTable(self._pool)
+        for column, codes in self._columns.items():
+            table._columns[column] = _take(codes, indices)
+        table._sizes = _take(self._sizes, indices)
+        table._file_classes = self._file_classes
+        table._modes = self._modes
+        table._file_class_codes = _take(self._file_class_codes, indices)
+        table._mode_codes = _take(self._mode_codes, indices)
+        return table
+
+    def to_files(self, **kwargs) -> List[File]:
+        """Creates a File for every row; kwargs are passed to every file class."""
+        return [
+            file_cls(mode=mode, path=path, **kwargs)
+            for file_cls, mode, path in zip(
+                self.column("file_cls"), self.column("mode"), self.column("path")
+            )
+        ]
+
+    def to_associations(self):
+        """Groups the files by the key column into sourcelib.associations.Associations."""
+        # imported here, because sourcelib.associations imports this module
+        from sourcelib.associations import Associations
+
+        associations = Associations()
+        for key, file in zip(self.column("key"), self.to_files()):
+            associations.add_file_key(file_key=key, mode=file.mode)
+            associations.add_file_with_key(file_key=key, file=file)
+        return associations
+
+
+def _as_numpy(values: array):
+    """Returns a numpy view of an integer array, without copying it."""
+    dtype = numpy.dtype(f"i{values.itemsize}")
+    if not len(values):
+        return numpy.empty(0, dtype=dtype)
+    return numpy.frombuffer(values, dtype=dtype)
+
+
+def _take(values: array, indices) -> array:
+    """Returns the values at indices, a numpy array of indices when numpy is available."""
+    if numpy is None:
+        return array(values.typecode, map(values.__getitem__, indices))
+    taken = array(values.typecode)
+    taken.frombytes(_as_numpy(values)[indices].tobytes())
+    return taken
+
+
+def _get_object_code(objects: list, obj) -> int:
+    for code, existing in enumerate(objects):
+        if existing is obj:
+            return code
+    objects.append(obj)
+    return len(objects) - 1
@@ -0,0 +1,459 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import stat
+import struct
+import sys
+import threading
+import time
+from enum import Enum
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from sourcelib.associations import AssociatedFiles, Associations
+from sourcelib.associators import stem_file_associater
+from sourcelib.file import File, FileMode
+from sourcelib.matcher import PathMatcher
+from sourcelib.scan import get_suffix_lengths, list_directory, match_suffix
+
+# inotify(7) constants
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_Q_OVERFLOW = 0x4000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_IN_ISDIR = 0x40000000
+_WATCH_MASK = (
+    _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+    | _IN_DELETE_SELF
+    | _IN_MOVE_SELF
+)
+_EVENT_HEADER = struct.Struct("iIII")
+
+# Returned by a backend when events were lost and the folder needs a full rescan.
+RESCAN = object()
+
+# Coarsest directory mtime resolution of common file systems (FAT has 2 seconds).
+MTIME_TICK_NS = 2_000_000_000
+
+
+class InotifyBackend:
+    """Reports changed paths with Linux inotify, through the C library (no dependencies).
+
+    A created file is reported once it is closed after writing, not when it is
+    created, so files are not picked up while they are still being written. Files
+    moved into a watched folder are reported right away.
+
+    Raises:
+        OSError: If inotify is not available.
+    """
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available in the C library")
+        self._libc = libc
+        self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._folders: Dict[int, str] = {}
+        self._writing: Set[str] = set()
+
+    def add_folder(self, folder: str) -> None:
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(folder), ctypes.c_uint32(_WATCH_MASK)
+        )
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return
+            if error == errno.ENOSPC:
+                raise OSError(
+                    error,
+                    "inotify watch limit reached, raise fs.inotify.max_user_watches "
+                    "or use polling",
+                )
+            raise OSError(error, os.strerror(error), folder)
+        self._folders[wd] = folder
+
+    def read(self, timeout: float) -> list:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                paths.append(RESCAN)
+                continue
+            folder = self._folders.get(wd)
+            if folder is None:
+                continue
+            if mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+                del self._folders[wd]
+                paths.append(folder)
+            elif name:
+                path = os.path.join(folder, os.fsdecode(name))
+                if (
+                    mask & _IN_CREATE
+                    and not mask & _IN_ISDIR
+                    and not os.path.islink(path)
+                ):
+                    # reported on _IN_CLOSE_WRITE
+                    self._writing.add(path)
+                    continue
+                self._writing.discard(path)
+                paths.append(path)
+        return paths
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class PollingBackend:
+    """Reports changed paths by comparing directory listings when a directory mtime changes.
+
+    Every poll costs one stat per watched directory; only changed directories are
+    listed. A change in the same mtime tick as a listing does not change the mtime
+    again, so a directory is listed on every poll until it was listed at least one
+    tick (MTIME_TICK_NS) after its mtime. A new file is reported once its size and
+    mtime did not change between two polls, so files are not picked up while they
+    are still being written.
+
+    Args:
+        interval (float, optional): Seconds between polls. Defaults to 5.0.
+    """
+
+    def __init__(self, interval: float = 5.0):
+        self._interval = interval
+        self._folders: Dict[str, tuple] = {}
+        # new paths and their (size, mtime_ns) at the previous poll
+        self._pending: Dict[str, Optional[tuple]] = {}
+        self._next_poll = time.monotonic() + interval
+
+    def add_folder(self, folder: str) -> None:
+        try:
+            self._folders[folder] = _list_folder(folder)
+        except OSError:
+            return
+
+    def read(self, timeout: float) -> list:
+        wait = self._next_poll - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+        self._next_poll = time.monotonic() + self._interval
+        return self.poll()
+
+    def poll(self) -> list:
+        paths = []
+        for folder, (mtime_ns, names, settled) in list(self._folders.items()):
+            try:
+                if settled and os.stat(folder).st_mtime_ns == mtime_ns:
+                    continue
+                listing = _list_folder(folder)
+            except OSError:
+                del self._folders[folder]
+                paths.append(folder)
+                continue
+            self._folders[folder] = listing
+            for name in listing[1] - names:
+                self._pending[os.path.join(folder, name)] = None
+            for name in names - listing[1]:
+                path = os.path.join(folder, name)
+                self._pending.pop(path, None)
+                paths.append(path)
+        paths.extend(self._pop_stable())
+        return paths
+
+    def close(self) -> None:
+        self._folders.clear()
+        self._pending.clear()
+
+    def _pop_stable(self) -> Iterator[str]:
+        """Yields the new paths that did not change since the previous poll."""
+        for path, previous in list(self._pending.items()):
+            try:
+                path_stat = os.lstat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            current = (path_stat.st_size, path_stat.st_mtime_ns)
+            if current == previous or stat.S_ISDIR(path_stat.st_mode):
+                del self._pending[path]
+                yield path
+            else:
+                self._pending[path] = current
+
+
+def _list_folder(folder: str) -> Tuple[int, Set[str], bool]:
+    """Returns the mtime and names of a folder, and whether the mtime tick had passed."""
+    listed_ns = time.time_ns()
+    names = set(os.listdir(folder))
+    # stat after listing, so a change after the stat always changes the mtime
+    mtime_ns = os.stat(folder).st_mtime_ns
+    return mtime_ns, names, listed_ns - mtime_ns >= MTIME_TICK_NS
+
+
+class AssociationWatcher:
+    """Keeps the files in a folder and their Associations up to date as files come and go.
+
+    The folder is scanned once, after which only changed paths are processed, as
+    reported by inotify on Linux or by polling directory mtimes elsewhere. Changes are
+    debounced: they are applied once no new change arrived for debounce seconds, so a
+    burst of files (e.g., a scanner writing a slide and its companion files) is applied
+    at once. Files are added with Associations.add_files and removed with
+    Associations.remove_files, so an update only costs the changed files. New files
+    are only added once they are completely written (see InotifyBackend and
+    PollingBackend).
+
+    Files of file_cls1 that pass filters1/excludes1 create association keys, files of
+    file_cls2 that pass filters2/excludes2 are associated with them, as in
+    associate_files. on_complete is also called for the associations that are
+    complete in the initial scan. Callbacks are called from the thread that applies
+    the changes (the watcher thread after start()). Hold lock while reading
+    associations or files from another thread.
+
+    Args:
+        folder (Union[str, Path]): The folder to watch.
+        file_cls1 (File): The class of the files that create association keys.
+        file_cls2 (Optional[File], optional): The class of the associated files. Defaults to None (file_cls1).
+        mode (Enum, optional): The mode of the files. Defaults to FileMode.default.
+        filters1 (tuple, optional): Filters for the files that create association keys, see sourcelib.matcher. Defaults to ().
+        excludes1 (tuple, optional): Excludes for the files that create association keys. Defaults to ().
+        filters2 (tuple, optional): Filters for the associated files. Defaults to ().
+        excludes2 (tuple, optional): Excludes for the associated files. Defaults to ().
+        recursive (bool, optional): Whether to watch subfolders. Defaults to True.
+        associator (Callable, optional): The function used to determine associations. Defaults to stem_file_associater.
+        exact_match (bool, optional): Flag to determine if exact matches are required. Defaults to False.
+        on_complete (Optional[Callable[[str, AssociatedFiles], None]], optional): Called when a key gets its partner. Defaults to None.
+        on_incomplete (Optional[Callable[[str], None]], optional): Called when a key loses its partner or is dropped. Defaults to None.
+        debounce (float, optional): Seconds without changes before changes are applied. Defaults to 1.0.
+        poll_interval (float, optional): Seconds between polls when polling. Defaults to 5.0.
+        use_inotify (Optional[bool], optional): Whether to use inotify. Defaults to None (when available).
+
+    Examples:
+        >>> def on_complete(file_key, associated_files):
+        ...     queue.put(file_key)
+        >>> watcher = AssociationWatcher("/scanner/output", ImageFile, AnnotationFile, on_complete=on_complete)
+        >>> watcher.start()
+        >>> ...
+        >>> watcher.stop()
+    """
+
+    def __init__(
+        self,
+        folder: Union[str, Path],
+        file_cls1: File,
+        file_cls2: Optional[File] = None,
+        mode: Enum = FileMode.default,
+        filters1=(),
+        excludes1=(),
+        filters2=(),
+        excludes2=(),
+        recursive: bool = True,
+        associator: Callable = stem_file_associater,
+        exact_match: bool = False,
+        on_complete: Optional[Callable[[str, AssociatedFiles], None]] = None,
+        on_incomplete: Optional[Callable[[str], None]] = None,
+        debounce: float = 1.0,
+        poll_interval: float = 5.0,
+        use_inotify: Optional[bool] = None,
+    ):
+        self._folder = os.path.abspath(os.path.expanduser(str(folder)))
+        self._mode = mode
+        self._roles = (
+            (file_cls1, PathMatcher(filters1, excludes1)),
+            (
+                file_cls1 if file_cls2 is None else file_cls2,
+                PathMatcher(filters2, excludes2),
+            ),
+        )
+        self._suffixes = {
+            suffix: None
+            for file_cls, _ in self._roles
+            for suffix in file_cls.EXTENSIONS
+        }
+        self._suffix_lengths = get_suffix_lengths(self._suffixes)
+        self._recursive = recursive
+        self._associator = associator
+        self._exact_match = exact_match
+        self._on_complete = on_complete
+        self._on_incomplete = on_incomplete
+        self._debounce = debounce
+        self._backend = _create_backend(use_inotify, poll_interval)
+        self._files: Dict[str, File] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.lock = threading.RLock()
+        self.associations = Associations()
+        self._apply(set(self._scan(self._folder)), set())
+
+    def __enter__(self) -> "AssociationWatcher":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    @property
+    def files(self) -> List[File]:
+        """The watched files that exist, in order of arrival."""
+        with self.lock:
+            return list(self._files.values())
+
+    def start(self) -> None:
+        """Applies changes in a background thread until stop() is called."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._backend.close()
+
+    def run(self) -> None:
+        """Applies debounced changes until stop() is called, in the calling thread."""
+        changed = set()
+        first_change = last_change = 0.0
+        while not self._stop.is_set():
+            paths = self._backend.read(self._debounce if changed else 0.5)
+            now = time.monotonic()
+            if paths:
+                if not changed:
+                    first_change = now
+                changed.update(paths)
+                last_change = now
+            # a continuous stream of changes is applied at least every 10 debounces
+            if changed and (
+                now - last_change >= self._debounce
+                or now - first_change >= 10 * self._debounce
+            ):
+                self.apply(changed)
+                changed = set()
+
+    def poll(self, timeout: float = 0.0) -> None:
+        """Reads the changes that arrive within timeout and applies them, without debouncing."""
+        self.apply(self._backend.read(timeout))
+
+    def apply(self, paths) -> None:
+        """Applies changed paths: existing paths are added, missing paths are removed."""
+        added, removed = set(), set()
+        for path in paths:
+            if path is RESCAN:
+                scanned = set(self._scan(self._folder))
+                added |= scanned - self._files.keys()
+                removed |= self._files.keys() - scanned
+            elif os.path.isdir(path) and path not in self._files:
+                if self._recursive:
+                    added.update(self._scan(path))
+            elif os.path.lexists(path):
+                if path not in self._files:
+                    added.add(path)
+            elif path in self._files:
+                removed.add(path)
+            else:
+                # a removed folder
+                prefix = path + os.sep
+                removed.update(
+                    known for known in self._files if known.startswith(prefix)
+                )
+        self._apply(added - removed, removed)
+
+    def _apply(self, added: Set[str], removed: Set[str]) -> None:
+        new_files = {}
+        files = ([], [])
+        for path in sorted(added):
+            role = self._get_role(path)
+            if role is not None:
+                file_cls, _ = self._roles[role]
+                new_files[path] = file_cls(mode=self._mode, path=path)
+                files[role].append(new_files[path])
+        files1, files2 = files
+
+        with self.lock:
+            removed_files = [self._files.pop(path) for path in sorted(removed)]
+            incomplete = self.associations.remove_files(
+                removed_files, self._exact_match
+            )
+            self._files.update(new_files)
+            completed = self.associations.add_files(
+                files1, files2, self._associator, self._exact_match
+            )
+            incomplete = [
+                file_key for file_key in incomplete if file_key not in self.associations
+            ]
+            completed = [
+                (file_key, self.associations[file_key]) for file_key in completed
+            ]
+
+        # callbacks are called without the lock, so they can hand off to other threads
+        if self._on_incomplete is not None:
+            for file_key in incomplete:
+                self._on_incomplete(file_key)
+        if self._on_complete is not None:
+            for file_key, associated_files in completed:
+                self._on_complete(file_key, associated_files)
+
+    def _get_role(self, path: str) -> Optional[int]:
+        """Returns 0 for files that create keys, 1 for associated files, or None."""
+        name = os.path.basename(path)
+        for role, (file_cls, matcher) in enumerate(self._roles):
+            suffix_lengths = get_suffix_lengths(file_cls.EXTENSIONS)
+            if match_suffix(name, file_cls.EXTENSIONS, suffix_lengths) and matcher(
+                path
+            ):
+                return role
+        return None
+
+    def _scan(self, folder: str) -> Iterator[str]:
+        folders = [folder]
+        while folders:
+            folder = folders.pop()
+            # watch before listing, so no file that arrives in between is missed
+            self._backend.add_folder(folder)
+            matches, subfolders = list_directory(
+                folder, self._suffixes, self._suffix_lengths
+            )
+            for _, path in matches:
+                yield path
+            if self._recursive:
+                folders.extend(subfolders)
+
+
+def _create_backend(use_inotify: Optional[bool], poll_interval: float):
+    if use_inotify is False:
+        return PollingBackend(poll_interval)
+    try:
+        return InotifyBackend()
+    except OSError:
+        if use_inotify:
+            raise
+        return PollingBackend(poll_interval)
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+from pathlib import Path
+
+import sourcelib.aio
+from pytest import raises
+from sourcelib.aio import aiter_files_from_folder, aiter_files_from_yaml, copy_files
+from sourcelib.collect import NoSourceFilesInFolderError, get_files_from_folder
+from sourcelib.copy import NonExistingSourceFileError
+from sourcelib.staging import CopyScheduler
+
+from .testfiles.testclasses import DocumentFile
+
+
+async def _collect(async_iterator):
+    return [item async for item in async_iterator]
+
+
+def test_aiter_files_from_folder():
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    documents = asyncio.run(
+        _collect(
+            aiter_files_from_folder(
+                DocumentFile, folder, recursive=True, sort_buffer=10, batch_size=2
+            )
+        )
+    )
+    assert [document.path for document in documents] == sorted(
+        document.path
+        for document in get_files_from_folder(DocumentFile, folder, recursive=True)
+    )
+
+
+def test_aiter_files_from_folder_no_files():
+    with raises(NoSourceFilesInFolderError):
+        asyncio.run(
+            _collect(aiter_files_from_folder(DocumentFile, Path(__file__).parent))
+        )
+
+
+def test_aiter_files_from_yaml():
+    yaml_path = Path(__file__).parent / "testfiles" / "data.yml"
+    documents = asyncio.run(_collect(aiter_files_from_yaml(yaml_path, DocumentFile)))
+    assert len(documents) == 1
+
+
+def test_async_copy_files(tmp_path: Path):
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    documents = get_files_from_folder(DocumentFile, folder, recursive=True)
+    report = asyncio.run(copy_files(documents, tmp_path, concurrency=2))
+    assert report.transferred == len(documents) == 5
+    assert all(document.path.parent == tmp_path for document in documents)
+
+
+def test_async_copy_files_scheduler_limits(tmp_path: Path):
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    documents = get_files_from_folder(DocumentFile, folder, recursive=True)
+    scheduler = CopyScheduler(max_per_destination=1)
+    slots = scheduler.get_slots(tmp_path)
+
+    async def _copy():
+        # hold the only slot, so no copy is started until it is released
+        assert slots.acquire(blocking=False)
+        task = asyncio.ensure_future(
+            copy_files(documents, tmp_path, concurrency=2, scheduler=scheduler)
+        )
+        await asyncio.sleep(0.05)
+        assert not task.done() and not list(tmp_path.iterdir())
+        slots.release()
+        return await task
+
+    report = asyncio.run(_copy())
+    assert report.transferred == len(documents) == 5
+
+
+def test_async_copy_files_stops_after_error(tmp_path: Path):
+    folder = tmp_path / "data"
+    folder.mkdir()
+    for index in range(20):
+        (folder / f"{index:02d}.md").write_bytes(b"x" * 1000)
+    documents = get_files_from_folder(DocumentFile, folder)
+    (folder / "00.md").unlink()
+
+    async def _copy():
+        with raises(NonExistingSourceFileError):
+            await copy_files(documents, tmp_path / "out", concurrency=2)
+        copied = list((tmp_path / "out").iterdir())
+        await asyncio.sleep(0.1)
+        return copied, list((tmp_path / "out").iterdir())
+
+    copied, later = asyncio.run(_copy())
+    assert later == copied and len(copied) < 19
+
+
+def test_async_copy_files_schedules_in_executor(tmp_path: Path, monkeypatch):
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    documents = get_files_from_folder(DocumentFile, folder, recursive=True)
+    threads = []
+    get_copy_jobs = sourcelib.aio.get_copy_jobs
+
+    def _get_copy_jobs(*args):
+        threads.append(threading.current_thread())
+        return get_copy_jobs(*args)
+
+    monkeypatch.setattr(sourcelib.aio, "get_copy_jobs", _get_copy_jobs)
+    scheduler = CopyScheduler(max_per_destination=2)
+    report = asyncio.run(copy_files(documents, tmp_path, scheduler=scheduler))
+    assert report.transferred == 5
+    assert threads and threads[0] is not threading.main_thread()
@@ -1,15 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from pytest import raises, warns
-from sourcelib.associations import associate_files
+from sourcelib.associations import Associations, associate_files
 from sourcelib.associators import (
     AnyOneAssociater,
+    AssociaterCacheStats,
+    CachedAssociater,
     StemSplitterAssociater,
-    associate_files,
     stem_file_associater,
 )
 from sourcelib.collect import get_files_from_folder
-from sourcelib.file import ModeMisMatchError
+from sourcelib.file import FileMode, ModeMisMatchError
+from sourcelib.staging import copy_files
 
 from .testfiles.testclasses import DocumentFile, DocumentFileMode
 
@@ -127,3 +130,268 @@ def test_mode_mismatch_error():
         associate_files(
             files1=txt_files, files2=md_files, associator=AnyOneAssociater()
         )
+
+
+def test_associations_index_matches_first_inserted_key():
+    associations = Associations()
+    for file_key in ("p10", "p1", "x"):
+        associations.add_file_key(file_key=file_key, mode=FileMode.default)
+
+    file = DocumentFile(path=Path("p10_annotation.md"))
+    assert associations._associate(file, stem_file_associater, False) == "p10"
+    assert associations._associate(file, stem_file_associater, True) is None
+
+    del associations["p10"]
+    assert associations._associate(file, stem_file_associater, False) == "p1"
+
+    associations.add_file_key(file_key="p10", mode=FileMode.default)
+    assert associations._associate(file, stem_file_associater, False) == "p1"
+    assert associations.copy()._associate(file, stem_file_associater, False) == "p1"
+
+
+def test_associations_index_exact_match():
+    associations = Associations()
+    associations.add_file_key(file_key="p1", mode=FileMode.default)
+    assert (
+        associations._associate(
+            DocumentFile(path=Path("p1.md")), stem_file_associater, True
+        )
+        == "p1"
+    )
+
+
+def test_associate_files_sharded(tmp_path):
+    for index in range(20):
+        (tmp_path / f"doc_{index}.txt").touch()
+        (tmp_path / f"doc_{index}.md").touch()
+    txt_files = get_files_from_folder(
+        file_cls=DocumentFile, folder=tmp_path, filters=[".txt"]
+    )
+    md_files = get_files_from_folder(
+        file_cls=DocumentFile, folder=tmp_path, filters=[".md"]
+    )
+
+    all_keys = set(associate_files(files1=txt_files, files2=md_files, exact_match=True))
+    shard_keys = []
+    for index in range(4):
+        associations = associate_files(
+            files1=txt_files,
+            files2=md_files,
+            exact_match=True,
+            shard_index=index,
+            num_shards=4,
+        )
+        for files in associations.values():
+            assert len(files[DocumentFile.IDENTIFIER]) == 2
+        shard_keys.extend(associations)
+    assert sorted(shard_keys) == sorted(all_keys)
+
+
+def _get_association_paths(associations):
+    return {
+        file_key: sorted(
+            str(file.path) for files in associated_files.values() for file in files
+        )
+        for file_key, associated_files in associations.items()
+    }
+
+
+def test_associate_files_sharded_substring_keys(tmp_path):
+    (tmp_path / "ann").mkdir()
+    for name in ["slide_1", "slide_12"]:
+        (tmp_path / f"{name}.md").touch()
+        (tmp_path / "ann" / f"{name}.txt").touch()
+    md_files = get_files_from_folder(file_cls=DocumentFile, folder=tmp_path)
+    txt_files = get_files_from_folder(file_cls=DocumentFile, folder=tmp_path / "ann")
+
+    expected = _get_association_paths(associate_files(md_files, txt_files))
+    sharded = {}
+    for index in range(4):
+        associations = associate_files(
+            md_files, txt_files, shard_index=index, num_shards=4
+        )
+        for file_key, paths in _get_association_paths(associations).items():
+            assert file_key not in sharded
+            sharded[file_key] = paths
+    assert sharded == expected
+
+
+def test_associate_files_calls_associator_once():
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    files = get_files_from_folder(file_cls=DocumentFile, folder=folder)
+    calls = []
+
+    def counting_associater(file):
+        calls.append(file)
+        return stem_file_associater(file)
+
+    associate_files(files1=files, files2=files, associator=counting_associater)
+    assert len(calls) == 2 * len(files)
+
+
+def test_associate_files_with_workers():
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    txt_files = get_files_from_folder(
+        file_cls=DocumentFile, folder=folder, filters=[".txt"]
+    )
+    md_files = get_files_from_folder(
+        file_cls=DocumentFile, folder=folder, filters=[".md"], recursive=True
+    )
+    expected = associate_files(files1=txt_files, files2=md_files)
+    associations = associate_files(
+        files1=txt_files, files2=md_files, workers=2, chunksize=1
+    )
+    assert list(associations) == list(expected)
+    for file_key, files in associations.items():
+        assert [file.path for file in files[DocumentFile.IDENTIFIER]] == [
+            file.path for file in expected[file_key][DocumentFile.IDENTIFIER]
+        ]
+    with ThreadPoolExecutor(2) as executor:
+        associations = associate_files(
+            files1=txt_files, files2=md_files, executor=executor
+        )
+    assert list(associations) == list(expected)
+
+
+def test_stem_splitter_associater_splits_like_str_split():
+    associater = StemSplitterAssociater(split_symbols=("_", "-"))
+    for name in ("image_01-version.md", "image-01_version.md", "image.md", "-a_b.md"):
+        stem = Path(name).stem
+        expected = stem.split("_")[0].split("-")[0]
+        assert associater(DocumentFile(path=Path(name))) == expected
+
+
+def test_cached_associater(tmp_path):
+    calls = []
+
+    def counting_associater(file):
+        calls.append(file)
+        return stem_file_associater(file)
+
+    path = tmp_path / "p1.txt"
+    path.touch()
+    file = DocumentFile(path=path)
+    with CachedAssociater(
+        counting_associater, cache_folder=tmp_path / "cache", identity="counting"
+    ) as associater:
+        assert associater(file) == "p1"
+        assert associater(file) == "p1"
+    assert len(calls) == 1
+    assert associater.stats == AssociaterCacheStats(memory_hits=1, misses=1)
+
+    associater = CachedAssociater(
+        counting_associater, cache_folder=tmp_path / "cache", identity="counting"
+    )
+    assert associater(file) == "p1"
+    assert len(calls) == 1
+    assert associater.stats.persistent_hits == 1
+
+    path.write_text("changed")
+    associater = CachedAssociater(
+        counting_associater, cache_folder=tmp_path / "cache", identity="counting"
+    )
+    assert associater(file) == "p1"
+    assert len(calls) == 2
+    associater.close()
+
+
+def test_cached_associater_requires_unique_identity(tmp_path):
+    for associater in [lambda file: file.stem, AnyOneAssociater()]:
+        CachedAssociater(associater)
+    with raises(ValueError):
+        CachedAssociater(lambda file: file.stem, cache_folder=tmp_path)
+
+    def nested_associater(file):
+        return file.stem
+
+    with raises(ValueError):
+        CachedAssociater(nested_associater, cache_folder=tmp_path)
+    CachedAssociater(nested_associater, cache_folder=tmp_path, identity="stem").close()
+
+
+def test_cached_associater_with_workers(tmp_path):
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    files = get_files_from_folder(file_cls=DocumentFile, folder=folder, recursive=True)
+    with CachedAssociater(stem_file_associater, cache_folder=tmp_path) as associater:
+        associate_files(files[:2], files[2:], associator=associater, workers=2)
+    # the keys computed in the worker processes were written to the persistent cache
+    with CachedAssociater(stem_file_associater, cache_folder=tmp_path) as associater:
+        for file in files:
+            associater(file)
+        assert associater.stats.persistent_hits == len(files)
+
+
+def test_associations_add_and_remove_files(tmp_path):
+    def get_file(name):
+        return DocumentFile(path=tmp_path / name)
+
+    associations = Associations()
+    assert associations.add_files(files1=[get_file("x.txt"), get_file("y.txt")]) == []
+    assert len(associations) == 0
+    assert set(associations.pending) == {"x", "y"}
+
+    orphan = get_file("z_annotation.md")
+    assert associations.add_files(files2=[get_file("x_annotation.md"), orphan]) == ["x"]
+    assert list(associations) == ["x"]
+    assert associations.add_files(files1=[get_file("z.txt")]) == ["z"]
+    assert associations["z"][DocumentFile.IDENTIFIER][-1] is orphan
+
+    assert associations.remove_files([orphan]) == ["z"]
+    assert list(associations) == ["x"]
+    assert set(associations.pending) == {"y", "z"}
+
+    assert associations.remove_files([get_file("x.txt")]) == ["x"]
+    assert len(associations) == 0
+    assert set(associations.pending) == {"y", "z"}
+    assert associations.add_files(files1=[get_file("x.txt")]) == ["x"]
+
+
+def test_associations_exact_match_adopts_equal_orphans(tmp_path):
+    def get_file(name):
+        return DocumentFile(path=tmp_path / name)
+
+    associations = Associations()
+    orphans = [get_file("a.md"), get_file("ab.md")]
+    associations.add_files(files2=orphans, exact_match=True)
+    assert associations.add_files(files1=[get_file("a.txt")], exact_match=True) == ["a"]
+    assert associations["a"][DocumentFile.IDENTIFIER][-1] is orphans[0]
+
+    # a new File is matched by path
+    assert associations.remove_files([get_file("ab.md")], exact_match=True) == []
+    assert associations.add_files(files1=[get_file("ab.txt")], exact_match=True) == []
+    assert set(associations.pending) == {"ab"}
+
+
+def test_associations_remove_copied_files(tmp_path):
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    associations = associate_files(
+        get_files_from_folder(file_cls=DocumentFile, folder=folder),
+        get_files_from_folder(file_cls=DocumentFile, folder=folder / "md"),
+        exact_match=True,
+    )
+    copy_files(associations, tmp_path, verbose=False)
+    p1_files = list(associations["p1"][DocumentFile.IDENTIFIER])
+    assert all(file.path.parent == tmp_path for file in p1_files)
+
+    assert associations.remove_files([p1_files[1]]) == ["p1"]
+    assert list(associations) == ["p2"]
+    assert set(associations.pending) == {"p1"}
+    assert associations.remove_files([p1_files[0]]) == ["p1"]
+    assert associations.pending == {}
+
+
+def test_associate_files_keeps_unpaired_keys_pending():
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    txt_files = get_files_from_folder(
+        file_cls=DocumentFile, folder=folder, filters=[".txt"]
+    )
+    md_files = get_files_from_folder(
+        file_cls=DocumentFile, folder=folder, filters=[".md"], recursive=True
+    )
+    with warns(UserWarning):
+        associations = associate_files(files1=txt_files, files2=md_files[:1])
+    assert len(associations) == 1
+    assert len(associations.pending) == 1
+    pending = list(associations.pending)
+    assert associations.add_files(files2=md_files[1:]) == pending
+    assert len(associations) == 2
@@ -1,5 +1,7 @@
+import os
 from pathlib import Path
 
+import pytest
 import yaml
 from pytest import raises
 from sourcelib.collect import (
@@ -9,10 +11,27 @@ from sourcelib.collect import (
     get_files_from_path,
     get_files_from_yaml,
     get_associations_from_yaml,
+    iter_associations_from_yaml,
+    iter_files_from_folder,
+    iter_files_from_yaml,
 )
-from sourcelib.file import FileMode
+from sourcelib.extension import Extension, create_extensions_mapping
+from sourcelib.file import FileMode, generate_file_class
+from sourcelib.manifest import (
+    SIDECAR_SUFFIX,
+    ManifestFormat,
+    clear_manifest_cache,
+    export_associations,
+    get_manifest_format,
+    iter_manifest_entries,
+    load_manifest,
+    write_manifest,
+)
+from sourcelib.matcher import PathMatcher
+from sourcelib.scan import iter_scan_folder
+from sourcelib.scancache import ScanCache, ScanCacheStats
 
-from .testfiles.testclasses import DocumentFile, DocumentFileMode
+from .testfiles.testclasses import DOCUMENT_EXTENSIONS, DocumentFile, DocumentFileMode
 
 
 def test_collect_by_path():
@@ -102,3 +121,319 @@ def test_collect_associations_from_yaml_source():
     assert len(associations) == 1
     assert list(associations.keys())[0] == "0"
     assert isinstance(associations["0"][DocumentFile.IDENTIFIER][0], DocumentFile)
+
+
+def test_collect_by_folder_single_pass_multipart_suffix(tmp_path: Path):
+    image_extensions = create_extensions_mapping(
+        [Extension((".tif",)), Extension((".ome.tif",))]
+    )
+    ImageFile = generate_file_class("image", image_extensions)
+    (tmp_path / "nested").mkdir()
+    for name in ("b.tif", "a.ome.tif", "nested/c.tif", "nested/d.txt"):
+        (tmp_path / name).touch()
+
+    images = get_files_from_folder(file_cls=ImageFile, folder=tmp_path)
+    assert [image.path.name for image in images] == ["b.tif", "a.ome.tif"]
+
+    images = get_files_from_folder(file_cls=ImageFile, folder=tmp_path, recursive=True)
+    assert [image.path.name for image in images] == ["b.tif", "c.tif", "a.ome.tif"]
+    assert images[-1]._extension.suffixes == (".ome.tif",)
+
+
+def test_collect_by_folder_parallel_matches_serial(tmp_path: Path):
+    for folder_index in range(5):
+        for subfolder_index in range(3):
+            folder = tmp_path / str(folder_index) / str(subfolder_index)
+            folder.mkdir(parents=True)
+            for file_index in range(4):
+                (folder / f"{file_index}.txt").touch()
+                (folder / f"{file_index}.md").touch()
+
+    serial = get_files_from_folder(
+        file_cls=DocumentFile, folder=tmp_path, recursive=True
+    )
+    parallel = get_files_from_folder(
+        file_cls=DocumentFile, folder=tmp_path, recursive=True, workers=3
+    )
+    assert len(serial) == 120
+    assert [file.path for file in parallel] == [file.path for file in serial]
+    assert list(iter_scan_folder(tmp_path, DOCUMENT_EXTENSIONS, True, 3)) == list(
+        iter_scan_folder(tmp_path, DOCUMENT_EXTENSIONS, True)
+    )
+
+
+def test_iter_files_from_folder():
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    documents = iter_files_from_folder(
+        file_cls=DocumentFile, folder=folder, recursive=True, sort_buffer=10
+    )
+    assert isinstance(next(documents), DocumentFile)
+    assert [document.path for document in documents] == [
+        folder / "md" / "p2.md",
+        folder / "md" / "p3.md",
+        folder / "p1.txt",
+        folder / "p2.txt",
+    ]
+
+
+def test_iter_files_from_folder_no_files():
+    with raises(NoSourceFilesInFolderError):
+        list(iter_files_from_folder(file_cls=DocumentFile, folder=Path(__file__).parent))
+
+
+def test_iter_files_from_yaml(tmp_path: Path):
+    test_path = Path(__file__).parent / "testfiles" / "test.md"
+    manifest_path = write_manifest(
+        tmp_path / "manifest.yml", {"default": [{"doc": {"path": str(test_path)}}]}
+    )
+    for yaml_source in [manifest_path, load_manifest(manifest_path)]:
+        documents = list(
+            iter_files_from_yaml(yaml_source=yaml_source, file_cls=DocumentFile)
+        )
+        assert [str(document.path) for document in documents] == [str(test_path)]
+
+
+def test_collect_by_folder_with_scan_cache(tmp_path: Path):
+    folder = tmp_path / "data"
+    (folder / "sub").mkdir(parents=True)
+    (folder / "p1.txt").touch()
+    (folder / "sub" / "p2.md").touch()
+    for directory in (folder, folder / "sub"):
+        os.utime(directory, (0, 0))
+
+    cache = ScanCache(tmp_path / "cache")
+    cold = get_files_from_folder(
+        file_cls=DocumentFile, folder=folder, recursive=True, cache=cache
+    )
+    assert cache.stats == ScanCacheStats(hits=0, misses=2)
+
+    cache = ScanCache(tmp_path / "cache")
+    warm = get_files_from_folder(
+        file_cls=DocumentFile, folder=folder, recursive=True, cache=cache
+    )
+    assert cache.stats == ScanCacheStats(hits=2, misses=0)
+    assert [file.path for file in warm] == [file.path for file in cold]
+
+    (folder / "sub" / "p3.md").touch()
+    cache = ScanCache(tmp_path / "cache")
+    changed = get_files_from_folder(
+        file_cls=DocumentFile, folder=folder, recursive=True, cache=cache
+    )
+    assert cache.stats == ScanCacheStats(hits=1, misses=1)
+    assert len(changed) == 3
+
+
+def test_path_matcher():
+    paths = ["/data/a.tif", "/data/thumb_a.tif", "/data/thumb_keep.tif", "/data/b.xml"]
+    assert PathMatcher(filters=["*.tif"]).select(paths) == paths[:3]
+    assert PathMatcher(excludes=["thumb", "!keep"]).select(paths) == [
+        paths[0],
+        paths[2],
+        paths[3],
+    ]
+    assert PathMatcher(filters=["!thumb"]).select(paths) == [paths[0], paths[3]]
+    assert PathMatcher(filters=["a", "xml"], regex=r"\.xml$").select(paths) == [
+        paths[3]
+    ]
+
+
+def test_path_matcher_accepts_none():
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    assert PathMatcher(filters=None, excludes=None)("/data/a.tif")
+    files = get_files_from_folder(
+        file_cls=DocumentFile, folder=folder, filters=None, excludes=None
+    )
+    assert len(files) == 2
+
+
+def test_path_matcher_substrings_match_any():
+    patterns = ["_he_", "he_1", "slide", "ide_9", "e"]
+    paths = ["/x/slide_he_1.tif", "/x/other.tif", "/x/id_9", "/y/abc"]
+    for path in paths:
+        expected = any(pattern in path for pattern in patterns)
+        assert PathMatcher(filters=patterns)(path) == expected
+        assert PathMatcher(excludes=patterns)(path) != expected
+
+
+def test_collect_from_yaml_source_is_not_modified():
+    yaml_path = Path(__file__).parent / "testfiles" / "data.yml"
+    with open(yaml_path, encoding="utf-8") as file:
+        yaml_source = yaml.safe_load(file)
+    expected = yaml.safe_load(yaml.safe_dump(yaml_source))
+    get_files_from_yaml(yaml_source=yaml_source, file_cls=DocumentFile)
+    get_associations_from_yaml(
+        yaml_source=yaml_source, file_classes={"document": {"class": DocumentFile}}
+    )
+    assert yaml_source == expected
+
+
+def test_load_manifest_cache(tmp_path):
+    clear_manifest_cache()
+    manifest_path = tmp_path / "manifest.yml"
+    manifest_path.write_text("default:\n  - document: {path: a.txt}\n")
+    data = load_manifest(manifest_path)
+    assert load_manifest(manifest_path) is data
+
+    manifest_path.write_text("default:\n  - document: {path: b.txt}\n  - {}\n")
+    assert len(load_manifest(manifest_path)["default"]) == 2
+
+
+def test_load_manifest_sidecar(tmp_path):
+    clear_manifest_cache()
+    manifest_path = tmp_path / "manifest.yml"
+    manifest_path.write_text("default:\n  - document: {path: a.txt}\n")
+    data = load_manifest(manifest_path, use_cache=False, sidecar=True)
+    sidecar_path = tmp_path / ("manifest.yml" + SIDECAR_SUFFIX)
+    assert sidecar_path.exists()
+    assert load_manifest(manifest_path, use_cache=False, sidecar=True) == data
+
+    manifest_path.write_text("default: []\n")
+    assert load_manifest(manifest_path, use_cache=False, sidecar=True) == {
+        "default": []
+    }
+
+
+def test_iter_manifest_entries(tmp_path):
+    manifest_path = tmp_path / "manifest.yml"
+    manifest_path.write_text(
+        "base: &base {size: 1}\n"
+        "training:\n"
+        "  - document: {path: a.txt, <<: *base}\n"
+        "  - document: {path: b.txt}\n"
+        "validation:\n"
+        "  - document: {path: c.txt}\n"
+    )
+    expected = yaml.safe_load(manifest_path.read_text())
+    for mode_name in ("training", "validation"):
+        for seek in (True, False):
+            entries = list(iter_manifest_entries(manifest_path, mode_name, seek))
+            assert entries == expected[mode_name]
+    with raises(KeyError):
+        list(iter_manifest_entries(manifest_path, "test"))
+
+
+def test_iter_associations_from_yaml():
+    yaml_path = Path(__file__).parent / "testfiles" / "data.yml"
+    associations = list(
+        iter_associations_from_yaml(
+            yaml_source=yaml_path, file_classes={"document": {"class": DocumentFile}}
+        )
+    )
+    assert len(associations) == 1
+    file_key, associated_files = associations[0]
+    assert file_key == "0"
+    assert len(associated_files["doc"]) == 1
+    with raises(NonExistentModeInYamlSource):
+        list(
+            iter_associations_from_yaml(
+                yaml_source=yaml_path,
+                file_classes={"document": {"class": DocumentFile}},
+                mode=DocumentFileMode.error,
+            )
+        )
+
+
+@pytest.mark.parametrize("suffix", [".yml", ".jsonl", ".sqlite", ".parquet"])
+def test_manifest_formats(tmp_path, suffix):
+    if suffix == ".parquet":
+        pytest.importorskip("pyarrow")
+    yaml_path = Path(__file__).parent / "testfiles" / "data.yml"
+    data = {**load_manifest(yaml_path), "empty": []}
+    manifest_path = write_manifest(tmp_path / f"manifest{suffix}", data)
+    assert load_manifest(manifest_path, use_cache=False) == data
+    assert list(iter_manifest_entries(manifest_path, "empty")) == []
+
+    documents = get_files_from_yaml(yaml_source=manifest_path, file_cls=DocumentFile)
+    streamed = list(iter_files_from_yaml(yaml_source=manifest_path, file_cls=DocumentFile))
+    assert [document.path for document in documents] == [
+        document.path for document in streamed
+    ]
+    assert len(documents) == 1
+    with raises(NonExistentModeInYamlSource):
+        list(
+            iter_files_from_yaml(
+                yaml_source=manifest_path,
+                file_cls=DocumentFile,
+                mode=DocumentFileMode.error,
+            )
+        )
+
+
+def test_manifest_format_records(tmp_path):
+    with raises(TypeError):
+        ManifestFormat()
+    data = {"default": [{"document": {"path": "a.txt"}}], "empty": []}
+    for suffix in [".yml", ".jsonl", ".sqlite"]:
+        manifest_path = str(write_manifest(tmp_path / f"manifest{suffix}", data))
+        assert list(get_manifest_format(manifest_path).iter_records(manifest_path)) == [
+            ("default", {"document": {"path": "a.txt"}}),
+            ("empty", None),
+        ]
+
+
+def test_export_associations(tmp_path):
+    yaml_path = Path(__file__).parent / "testfiles" / "data.yml"
+    file_classes = {"document": {"class": DocumentFile}}
+    associations = get_associations_from_yaml(yaml_source=yaml_path, file_classes=file_classes)
+    manifest_path = export_associations(associations, tmp_path / "manifest.jsonl")
+    exported = get_associations_from_yaml(
+        yaml_source=manifest_path, file_classes=file_classes
+    )
+    assert [files["doc"][0].path for files in exported.values()] == [
+        files["doc"][0].path for files in associations.values()
+    ]
+
+    associations["0"]["doc"].append(associations["0"]["doc"][0])
+    with raises(ValueError):
+        export_associations(associations, tmp_path / "invalid.jsonl")
+
+
+def test_collect_by_folder_sharded(tmp_path):
+    for index in range(20):
+        (tmp_path / f"doc_{index}.txt").touch()
+        (tmp_path / f"doc_{index}.md").touch()
+    all_files = get_files_from_folder(file_cls=DocumentFile, folder=tmp_path)
+
+    shards = [
+        get_files_from_folder(
+            file_cls=DocumentFile, folder=tmp_path, shard_index=index, num_shards=3
+        )
+        for index in range(3)
+    ]
+    assert sorted(file.path for shard in shards for file in shard) == sorted(
+        file.path for file in all_files
+    )
+    for shard in shards:
+        stems = [file.path.stem for file in shard]
+        assert len(stems) == 2 * len(set(stems))
+
+    streamed = iter_files_from_folder(
+        file_cls=DocumentFile, folder=tmp_path, shard_index=1, num_shards=3
+    )
+    assert sorted(file.path for file in streamed) == sorted(
+        file.path for file in shards[1]
+    )
+    with raises(ValueError):
+        get_files_from_folder(file_cls=DocumentFile, folder=tmp_path, shard_index=3, num_shards=3)
+
+
+def test_collect_from_yaml_sharded():
+    data = {"default": [{"doc": {"path": f"/data/doc_{index}.txt"}} for index in range(20)]}
+    all_files = get_files_from_yaml(yaml_source=data, file_cls=DocumentFile)
+    shards = [
+        get_files_from_yaml(
+            yaml_source=data, file_cls=DocumentFile, shard_index=index, num_shards=4
+        )
+        for index in range(4)
+    ]
+    assert sorted(file.path for shard in shards for file in shard) == sorted(
+        file.path for file in all_files
+    )
+
+    file_classes = {"document": {"class": DocumentFile}}
+    associations = get_associations_from_yaml(
+        yaml_source=data, file_classes=file_classes, shard_index=2, num_shards=4
+    )
+    assert sorted(files["doc"][0].path for files in associations.values()) == [
+        file.path for file in shards[2]
+    ]
@@ -0,0 +1,95 @@
+import os
+from pathlib import Path
+
+from sourcelib.associations import Associations
+from sourcelib.dedup import deduplicate, deduplicate_associations, find_duplicates
+from sourcelib.file import FileMode
+
+from .testfiles.testclasses import DocumentFile
+
+
+def create_files(folder: Path, contents: dict):
+    folder.mkdir(parents=True, exist_ok=True)
+    files = []
+    for name, content in contents.items():
+        (folder / name).write_bytes(content)
+        files.append(DocumentFile(path=folder / name))
+    return files
+
+
+def test_find_duplicates(tmp_path: Path):
+    files = create_files(
+        tmp_path / "data",
+        {
+            "a.txt": b"0123456789",
+            "b.txt": b"0123456789",
+            "c.txt": b"9876543210",
+            "d.txt": b"0123xx6789",
+            "e.txt": b"0123yy6789",
+            "f.txt": b"short",
+        },
+    )
+    os.link(tmp_path / "data" / "f.txt", tmp_path / "data" / "g.txt")
+    files.append(DocumentFile(path=tmp_path / "data" / "g.txt"))
+
+    duplicates = find_duplicates(files, partial_size=4)
+    assert [[file.name for file in group] for group in duplicates] == [
+        ["a.txt", "b.txt"],
+        ["f.txt", "g.txt"],
+    ]
+
+
+def test_deduplicate_and_copy(tmp_path: Path):
+    files = create_files(
+        tmp_path / "data",
+        {"a.txt": b"content", "b.txt": b"content", "c.txt": b"other!!"},
+    )
+    assert [file.name for file in deduplicate(files, collapse=True)] == [
+        "a.txt",
+        "c.txt",
+    ]
+    assert files[1].duplicate_of is files[0]
+
+    for file in files:
+        file.copy(tmp_path / "copy")
+    copied_a = os.stat(tmp_path / "copy" / "a.txt")
+    copied_b = os.stat(tmp_path / "copy" / "b.txt")
+    assert (copied_a.st_dev, copied_a.st_ino) == (copied_b.st_dev, copied_b.st_ino)
+    assert (tmp_path / "copy" / "b.txt").read_bytes() == b"content"
+
+
+def test_deduplicate_associations(tmp_path: Path):
+    files = create_files(
+        tmp_path / "data",
+        {
+            "a.txt": b"slide",
+            "a.md": b"annotation",
+            "b.txt": b"slide",
+            "b.md": b"annotation",
+            "c.txt": b"slide",
+            "c.md": b"other annotation",
+        },
+    )
+    associations = Associations()
+    for file_key, key_files in (("a", files[:2]), ("b", files[2:4]), ("c", files[4:])):
+        associations.add_file_key(file_key=file_key, mode=FileMode.default)
+        for file in key_files:
+            associations.add_file_with_key(file_key=file_key, file=file)
+
+    deduplicate_associations(associations, collapse=True)
+    assert list(associations) == ["a", "c"]
+    assert files[4].duplicate_of is files[0]
+
+
+def test_deduplicate_and_copy_with_companions(tmp_path: Path):
+    files = create_files(tmp_path / "data", {"a.tpt": b"parts", "b.tpt": b"parts"})
+    for name in ["a", "b"]:
+        (tmp_path / "data" / name).mkdir()
+        (tmp_path / "data" / name / "p1.txt").write_bytes(name.encode())
+    deduplicate(files)
+
+    for file in files:
+        file.copy(tmp_path / "copy")
+    assert os.path.samefile(tmp_path / "copy" / "a.tpt", tmp_path / "copy" / "b.tpt")
+    assert (tmp_path / "copy" / "b" / "p1.txt").read_bytes() == b"b"
+    assert files[1].path == (tmp_path / "copy" / "b.tpt").resolve()
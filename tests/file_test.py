@@ -1,10 +1,30 @@
+import os
+import shutil
+import threading
+import time
 from pathlib import Path
 
-from pytest import raises
-from sourcelib.collect import copy_from_yml
-from sourcelib.copy import NonExistingSourceFileError
+import sourcelib.copy
+from pytest import mark, raises
+from sourcelib.associations import AssociatedFiles, associate_files
+from sourcelib.collect import copy_from_yml, get_files_from_folder
+from sourcelib.copy import (
+    PARTIAL_SUFFIX,
+    TRANSFER_STRATEGIES,
+    NonExistingSourceFileError,
+    is_complete,
+    transfer,
+)
 from sourcelib.extension import Extension, create_extensions_mapping
-from sourcelib.file import FileMode
+from sourcelib.file import FileMode, generate_file_class, prefetch_metadata
+import sourcelib.staging
+from sourcelib.staging import (
+    CopyReport,
+    CopyScheduler,
+    TokenBucket,
+    copy_files,
+    stage_associations,
+)
 
 from tests.testfiles.testclasses import DocumentFile
 
@@ -36,6 +56,48 @@ def test_copy_file_with_coupled_folder(tmp_path: Path):
     assert (tmp_path / tpt_path.with_suffix("")).is_dir()
 
 
+def test_file_metadata_is_cached(tmp_path: Path):
+    path = tmp_path / "test.md"
+    path.write_bytes(b"12345")
+    markdown_file = DocumentFile(path=path)
+    assert markdown_file.metadata is None and not markdown_file.is_known
+    assert markdown_file.exists and markdown_file.size == 5
+    assert markdown_file.mtime_ns == path.stat().st_mtime_ns
+
+    path.write_bytes(b"1234567")
+    assert markdown_file.size == 5
+    assert markdown_file.refresh() and markdown_file.size == 7
+
+    path.unlink()
+    assert markdown_file.exists
+    assert not markdown_file.refresh()
+    assert not markdown_file.exists and markdown_file.metadata is None
+    assert markdown_file.is_known
+    with raises(FileNotFoundError):
+        _ = markdown_file.size
+
+
+@mark.parametrize("workers", [1, 4])
+def test_prefetch_metadata(tmp_path: Path, workers: int):
+    for index in range(5):
+        (tmp_path / f"{index}.md").write_bytes(b"x" * index)
+    files = [DocumentFile(path=tmp_path / f"{index}.md") for index in range(6)]
+    assert prefetch_metadata(files, workers=workers) == files
+    assert [file.metadata is not None for file in files] == [True] * 5 + [False]
+    assert all(file.is_known for file in files)
+    assert [file.size for file in files[:5]] == list(range(5))
+    assert not files[5].exists
+
+
+def test_get_files_from_folder_with_stat(tmp_path: Path):
+    for index in range(3):
+        (tmp_path / f"{index}.md").write_bytes(b"x" * index)
+    files = get_files_from_folder(DocumentFile, tmp_path, with_stat=True)
+    assert [file.metadata.size for file in files] == [0, 1, 2]
+    table = get_files_from_folder(DocumentFile, tmp_path, with_stat=True, as_table=True)
+    assert table.column("size") == [0, 1, 2]
+
+
 def test_copy_error(tmp_path: Path):
     with raises(NonExistingSourceFileError):
         path = Path(__file__).parent / "testfiles" / "notexisting.txt"
@@ -58,3 +120,333 @@ def test_duplace_extension():
     with raises(ValueError):
         extension_txt = Extension(".txt")
         create_extensions_mapping([extension_txt, extension_txt])
+
+
+def test_copy_files(tmp_path: Path):
+    markdown_file = DocumentFile(path=Path(__file__).parent / "testfiles" / "test.md")
+    tpt_file = DocumentFile(path=Path(__file__).parent / "testfiles" / "testparts.tpt")
+
+    report = copy_files([markdown_file, tpt_file], tmp_path / "out", workers=2)
+    assert report.transferred == 3
+    assert report.bytes > 0
+    assert markdown_file.path == tmp_path / "out" / "test.md"
+    assert (tmp_path / "out" / "testparts" / "p1.txt").exists()
+
+    copies = [DocumentFile(path=Path(__file__).parent / "testfiles" / "test.md")]
+    report = copy_files(copies, tmp_path / "out", verbose=False)
+    assert report.skipped == 1 and report.transferred == 0
+
+
+def _get_testparts_associations():
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    return associate_files(
+        get_files_from_folder(file_cls=DocumentFile, folder=folder),
+        get_files_from_folder(file_cls=DocumentFile, folder=folder / "md"),
+        exact_match=True,
+    )
+
+
+def test_copy_files_from_associations(tmp_path: Path):
+    associations = _get_testparts_associations()
+    report = copy_files(associations, tmp_path, workers=4)
+    assert report.transferred == 4
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "p1.md",
+        "p1.txt",
+        "p2.md",
+        "p2.txt",
+    ]
+
+
+def test_stage_associations(tmp_path: Path):
+    associations = _get_testparts_associations()
+    report = CopyReport()
+    staged = dict(stage_associations(associations, tmp_path, workers=2, report=report))
+    assert sorted(staged) == ["p1", "p2"]
+    assert report.transferred == 4
+    for associated_files in staged.values():
+        for identifier_files in associated_files.values():
+            assert all(file.path.parent == tmp_path for file in identifier_files)
+
+
+def test_stage_associations_yields_complete_associations_first(
+    tmp_path: Path, monkeypatch
+):
+    associations = _get_testparts_associations()
+    release = threading.Event()
+    copy_file = sourcelib.staging._copy_file
+
+    def _copy_file(file, *args):
+        if file.name.startswith("p2"):
+            assert release.wait(5)
+        return copy_file(file, *args)
+
+    monkeypatch.setattr(sourcelib.staging, "_copy_file", _copy_file)
+    staged = stage_associations(associations, tmp_path, workers=4)
+    key, associated_files = next(staged)
+    assert key == "p1" and not (tmp_path / "p2.md").exists()
+    assert all(file.exists for files in associated_files.values() for file in files)
+    release.set()
+    assert [key for key, _ in staged] == ["p2"]
+
+
+def test_stage_associations_copies_companions_per_association(
+    tmp_path: Path, monkeypatch
+):
+    folder = tmp_path / "data"
+    for name in ["a", "b"]:
+        (folder / name).mkdir(parents=True)
+        (folder / name / "part.txt").write_text(name)
+        (folder / f"{name}.tpt").write_text(name)
+        (folder / f"{name}.md").write_text(name)
+    associations = associate_files(
+        get_files_from_folder(DocumentFile, folder, filters=[".tpt"]),
+        get_files_from_folder(DocumentFile, folder, filters=[".md"]),
+        exact_match=True,
+    )
+    release = threading.Event()
+    copy_companion = sourcelib.staging._copy_companion
+
+    def _copy_companion(path, *args):
+        if path.name == "b":
+            assert release.wait(5)
+        return copy_companion(path, *args)
+
+    monkeypatch.setattr(sourcelib.staging, "_copy_companion", _copy_companion)
+    staged = stage_associations(associations, tmp_path / "out", workers=1)
+    key, _ = next(staged)
+    assert key == "a" and (tmp_path / "out" / "a" / "part.txt").exists()
+    assert not (tmp_path / "out" / "b").exists()
+    release.set()
+    assert [key for key, _ in staged] == ["b"]
+
+
+def test_stage_associations_with_companions(tmp_path: Path):
+    tpt_file = DocumentFile(path=Path(__file__).parent / "testfiles" / "testparts.tpt")
+    associated_files = AssociatedFiles("testparts", FileMode.default)
+    associated_files.add_file(tpt_file)
+    scheduler = CopyScheduler("smallest", max_per_destination=1)
+    for _key, staged in stage_associations(
+        [("testparts", associated_files)], tmp_path, scheduler=scheduler
+    ):
+        assert (tmp_path / "testparts" / "p1.txt").exists()
+        assert staged["doc"][0].path == tmp_path / "testparts.tpt"
+
+
+def _record_copies(monkeypatch, copied: list) -> None:
+    copy_file = sourcelib.staging._copy_file
+
+    def _copy_file(file, *args):
+        copied.append(file.name)
+        return copy_file(file, *args)
+
+    monkeypatch.setattr(sourcelib.staging, "_copy_file", _copy_file)
+
+
+@mark.parametrize(
+    "order, expected",
+    [
+        ("largest", ["b.md", "c.md", "a.md"]),
+        ("smallest", ["a.md", "c.md", "b.md"]),
+        (None, ["a.md", "b.md", "c.md"]),
+    ],
+)
+def test_copy_files_scheduler_order(tmp_path: Path, monkeypatch, order, expected):
+    for name, size in [("a.md", 1), ("b.md", 30), ("c.md", 20)]:
+        (tmp_path / name).write_bytes(b"x" * size)
+    files = get_files_from_folder(DocumentFile, tmp_path, with_stat=True)
+    copied = []
+    _record_copies(monkeypatch, copied)
+    scheduler = CopyScheduler(order)
+    copy_files(files, tmp_path / "out", workers=1, verbose=False, scheduler=scheduler)
+    assert copied == expected
+
+
+def test_copy_files_scheduler_priorities(tmp_path: Path, monkeypatch):
+    AnnotationFile = generate_file_class("annotation.yml", DocumentFile.EXTENSIONS)
+    (tmp_path / "large.md").write_bytes(b"x" * 100)
+    (tmp_path / "small.txt").write_bytes(b"x")
+    files = [
+        DocumentFile(tmp_path / "large.md"),
+        AnnotationFile(tmp_path / "small.txt"),
+    ]
+    copied = []
+    _record_copies(monkeypatch, copied)
+    for priorities in [{"annotation": 1}, {AnnotationFile: 1}, {DocumentFile: -1}]:
+        copied.clear()
+        scheduler = CopyScheduler("largest", priorities)
+        copy_files(
+            files, tmp_path / "out", workers=1, verbose=False, scheduler=scheduler
+        )
+        assert copied == ["small.txt", "large.md"]
+
+
+def test_copy_files_scheduler_limits(tmp_path: Path, monkeypatch):
+    for index in range(6):
+        (tmp_path / f"{index}.md").write_bytes(os.urandom(1000))
+    files = get_files_from_folder(DocumentFile, tmp_path)
+    lock = threading.Lock()
+    running, maximum = [0], [0]
+    copy_file = sourcelib.staging._copy_file
+
+    def _copy_file(*args):
+        with lock:
+            running[0] += 1
+            maximum[0] = max(maximum[0], running[0])
+        try:
+            return copy_file(*args)
+        finally:
+            with lock:
+                running[0] -= 1
+
+    monkeypatch.setattr(sourcelib.staging, "_copy_file", _copy_file)
+    # 5000 bytes over the burst at 25000 bytes per second take at least 0.2 seconds
+    scheduler = CopyScheduler(max_per_destination=1, bandwidth=25_000, burst=1000)
+    report = copy_files(files, tmp_path / "out", workers=4, scheduler=scheduler)
+    assert maximum[0] == 1 and report.transferred == 6
+    assert report.seconds >= 0.19
+    for index in range(6):
+        name = f"{index}.md"
+        assert (tmp_path / "out" / name).read_bytes() == (tmp_path / name).read_bytes()
+
+
+def test_copy_files_scheduler_limit_does_not_block_workers(tmp_path: Path):
+    for index in range(4):
+        (tmp_path / f"{index}.md").write_bytes(b"x")
+    scheduler = CopyScheduler(max_per_destination=1)
+    slots = scheduler.get_slots(tmp_path / "out")
+    assert slots.acquire(blocking=False)
+    # another copy into the same folder holds the only slot, so nothing is submitted
+    files = get_files_from_folder(DocumentFile, tmp_path)
+    staged = stage_associations(
+        [(file.name, {"doc": [file]}) for file in files],
+        tmp_path / "out",
+        workers=1,
+        scheduler=scheduler,
+    )
+    timer = threading.Timer(0.1, slots.release)
+    timer.start()
+    start = time.perf_counter()
+    assert len(list(staged)) == 4
+    assert time.perf_counter() - start >= 0.09
+    timer.join()
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10_000)
+    assert bucket.consume(10_000) == 0
+    assert 0.1 < bucket.consume(2_000) <= 0.2
+
+
+@mark.parametrize("strategy", ["copy", "copy_file_range"])
+def test_transfer_throttled(tmp_path: Path, strategy: str):
+    source = tmp_path / "source.bin"
+    source.write_bytes(os.urandom(3 * sourcelib.copy.RESUME_BLOCK_SIZE // 2))
+    consumed = []
+    transfer(source, tmp_path / "copy.bin", strategy, throttle=consumed.append)
+    assert (tmp_path / "copy.bin").read_bytes() == source.read_bytes()
+    assert sum(consumed) == source.stat().st_size and len(consumed) == 2
+
+
+def test_transfer_copy_file_range_short_copy(tmp_path: Path, monkeypatch):
+    source = tmp_path / "source.bin"
+    source.write_bytes(os.urandom(1000))
+    monkeypatch.setattr(os, "copy_file_range", lambda *args: 0, raising=False)
+    transfer(source, tmp_path / "copy.bin", "copy_file_range")
+    assert (tmp_path / "copy.bin").read_bytes() == source.read_bytes()
+
+
+@mark.parametrize("strategy", TRANSFER_STRATEGIES)
+def test_copy_file_strategies(tmp_path: Path, strategy: str):
+    tpt_path = Path(__file__).parent / "testfiles" / "testparts.tpt"
+    tpt_file = DocumentFile(path=tpt_path)
+    tpt_file.copy(tmp_path, strategy=strategy)
+    assert (tmp_path / "testparts.tpt").read_bytes() == tpt_path.read_bytes()
+    assert (tmp_path / "testparts" / "p1.txt").exists()
+    assert tpt_file.path == tmp_path / "testparts.tpt"
+
+
+def test_transfer_hardlink(tmp_path: Path):
+    source = tmp_path / "source.txt"
+    source.write_text("data")
+    transfer(source, tmp_path / "linked.txt", strategy="hardlink")
+    assert os.path.samefile(source, tmp_path / "linked.txt")
+
+
+def test_transfer_unknown_strategy(tmp_path: Path):
+    with raises(ValueError):
+        transfer(Path(__file__), tmp_path / "file.py", strategy="teleport")
+
+
+def test_copy_replaces_incomplete_destination(tmp_path: Path):
+    markdown_path = Path(__file__).parent / "testfiles" / "test.md"
+    (tmp_path / "test.md").write_text("trunc")
+    DocumentFile(path=markdown_path).copy(tmp_path)
+    assert (tmp_path / "test.md").read_bytes() == markdown_path.read_bytes()
+    assert not (tmp_path / ("test.md" + PARTIAL_SUFFIX)).exists()
+
+
+def test_copy_verify_checksum(tmp_path: Path):
+    markdown_path = Path(__file__).parent / "testfiles" / "test.md"
+    destination_path = tmp_path / "test.md"
+    destination_path.write_bytes(b"x" * markdown_path.stat().st_size)
+    shutil.copystat(markdown_path, destination_path)
+    assert is_complete(markdown_path, destination_path)
+    assert not is_complete(markdown_path, destination_path, verify="blake2b")
+
+    DocumentFile(path=markdown_path).copy(tmp_path, verify="blake2b")
+    assert destination_path.read_bytes() == markdown_path.read_bytes()
+
+
+@mark.parametrize("strategy", ["copy", "copy_file_range"])
+def test_transfer_resumes_partial_copy(tmp_path: Path, monkeypatch, strategy: str):
+    monkeypatch.setattr(sourcelib.copy, "RESUME_BLOCK_SIZE", 4)
+    source = tmp_path / "source.bin"
+    source.write_bytes(b"0123456789abcdefghij")
+    destination_path = tmp_path / "copy.bin"
+    partial_path = tmp_path / ("copy.bin" + PARTIAL_SUFFIX)
+
+    partial_path.write_bytes(b"012345678")
+    transfer(source, destination_path, strategy)
+    assert destination_path.read_bytes() == source.read_bytes()
+    assert not partial_path.exists()
+
+    # a partial copy whose last block differs from the source starts over
+    destination_path.unlink()
+    partial_path.write_bytes(b"0123XXXX89")
+    copied = []
+    transfer(source, destination_path, strategy, throttle=copied.append)
+    assert destination_path.read_bytes() == source.read_bytes()
+    assert sum(copied) == len(source.read_bytes())
+
+
+@mark.parametrize("link", ["hardlink", "symlink"])
+@mark.parametrize("strategy", ["copy", "copy_file_range", "hardlink", "symlink"])
+def test_transfer_does_not_resume_linked_partial(
+    tmp_path: Path, monkeypatch, link: str, strategy: str
+):
+    monkeypatch.setattr(sourcelib.copy, "RESUME_BLOCK_SIZE", 4)
+    source = tmp_path / "source.bin"
+    source.write_bytes(b"0123456789")
+    destination_path = tmp_path / "copy.bin"
+    partial_path = tmp_path / ("copy.bin" + PARTIAL_SUFFIX)
+    if link == "hardlink":
+        os.link(source, partial_path)
+    else:
+        os.symlink(source, partial_path)
+
+    transfer(source, destination_path, strategy)
+    assert source.read_bytes() == b"0123456789"
+    assert destination_path.read_bytes() == source.read_bytes()
+    assert destination_path.is_symlink() == (strategy == "symlink")
+
+
+def test_generated_file_class_is_slotted():
+    ImageFile = generate_file_class(
+        "image", create_extensions_mapping([Extension((".tif",))])
+    )
+    first, second = ImageFile(path="/data/a.tif"), ImageFile(path="/data/b.tif")
+    assert not hasattr(first, "__dict__")
+    assert first.path == Path("/data/a.tif")
+    assert first.name == "a.tif"
+    assert first._folder is second._folder
@@ -0,0 +1,132 @@
+import os
+import threading
+from pathlib import Path
+
+from pytest import mark, raises
+
+from sourcelib.copy import NonExistingSourceFileError
+from sourcelib.stagingcache import StagingCache
+
+from .testfiles.testclasses import DocumentFile
+
+
+def create_sources(folder: Path, sizes: dict) -> dict:
+    folder.mkdir(parents=True, exist_ok=True)
+    paths = {}
+    for name, size in sizes.items():
+        paths[name] = folder / name
+        paths[name].write_bytes(os.urandom(size))
+    return paths
+
+
+def test_staging_cache_copy(tmp_path: Path):
+    source = create_sources(tmp_path / "data", {"a.txt": 100})["a.txt"]
+    cache = StagingCache(tmp_path / "cache", link_strategy="hardlink")
+    first = cache.copy(source, tmp_path / "job_1")
+    second = cache.copy(source, tmp_path / "job_2")
+    assert first.read_bytes() == second.read_bytes() == source.read_bytes()
+    assert os.path.samefile(first, second)
+    assert (cache.stats.misses, cache.stats.hits) == (1, 1)
+    assert cache.size == 100
+
+    source.write_bytes(b"changed")
+    os.utime(source, ns=(0, 0))
+    assert cache.copy(source, tmp_path / "job_3").read_bytes() == b"changed"
+    assert cache.stats.misses == 2
+
+
+def test_file_copy_through_cache(tmp_path: Path):
+    cache = StagingCache(tmp_path / "cache")
+    tpt_path = Path(__file__).parent / "testfiles" / "testparts.tpt"
+    for job in ["job_1", "job_2"]:
+        tpt_file = DocumentFile(path=tpt_path)
+        tpt_file.copy(tmp_path / job, cache=cache)
+        assert tpt_file.path == tmp_path / job / "testparts.tpt"
+        assert (tmp_path / job / "testparts" / "p1.txt").exists()
+    assert (cache.stats.misses, cache.stats.hits) == (2, 2)
+
+
+@mark.parametrize("policy, evicted", [("lru", "a.txt"), ("lfu", "b.txt")])
+def test_staging_cache_eviction(tmp_path: Path, policy: str, evicted: str):
+    sources = create_sources(
+        tmp_path / "data", {"a.txt": 100, "b.txt": 100, "c.txt": 100}
+    )
+    cache = StagingCache(tmp_path / "cache", budget=250, policy=policy)
+    for name in ["a.txt", "a.txt", "a.txt", "b.txt"]:
+        cache.copy(sources[name], tmp_path / "job")
+    cache.copy(sources["c.txt"], tmp_path / "job")
+    assert cache.stats.evictions == 1 and cache.size == 200
+
+    # the copies stay valid after their entry is evicted
+    assert all((tmp_path / "job" / name).exists() for name in sources)
+    cached = sorted(path.name for path in (tmp_path / "cache").glob("objects/*/*/*"))
+    assert cached == sorted(set(sources) - {evicted})
+
+
+def test_staging_cache_pinned_entries_are_not_evicted(tmp_path: Path):
+    sources = create_sources(tmp_path / "data", {"a.txt": 100, "b.txt": 100})
+    cache = StagingCache(tmp_path / "cache", budget=150)
+    with cache.pinned(sources["a.txt"]) as cached_a:
+        with cache.pinned(sources["b.txt"]) as cached_b:
+            assert cached_a.exists() and cached_b.exists()
+            assert cache.clear() == 0
+        assert cache.evict() == 100
+        assert cached_a.exists() and not cached_b.exists()
+    assert cache.clear() == 100 and cache.size == 0
+    assert not list((tmp_path / "cache" / "locks").iterdir())
+
+
+def test_staging_cache_only_evicts_after_misses(tmp_path: Path, monkeypatch):
+    source = create_sources(tmp_path / "data", {"a.txt": 100})["a.txt"]
+    cache = StagingCache(tmp_path / "cache", budget=1000)
+    evictions = []
+    monkeypatch.setattr(cache, "evict", lambda: evictions.append(1))
+    for job in ["job_1", "job_2", "job_3"]:
+        cache.copy(source, tmp_path / job)
+    assert len(evictions) == 1
+
+
+def test_staging_cache_copies_are_independent(tmp_path: Path):
+    source = create_sources(tmp_path / "data", {"a.txt": 100})["a.txt"]
+    cache = StagingCache(tmp_path / "cache")
+    first = cache.copy(source, tmp_path / "job_1")
+    first.write_bytes(b"modified")
+    assert cache.copy(source, tmp_path / "job_2").read_bytes() == source.read_bytes()
+
+
+def test_staging_cache_concurrent_fetches(tmp_path: Path):
+    source = create_sources(tmp_path / "data", {"a.txt": 1 << 20})["a.txt"]
+    caches = [StagingCache(tmp_path / "cache") for _ in range(4)]
+    threads = [
+        threading.Thread(target=cache.copy, args=(source, tmp_path / f"job_{index}"))
+        for index, cache in enumerate(caches)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(cache.stats.misses for cache in caches) == 1
+    assert sum(cache.stats.hits for cache in caches) == 3
+
+
+def test_staging_cache_shared_between_threads(tmp_path: Path):
+    source = create_sources(tmp_path / "data", {"a.txt": 100})["a.txt"]
+    cache = StagingCache(tmp_path / "cache")
+
+    def _copy(index: int) -> None:
+        for _ in range(25):
+            cache.copy(source, tmp_path / f"job_{index}")
+
+    threads = [threading.Thread(target=_copy, args=(index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert (cache.stats.misses, cache.stats.hits) == (1, 199)
+
+
+def test_staging_cache_errors(tmp_path: Path):
+    with raises(ValueError):
+        StagingCache(tmp_path / "cache", policy="fifo")
+    with raises(NonExistingSourceFileError):
+        StagingCache(tmp_path / "cache").copy(tmp_path / "missing.txt", tmp_path)
@@ -0,0 +1,98 @@
+from pathlib import Path
+
+import pytest
+import sourcelib.table
+from sourcelib.associations import associate_files
+from sourcelib.collect import get_files_from_folder
+from sourcelib.file import FileMode
+from sourcelib.table import FileTable
+
+from .testfiles.testclasses import DocumentFile
+
+
+def test_file_table_from_folder():
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    table = get_files_from_folder(
+        file_cls=DocumentFile, folder=folder, recursive=True, as_table=True
+    )
+    files = get_files_from_folder(file_cls=DocumentFile, folder=folder, recursive=True)
+    assert isinstance(table, FileTable)
+    assert table.column("path") == [str(file.path) for file in files]
+
+    markdown = table.filter(suffix=".md")
+    assert markdown.column("stem") == ["p1", "p2", "p3"]
+    assert table.filter(suffix=(".md", ".txt"), stem="p1").column("name") == [
+        "p1.txt",
+        "p1.md",
+    ]
+    assert len(table.filter(suffix=".pdf")) == 0
+
+    groups = table.group_by("stem")
+    assert list(groups) == ["p1", "p2", "p3"]
+    assert [len(group) for group in groups.values()] == [2, 2, 1]
+
+    copies = groups["p2"].to_files()
+    assert all(isinstance(file, DocumentFile) for file in copies)
+    assert [file.path for file in copies] == [
+        folder / "p2.txt",
+        folder / "md" / "p2.md",
+    ]
+    assert all(file.mode is FileMode.default for file in copies)
+
+
+def test_file_table_from_associations():
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    table = associate_files(
+        get_files_from_folder(file_cls=DocumentFile, folder=folder),
+        get_files_from_folder(file_cls=DocumentFile, folder=folder / "md"),
+        exact_match=True,
+        as_table=True,
+    )
+    assert table.column("key") == ["p1", "p1", "p2", "p2"]
+    associations = table.to_associations()
+    assert list(associations) == ["p1", "p2"]
+    assert len(associations["p1"][DocumentFile.IDENTIFIER]) == 2
+
+
+def test_file_table_sharded_without_files(monkeypatch):
+    folder = Path(__file__).parent / "testfiles" / "testparts"
+    files = get_files_from_folder(file_cls=DocumentFile, folder=folder, recursive=True)
+
+    def _no_files(*args, **kwargs):
+        raise AssertionError("no File is created for a table")
+
+    monkeypatch.setattr(DocumentFile, "__init__", _no_files)
+    paths = []
+    for shard_index in range(3):
+        table = get_files_from_folder(
+            file_cls=DocumentFile,
+            folder=folder,
+            recursive=True,
+            as_table=True,
+            shard_index=shard_index,
+            num_shards=3,
+        )
+        paths.extend(table.column("path"))
+    assert sorted(paths) == sorted(str(file.path) for file in files)
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_file_table_filter_and_take(tmp_path, monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(sourcelib.table, "numpy", None)
+    table = FileTable()
+    for index in range(6):
+        name = f"{index % 3}.{'md' if index < 3 else 'txt'}"
+        table.append_path(DocumentFile, FileMode.default, tmp_path / name, size=index)
+
+    assert table.filter(suffix=".md", stem=("0", "2")).column("size") == [0, 2]
+    assert table.filter(suffix=".md", min_size=1).column("size") == [1, 2]
+    assert table.filter(min_size=4).column("name") == ["1.txt", "2.txt"]
+    assert len(table.filter(suffix=".pdf")) == 0
+    assert len(table.filter()) == 6
+    taken = table.take([5, 0])
+    assert taken.column("path") == [str(tmp_path / "2.txt"), str(tmp_path / "0.md")]
+    assert taken.column("file_cls") == [DocumentFile, DocumentFile]
+    assert len(table.take([]).filter(suffix=".md")) == 0
@@ -0,0 +1,105 @@
+import os
+
+import pytest
+from sourcelib.watch import AssociationWatcher, InotifyBackend, PollingBackend
+
+from .testfiles.testclasses import DocumentFile
+
+
+def _skip_without_inotify(use_inotify: bool) -> None:
+    try:
+        if use_inotify:
+            InotifyBackend().close()
+    except OSError:
+        pytest.skip("inotify is not available")
+
+
+def _poll(watcher: AssociationWatcher) -> None:
+    # polling reports a new file once it did not change between two polls
+    watcher.poll(timeout=1.0)
+    watcher.poll()
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_association_watcher(tmp_path, use_inotify):
+    _skip_without_inotify(use_inotify)
+
+    (tmp_path / "a.txt").touch()
+    (tmp_path / "a.md").touch()
+    completed, incomplete = [], []
+    watcher = AssociationWatcher(
+        tmp_path,
+        DocumentFile,
+        filters1=[".txt"],
+        filters2=[".md"],
+        exact_match=True,
+        on_complete=lambda file_key, files: completed.append(file_key),
+        on_incomplete=incomplete.append,
+        poll_interval=0.0,
+        use_inotify=use_inotify,
+    )
+    assert list(watcher.associations) == ["a"]
+    assert completed == ["a"]
+
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "b.txt").touch()
+    _poll(watcher)
+    (tmp_path / "sub" / "b.md").touch()
+    _poll(watcher)
+    assert completed == ["a", "b"]
+    assert sorted(watcher.associations) == ["a", "b"]
+
+    (tmp_path / "a.md").unlink()
+    _poll(watcher)
+    assert incomplete == ["a"]
+    assert list(watcher.associations) == ["b"]
+
+    (tmp_path / "a.md").touch()
+    _poll(watcher)
+    assert completed == ["a", "b", "a"]
+    watcher.stop()
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_association_watcher_waits_for_written_files(tmp_path, use_inotify):
+    _skip_without_inotify(use_inotify)
+    (tmp_path / "a.md").touch()
+    completed = []
+    watcher = AssociationWatcher(
+        tmp_path,
+        DocumentFile,
+        filters1=[".txt"],
+        filters2=[".md"],
+        on_complete=lambda file_key, files: completed.append(file_key),
+        poll_interval=0.0,
+        use_inotify=use_inotify,
+    )
+    with open(tmp_path / "a.txt", "wb") as file:
+        for _ in range(3):
+            file.write(b"0123456789")
+            file.flush()
+            watcher.poll(timeout=0.1)
+        assert completed == [] and len(watcher.files) == 1
+    _poll(watcher)
+    assert completed == ["a"]
+    with watcher.lock:
+        assert sorted(file.size for file in watcher.associations["a"]["doc"]) == [0, 30]
+    watcher.stop()
+
+
+def test_polling_backend_lists_changes_within_mtime_tick(tmp_path, monkeypatch):
+    (tmp_path / "a.txt").touch()
+    mtime_ns = tmp_path.stat().st_mtime_ns
+    backend = PollingBackend()
+    backend.add_folder(str(tmp_path))
+    # a file created in the same mtime tick as the listing leaves the mtime as is
+    (tmp_path / "b.txt").touch()
+    os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+    assert backend.poll() == []
+    assert backend.poll() == [str(tmp_path / "b.txt")]
+
+    monkeypatch.setattr("sourcelib.watch.MTIME_TICK_NS", 0)
+    assert backend.poll() == []
+    (tmp_path / "c.txt").touch()
+    assert backend.poll() == []
+    assert backend.poll() == [str(tmp_path / "c.txt")]